@@ -2,14 +2,22 @@
 API для администраторов (управление остановками)
 """
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 from datetime import datetime, timedelta
 
 from core.database import get_db
 from core import schemas
 from core.models import Stop, LoadData
-from tasks.monitoring_tasks import monitor_stop_passive_task, monitor_all_stops_passive_task
+from core.config import settings
+from services.stop_state import stop_state, updated_at
+from services import stream_monitor
+from tasks.monitoring_tasks import (
+    monitor_stop_passive_task, monitor_all_stops_passive_task, monitor_all_stops_batch_task
+)
+from tasks.video_tasks import process_video_stream_task
+from core.cameras import IS74_CAMERAS
 
 router = APIRouter()
 
@@ -56,6 +64,8 @@ async def update_stop(
     
     db.commit()
     db.refresh(stop)
+    # Название и настройки остановки в кэшированном состоянии могли устареть
+    stop_state.invalidate(stop_id)
     return stop
 
 
@@ -133,8 +143,11 @@ async def trigger_monitoring(stop_id: int, db: Session = Depends(get_db)):
 async def trigger_monitoring_all(db: Session = Depends(get_db)):
     """Ручной запуск задачи мониторинга для всех остановок"""
     try:
-        # Запускаем задачу синхронно
-        result = monitor_all_stops_passive_task()
+        # Запускаем задачу синхронно (в режиме мониторинга из настроек)
+        if settings.MONITORING_MODE == "batch":
+            result = monitor_all_stops_batch_task()
+        else:
+            result = monitor_all_stops_passive_task()
         
         return {
             "success": True,
@@ -147,39 +160,87 @@ async def trigger_monitoring_all(db: Session = Depends(get_db)):
 
 @router.get("/monitoring-status")
 async def get_monitoring_status(db: Session = Depends(get_db)):
-    """Получение статуса мониторинга (последние записи, активность)"""
-    # Проверяем последние записи
-    ten_min_ago = datetime.now() - timedelta(minutes=10)
-    recent_data = db.query(LoadData).filter(
-        LoadData.timestamp >= ten_min_ago
-    ).order_by(LoadData.timestamp.desc()).all()
-    
-    # Группируем по остановкам
-    stops_data = {}
-    for data in recent_data:
-        if data.stop_id not in stops_data:
-            stops_data[data.stop_id] = []
-        stops_data[data.stop_id].append({
-            "timestamp": data.timestamp.isoformat() + 5,
-            "people_count": data.people_count,
-            "buses_detected": data.buses_detected
-        })
-    
+    """
+    Получение статуса мониторинга (последние записи, активность)
+    Последние значения берутся из состояния остановок в Redis
+    """
     # Проверяем активные остановки
-    active_stops = db.query(Stop).filter(
+    active_stop_ids = [stop_id for (stop_id,) in db.query(Stop.id).filter(
         Stop.is_active == True,
         Stop.camera_id.isnot(None),
         Stop.stop_zone_coords.isnot(None)
-    ).count()
+    ).all()]
+    
+    # Последние записи по остановкам за 10 минут
+    ten_min_ago = datetime.now() - timedelta(minutes=10)
+    states = stop_state.get_or_load(db, active_stop_ids)
+    stops_data = {
+        stop_id: {
+            "timestamp": state["updated_at"],
+            "people_count": state["people_count"],
+            "smoothed_count": state.get("smoothed_count"),
+            "buses_detected": state["buses_detected"]
+        }
+        for stop_id, state in states.items()
+        if updated_at(state) >= ten_min_ago
+    }
+    
+    # Записи LoadData за 10 минут: одна агрегатная выборка без загрузки строк
+    recent_records_count = db.query(func.count(LoadData.id)).filter(
+        LoadData.timestamp >= ten_min_ago
+    ).scalar()
     
     return {
-        "recent_records_count": len(recent_data),
-        "active_stops_count": active_stops,
+        "recent_records_count": recent_records_count,
+        "active_stops_count": len(active_stop_ids),
         "stops_with_recent_data": len(stops_data),
-        "last_10_minutes": {
-            stop_id: records[0] if records else None
-            for stop_id, records in stops_data.items()
-        },
-        "is_monitoring_active": len(recent_data) > 0
+        "last_10_minutes": stops_data,
+        "is_monitoring_active": recent_records_count > 0
     }
 
+
+def _stream_stop(db: Session, stop_id: int) -> Stop:
+    stop = db.query(Stop).filter(Stop.id == stop_id).first()
+    if not stop:
+        raise HTTPException(status_code=404, detail="Остановка не найдена")
+    if not stop.camera_id or stop.camera_id not in IS74_CAMERAS:
+        raise HTTPException(status_code=400, detail="Camera ID не настроен")
+    return stop
+
+
+@router.post("/stream-monitoring/{stop_id}/start")
+async def start_stream_monitoring(stop_id: int, duration: Optional[float] = None, db: Session = Depends(get_db)):
+    """
+    Запуск непрерывного мониторинга видеопотока камеры остановки
+    Воркер обрабатывает все активные остановки камеры (очередь Celery streams)
+    """
+    stop = _stream_stop(db, stop_id)
+    if not stop.stop_zone_coords:
+        raise HTTPException(status_code=400, detail="Зона остановки не настроена")
+    if stream_monitor.is_running(stop.camera_id):
+        raise HTTPException(status_code=409, detail="Мониторинг потока камеры уже запущен")
+    
+    result = process_video_stream_task.delay(None, stop_id, duration)
+    return {
+        "task_id": result.id,
+        "camera_id": stop.camera_id,
+        "status": "starting"
+    }
+
+
+@router.post("/stream-monitoring/{stop_id}/stop")
+async def stop_stream_monitoring(stop_id: int, db: Session = Depends(get_db)):
+    """Остановка мониторинга потока камеры остановки (воркер завершится в течение нескольких секунд)"""
+    stop = _stream_stop(db, stop_id)
+    if not stream_monitor.request_stop(stop.camera_id):
+        raise HTTPException(status_code=404, detail="Мониторинг потока камеры не запущен")
+    return {"camera_id": stop.camera_id, "status": "stopping"}
+
+
+@router.get("/stream-monitoring")
+async def get_stream_monitoring_status():
+    """Статус воркеров непрерывного мониторинга по камерам"""
+    return {
+        "cameras": stream_monitor.get_status(list(IS74_CAMERAS.keys())),
+        "supervised": settings.STREAM_MONITOR_CAMERAS
+    }
@@ -1,21 +1,42 @@
 """
 API для работы с компьютерным зрением
 """
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse, FileResponse, Response
+from fastapi import APIRouter, UploadFile, File, Form, Depends, HTTPException, WebSocket, WebSocketDisconnect, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse, FileResponse, Response, JSONResponse
 import cv2
-import numpy as np
 from io import BytesIO
 from PIL import Image
 import asyncio
+import base64
+import json
+import shutil
 import tempfile
+import time
 import os
-from typing import Optional
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import List, Optional, Tuple
 
 from services.cv_service import cv_service
 from services.video_processor import video_processor
+from services.camera_hub import camera_hub, CameraViewer, resolve_fps, parse_stream_profile, encode_tagged_frame
+from services.hls_writer import hls_service
+from services.snapshot_service import SnapshotError
+from services.snapshot_cache import snapshot_cache
+from services.zone_store import zone_store
+from services.frame_store import frame_store
+from services.video_jobs import video_jobs, VideoJobError
+from services.batch_detection import detect_images, BatchDetectionError
+from services.frame_dedup import frame_dedup
+from services.detection_bus import camera_detections
+from services.image_decode import decode_image
+from services.event_bus import event_relay, new_queue, camera_channel, stop_channel
 from tasks.video_tasks import process_video_frame_task
 from core.cameras import IS74_CAMERAS
+from core.config import settings
 
 router = APIRouter()
 
@@ -25,16 +46,15 @@ async def detect_objects(file: UploadFile = File(...)):
     """
     Детекция объектов на загруженном изображении
     """
-    # Чтение изображения
+    # Чтение изображения (с уменьшением до размера входа модели, если возможно)
     contents = await file.read()
-    nparr = np.frombuffer(contents, np.uint8)
-    frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    image = decode_image(contents)
     
-    if frame is None:
+    if image is None:
         raise HTTPException(status_code=400, detail="Не удалось декодировать изображение")
     
-    # Детекция
-    detections = cv_service.detect_objects(frame)
+    # Детекция, координаты - исходного изображения
+    detections = image.to_full(cv_service.detect_decoded(image))
     
     return {
         "people_count": len(detections['people']),
@@ -43,24 +63,51 @@ async def detect_objects(file: UploadFile = File(...)):
     }
 
 
+@router.post("/detect-batch")
+async def detect_batch(files: List[UploadFile] = File(...)):
+    """
+    Детекция на наборе изображений (см. services/batch_detection.py)
+    
+    Файлы - изображения или архивы zip/tar (в том числе .tar.gz) с изображениями.
+    Изображения распознаются порциями по DETECTION_BATCH_SIZE, ответ - поток NDJSON:
+    событие image на каждое изображение в порядке набора ({"index", "name",
+    "people_count", "buses_count", "detections"} или {"index", "name", "error"})
+    по мере готовности порций, итоговое событие done. Ошибка чтения архива или
+    другая ошибка обработки набора - последнее событие error
+    """
+    async def events():
+        try:
+            async for event in detect_images([(file.filename or "image", file.file) for file in files]):
+                yield json.dumps(jsonable_encoder(event), ensure_ascii=False) + "\n"
+        except BatchDetectionError as e:
+            yield json.dumps({"event": "error", "error": str(e)}, ensure_ascii=False) + "\n"
+        except Exception as e:
+            # Заголовки уже отправлены: ошибка сообщается последним событием потока
+            print(f"[BATCH DETECT] Ошибка обработки набора: {e}")
+            yield json.dumps({"event": "error", "error": f"Ошибка обработки набора: {e}"}, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(
+        events(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.post("/detect-with-visualization")
 async def detect_with_visualization(file: UploadFile = File(...)):
     """
     Детекция объектов с визуализацией результатов
     """
-    # Чтение изображения
+    # Чтение изображения (с уменьшением до размера входа модели, если возможно)
     contents = await file.read()
-    nparr = np.frombuffer(contents, np.uint8)
-    frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    image = decode_image(contents)
     
-    if frame is None:
+    if image is None:
         raise HTTPException(status_code=400, detail="Не удалось декодировать изображение")
     
-    # Детекция
-    detections = cv_service.detect_objects(frame)
-    
-    # Отрисовка детекций
-    result_frame = cv_service.draw_detections(frame, detections)
+    # Детекция и отрисовка на декодированном кадре
+    detections = cv_service.detect_decoded(image)
+    result_frame = cv_service.draw_detections(image.frame, detections)
     
     # Конвертация в формат для отправки
     _, encoded_img = cv2.imencode('.jpg', result_frame)
@@ -85,9 +132,17 @@ async def process_frame_endpoint(
     Обработка кадра с сохранением результатов в БД
     """
     contents = await file.read()
+    if not contents:
+        raise HTTPException(status_code=400, detail="Пустой файл")
+    
+    # Кадр передается задаче через хранилище, в брокер уходит только ссылка
+    try:
+        frame_ref = await asyncio.to_thread(frame_store.put, contents)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Хранилище кадров недоступно: {str(e)}")
     
     # Отправка задачи в Celery
-    result = process_video_frame_task.delay(contents, stop_id)
+    result = process_video_frame_task.delay(frame_ref, stop_id)
     
     return {
         "task_id": result.id,
@@ -95,60 +150,244 @@ async def process_frame_endpoint(
     }
 
 
+@router.post("/process-video")
+async def process_video(
+    file: UploadFile = File(...),
+    save_output: bool = Form(False),
+    fps: Optional[float] = Form(None)
+):
+    """
+    Офлайн обработка видеофайла пулом процессов (см. services/video_jobs.py)
+    
+    Ответ - поток NDJSON: событие started, события progress по мере готовности
+    отрезков и итоговое событие result с количеством людей и автобусов по секундам
+    и ссылкой на аннотированное видео (save_output). Ошибка - событие error
+    
+    Args:
+        file: видеофайл
+        save_output: записать аннотированное видео
+        fps: частота анализа кадров по времени видео (по умолчанию VIDEO_JOB_FPS)
+    """
+    if fps is not None and fps <= 0:
+        raise HTTPException(status_code=400, detail="fps должен быть положительным")
+    
+    job_id = video_jobs.create_job()
+    suffix = os.path.splitext(file.filename or "")[1] or ".mp4"
+    input_path = os.path.join(video_jobs.job_dir(job_id), f"input{suffix}")
+    
+    def save_upload():
+        with open(input_path, "wb") as f:
+            shutil.copyfileobj(file.file, f, 1024 * 1024)
+    
+    await asyncio.to_thread(save_upload)
+    if os.path.getsize(input_path) == 0:
+        raise HTTPException(status_code=400, detail="Пустой файл")
+    
+    async def events():
+        try:
+            async for event in video_jobs.run(job_id, input_path, fps=fps, save_output=save_output):
+                yield json.dumps(jsonable_encoder(event), ensure_ascii=False) + "\n"
+        except VideoJobError as e:
+            yield json.dumps({"event": "error", "job_id": job_id, "error": str(e)}, ensure_ascii=False) + "\n"
+        finally:
+            # Исходный файл больше не нужен, аннотированное видео хранится до VIDEO_JOB_TTL
+            try:
+                os.unlink(input_path)
+            except OSError:
+                pass
+    
+    return StreamingResponse(
+        events(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/process-video/{job_id}/output")
+async def get_processed_video(job_id: str):
+    """Аннотированное видео офлайн обработки"""
+    path = video_jobs.output_path(job_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Видео не найдено или истек срок хранения")
+    return FileResponse(path, media_type="video/mp4", filename=f"processed_{job_id}.mp4")
+
+
+# Начало JPEG (SOI): кадр клиента без префикса ID
+JPEG_SOI = b"\xff\xd8"
+
+
+def parse_client_frame(payload: bytes) -> Optional[Tuple[Optional[int], bytes]]:
+    """
+    Разбор бинарного сообщения клиента /process-video-stream
+    Returns:
+        (ID кадра или None - кадр без префикса, JPEG) или None - в сообщении нет кадра
+    """
+    if payload[:2] == JPEG_SOI:
+        return None, payload
+    if len(payload) <= 4:
+        return None
+    return int.from_bytes(payload[:4], "big"), payload[4:]
+
+
+def frame_message(frame_id: int, tagged: bool, jpeg: bytes) -> bytes:
+    """Бинарный ответ на кадр в формате кадра клиента (с префиксом ID, если он был)"""
+    return frame_id.to_bytes(4, "big") + jpeg if tagged else jpeg
+
+
+def _detect_client_frame(payload: bytes, source: tuple):
+    """
+    Декодирование кадра клиента, детекция и отрисовка (выполняется в потоке)
+    Большой кадр декодируется с уменьшением, результат отрисовывается на нем же.
+    Повтор предыдущего кадра соединения (пауза, статичная сцена) получает его детекции
+    """
+    image = decode_image(payload)
+    if image is None:
+        return None
+    detections, duplicate = frame_dedup.get_or_compute(source, image.frame, lambda: cv_service.detect_decoded(image))
+    return cv_service.draw_detections(image.frame, detections), detections, duplicate
+
+
+def _encode_result_frame(frame) -> bytes:
+    _, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return encoded.tobytes()
+
+
 @router.websocket("/process-video-stream")
 async def process_video_stream(websocket: WebSocket):
     """
     WebSocket для обработки видеопотока в реальном времени
+    
+    Прием кадров, детекция (в потоке) и кодирование/отправка результатов работают
+    параллельно. Клиент держит до window кадров без ответа; если кадры приходят
+    быстрее детекции, обрабатывается самый свежий, а устаревшие пропускаются
+    с уведомлением {"frame_id", "skipped": true}
+    
+    Сообщения клиента:
+        - бинарное: 4 байта ID кадра (uint32 big-endian, меньше 0xFFD80000 -
+          иначе префикс не отличить от начала JPEG) + JPEG,
+          или только JPEG (ID присваивает сервер по порядку)
+        - текст "stop" - завершение после отправки результатов принятых кадров
+    Ответ на кадр: бинарное сообщение в том же формате с аннотированным JPEG,
+    затем JSON {"frame_id", "people_count", "buses_count", "latency_ms", "skipped": false, "duplicate"}
+    (duplicate - кадр совпал с предыдущим, детекции повторены без запуска модели)
+    
+    Query параметры:
+        - window: кадров в обработке одновременно (по умолчанию VIDEO_WS_WINDOW)
     """
+    try:
+        window = int(websocket.query_params.get("window", settings.VIDEO_WS_WINDOW))
+    except ValueError:
+        await websocket.close(code=1008, reason="Некорректный размер окна")
+        return
+    window = max(1, min(window, 8))
+    
     await websocket.accept()
     
-    try:
-        while True:
-            # Получаем данные от клиента
-            data = await websocket.receive()
-            
-            frame_data = None
-            if "bytes" in data:
-                frame_data = data["bytes"]
-            elif "text" in data:
-                # Если это команда (например, "stop")
-                if data["text"] == "stop":
+    # Принятые, но еще не обработанные кадры: (frame_id, tagged, payload, received_at)
+    pending = deque()
+    frame_ready = asyncio.Event()
+    # Сообщения для отправки по порядку: уведомления о пропуске и результаты; None - конец
+    outbox: asyncio.Queue = asyncio.Queue()
+    # Кадров между началом детекции и отправкой результата
+    slots = asyncio.Semaphore(window)
+    state = {"closed": False, "next_id": 0}
+    dedup_source = ("ws", uuid.uuid4().hex)
+    
+    def skip(item):
+        outbox.put_nowait({"type": "skip", "frame_id": item[0]})
+    
+    async def receive_frames():
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                if message.get("text") == "stop":
                     break
+                payload = message.get("bytes")
+                if not payload:
+                    continue
+                parsed = parse_client_frame(payload)
+                if parsed is None:
+                    continue
+                frame_id, payload = parsed
+                tagged = frame_id is not None
+                if not tagged:
+                    state["next_id"] += 1
+                    frame_id = state["next_id"]
+                if len(pending) >= window:
+                    skip(pending.popleft())
+                pending.append((frame_id, tagged, payload, time.monotonic()))
+                frame_ready.set()
+        finally:
+            state["closed"] = True
+            frame_ready.set()
+    
+    async def run_inference():
+        while True:
+            # Слот берется до выбора кадра: пока отправка отстает, успевают прийти более свежие кадры
+            await slots.acquire()
+            while not pending and not state["closed"]:
+                frame_ready.clear()
+                await frame_ready.wait()
+            if not pending:
+                outbox.put_nowait(None)
+                return
+            item = pending.pop()
+            while pending:
+                skip(pending.popleft())
+            try:
+                result = await asyncio.to_thread(_detect_client_frame, item[2], dedup_source)
+            except BaseException:
+                slots.release()
+                raise
+            outbox.put_nowait({"type": "result", "item": item, "result": result})
+    
+    async def send_results():
+        while True:
+            message = await outbox.get()
+            if message is None:
+                return
+            if message["type"] == "skip":
+                await websocket.send_json({"frame_id": message["frame_id"], "skipped": True})
                 continue
-            else:
-                continue
-            
-            # Декодируем кадр
-            nparr = np.frombuffer(frame_data, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if frame is None:
-                continue
-            
-            # Обрабатываем кадр
-            detections = cv_service.detect_objects(frame)
-            
-            # Визуализируем детекции
-            result_frame = cv_service.draw_detections(frame, detections)
-            
-            # Кодируем обработанный кадр
-            _, encoded = cv2.imencode('.jpg', result_frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
-            
-            # Отправляем обратно клиенту
-            await websocket.send_bytes(encoded.tobytes())
-            
-            # Отправляем метаданные через JSON (после изображения)
-            await asyncio.sleep(0.001)  # Небольшая задержка для разделения сообщений
-            await websocket.send_json({
-                "people_count": len(detections['people']),
-                "buses_count": len(detections['buses'])
-            })
-            
+            frame_id, tagged, _, received_at = message["item"]
+            try:
+                if message["result"] is None:
+                    await websocket.send_json({"frame_id": frame_id, "error": "Не удалось декодировать кадр"})
+                    continue
+                result_frame, detections, duplicate = message["result"]
+                encoded = await asyncio.to_thread(_encode_result_frame, result_frame)
+                await websocket.send_bytes(frame_message(frame_id, tagged, encoded))
+                await websocket.send_json({
+                    "frame_id": frame_id,
+                    "people_count": len(detections['people']),
+                    "buses_count": len(detections['buses']),
+                    "latency_ms": round((time.monotonic() - received_at) * 1000, 1),
+                    "skipped": False,
+                    "duplicate": duplicate
+                })
+            finally:
+                slots.release()
+    
+    tasks = []
+    try:
+        tasks = [
+            asyncio.create_task(receive_frames()),
+            asyncio.create_task(run_inference()),
+            asyncio.create_task(send_results())
+        ]
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
     except WebSocketDisconnect:
         pass
     except Exception as e:
         print(f"Ошибка WebSocket: {e}")
     finally:
+        for task in tasks:
+            task.cancel()
+        frame_dedup.forget(dedup_source)
         try:
             await websocket.close()
         except:
@@ -172,6 +411,15 @@ async def get_available_cameras():
     }
 
 
+@router.get("/dedup-stats")
+async def get_dedup_stats():
+    """
+    Счетчики подавления повторных кадров в процессе API
+    checked - проверено кадров, duplicates - детекций не потребовалось (по типам источников)
+    """
+    return frame_dedup.get_stats()
+
+
 @router.get("/camera/{camera_id}/stream")
 async def get_camera_stream(camera_id: str, with_detection: bool = False):
     """
@@ -212,12 +460,19 @@ async def camera_stream_websocket(websocket: WebSocket, camera_id: str):
     """
     WebSocket поток с камеры с возможностью детекции
     Использует HD качество для лучшего распознавания номеров автобусов
+    Кадры берутся из общего конвейера камеры (один захват на всех зрителей)
     
     Args:
         camera_id: ID камеры (camera1, camera2, camera3)
         Query параметры:
         - with_detection: Включить детекцию объектов (по умолчанию True)
         - fps_mode: Режим FPS - "active" (8 FPS) или "passive" (1 FPS, по умолчанию)
+        - fps: Явный FPS (приоритетнее fps_mode)
+        - width: Ширина кадра в пикселях, "auto" (по пропускной способности, по умолчанию) или "original"
+        - quality: Качество JPEG 10..95
+    
+    Параметры кадра можно менять без переподключения командой
+        {"action": "configure", "fps_mode": ..., "fps": ..., "width": ..., "quality": ...}
     """
     if camera_id not in IS74_CAMERAS:
         await websocket.close(code=1008, reason="Камера не найдена")
@@ -226,157 +481,335 @@ async def camera_stream_websocket(websocket: WebSocket, camera_id: str):
     # Получаем query параметры
     query_params = dict(websocket.query_params)
     with_detection = query_params.get('with_detection', 'true').lower() == 'true'
-    fps_mode = query_params.get('fps_mode', 'passive').lower()
+    query_params.setdefault('fps_mode', 'passive')
+    try:
+        profile = parse_stream_profile(query_params)
+    except ValueError:
+        await websocket.close(code=1008, reason="Некорректные параметры кадра")
+        return
     
     await websocket.accept()
     
-    camera = IS74_CAMERAS[camera_id]
-    # Пытаемся использовать HD качество, если недоступно - переключаемся на main
-    # Пробуем разные форматы RTSP URL и HLS как альтернативу
-    stream_urls = [
-        # RTSP варианты
-        f"rtsp://cdn.cams.is74.ru:8554/stream?uuid={camera['uuid']}&quality=hd",
-        f"rtsp://cdn.cams.is74.ru:8554/stream?uuid={camera['uuid']}&quality=main",
-        f"rtsp://cdn.cams.is74.ru:8554?uuid={camera['uuid']}&quality=hd",
-        f"rtsp://cdn.cams.is74.ru:8554?uuid={camera['uuid']}&quality=main",
-        f"rtsp://cdn.cams.is74.ru:8554/{camera['uuid']}?quality=hd",
-        camera["rtsp"],
-        camera.get("rtsp_main"),
-        # HLS как последняя попытка (требует специальной обработки)
-        camera.get("hls"),
-    ]
-    
-    cap = None
-    stream_url = None
+    viewer = CameraViewer()
+    camera_hub.subscribe(camera_id, viewer, with_detection, profile)
     
+    async def receive_commands():
+        while True:
+            message = await websocket.receive_json()
+            if message.get("action") != "configure":
+                await websocket.send_json({"error": f"Неизвестная команда: {message.get('action')}"})
+                continue
+            try:
+                camera_hub.configure(camera_id, viewer, parse_stream_profile(message))
+            except ValueError:
+                await websocket.send_json({"error": "Некорректные параметры кадра"})
+    
+    async def send_frames():
+        while True:
+            for packet in await viewer.get():
+                if packet["type"] == "status":
+                    await websocket.send_json({
+                        "status": packet["status"],
+                        "camera_name": packet["camera_name"],
+                        "detection_enabled": packet["detection_enabled"]
+                    })
+                elif packet["type"] == "error":
+                    await websocket.send_json({"error": packet["error"]})
+                    return
+                else:
+                    # Отправляем кадр, замеряя пропускную способность клиента
+                    started = time.monotonic()
+                    await websocket.send_bytes(packet["jpeg"])
+                    viewer.throughput.record(len(packet["jpeg"]), time.monotonic() - started)
+                    
+                    # Отправляем метаданные если включена детекция (со сглаженными значениями)
+                    if packet["meta"] is not None:
+                        await websocket.send_json({**packet["meta"], **packet["profile"]})
+    
+    tasks = []
     try:
-        # Пробуем разные форматы URL
-        for url in stream_urls:
-            if not url:
+        tasks = [asyncio.create_task(receive_commands()), asyncio.create_task(send_frames())]
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            # Пробрасываем исключение завершившейся задачи (включая отключение клиента)
+            task.result()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"Ошибка обработки потока камеры {camera_id}: {e}")
+        try:
+            await websocket.send_json({"error": str(e)})
+        except:
+            pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        camera_hub.unsubscribe(camera_id, viewer)
+        try:
+            await websocket.close()
+        except:
+            pass
+
+
+@router.websocket("/cameras/stream-ws")
+async def multi_camera_stream_websocket(websocket: WebSocket):
+    """
+    Мультиплексированный WebSocket поток нескольких камер в одном соединении
+    
+    Query параметры (начальная подписка, необязательно):
+        - camera_ids: список ID камер через запятую
+        - with_detection: Включить детекцию объектов (по умолчанию True)
+        - fps_mode: "active" (8 FPS) или "passive" (1 FPS, по умолчанию)
+    
+    Команды клиента (JSON, в любой момент без переподключения):
+        {"action": "subscribe", "camera_ids": [...], "with_detection": true, "fps_mode": "passive",
+         "width": 480, "quality": 70}
+        {"action": "configure", "camera_ids": [...], "fps": 2, "width": "auto", "quality": 80}
+        {"action": "unsubscribe", "camera_ids": [...]}
+    Повторная подписка на ту же камеру меняет ее параметры.
+    width: пиксели, "auto" (по пропускной способности клиента, по умолчанию) или "original".
+    
+    Сообщения сервера:
+        - бинарные: 1 байт длины ID камеры, ID камеры (ASCII), затем JPEG кадра
+        - JSON: {"type": "status" | "meta" | "error" | "subscriptions", "camera_id": ..., ...}
+    """
+    await websocket.accept()
+    
+    viewer = CameraViewer()
+    subscriptions = set()
+    
+    async def send_subscriptions():
+        await websocket.send_json({"type": "subscriptions", "camera_ids": sorted(subscriptions)})
+    
+    async def subscribe(camera_ids, with_detection, profile):
+        for camera_id in camera_ids:
+            if camera_id not in IS74_CAMERAS:
+                await websocket.send_json({"type": "error", "camera_id": camera_id, "error": "Камера не найдена"})
                 continue
+            camera_hub.subscribe(camera_id, viewer, with_detection, profile)
+            subscriptions.add(camera_id)
+    
+    def unsubscribe(camera_ids):
+        for camera_id in camera_ids:
+            camera_hub.unsubscribe(camera_id, viewer)
+            subscriptions.discard(camera_id)
+    
+    async def receive_commands():
+        while True:
+            message = await websocket.receive_json()
+            action = message.get("action")
+            camera_ids = message.get("camera_ids") or []
             try:
-                test_cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
-                test_cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Минимальный буфер для снижения задержки
-                test_cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'H264'))
-                
-                # Даем больше времени на подключение для RTSP
-                await asyncio.sleep(1.0)
-                
-                if test_cap.isOpened():
-                    # Проверяем, что поток действительно работает
-                    ret, test_frame = test_cap.read()
-                    if ret and test_frame is not None and test_frame.size > 0:
-                        cap = test_cap
-                        stream_url = url
-                        print(f"✓ Успешное подключение к камере {camera_id} через URL: {url}")
-                        break
-                test_cap.release()
-            except Exception as e:
-                print(f"Ошибка при попытке подключения к {url}: {e}")
-                if 'test_cap' in locals():
-                    try:
-                        test_cap.release()
-                    except:
-                        pass
+                profile = parse_stream_profile(message)
+            except ValueError:
+                await websocket.send_json({"type": "error", "error": "Некорректные параметры кадра"})
+                continue
+            if action == "subscribe":
+                profile.setdefault("fps", resolve_fps("passive"))
+                await subscribe(camera_ids, bool(message.get("with_detection", True)), profile)
+            elif action == "configure":
+                for camera_id in camera_ids:
+                    if camera_id in subscriptions:
+                        camera_hub.configure(camera_id, viewer, profile)
+            elif action == "unsubscribe":
+                unsubscribe(camera_ids)
+            else:
+                await websocket.send_json({"type": "error", "error": f"Неизвестная команда: {action}"})
                 continue
+            await send_subscriptions()
+    
+    async def send_frames():
+        while True:
+            for packet in await viewer.get():
+                camera_id = packet["camera_id"]
+                # Пакет мог прийти до отписки - не отправляем лишнего
+                if camera_id not in subscriptions:
+                    continue
+                if packet["type"] == "frame":
+                    data = encode_tagged_frame(camera_id, packet["jpeg"])
+                    started = time.monotonic()
+                    await websocket.send_bytes(data)
+                    viewer.throughput.record(len(data), time.monotonic() - started)
+                    if packet["meta"] is not None:
+                        await websocket.send_json({
+                            "type": "meta", "camera_id": camera_id, **packet["meta"], **packet["profile"]
+                        })
+                else:
+                    if packet["type"] == "error":
+                        # Конвейер камеры остановлен - подписка снимается
+                        subscriptions.discard(camera_id)
+                        camera_hub.unsubscribe(camera_id, viewer)
+                    await websocket.send_json(packet)
+    
+    query_params = dict(websocket.query_params)
+    initial_ids = [c for c in query_params.get('camera_ids', '').split(',') if c]
+    
+    tasks = []
+    try:
+        if initial_ids:
+            query_params.setdefault('fps_mode', 'passive')
+            await subscribe(
+                initial_ids,
+                query_params.get('with_detection', 'true').lower() == 'true',
+                parse_stream_profile(query_params)
+            )
+        await send_subscriptions()
         
-        if not cap or not cap.isOpened():
-            await websocket.send_json({
-                "error": f"Не удалось открыть видеопоток камеры {camera_id}. Попробованы все форматы URL."
-            })
+        tasks = [asyncio.create_task(receive_commands()), asyncio.create_task(send_frames())]
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            # Пробрасываем исключение завершившейся задачи (включая отключение клиента)
+            task.result()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"Ошибка мультиплексированного потока камер: {e}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        camera_hub.unsubscribe_all(viewer)
+        try:
             await websocket.close()
-            return
-        
+        except:
+            pass
+
+
+@router.websocket("/detections-ws")
+async def detections_ws(websocket: WebSocket):
+    """
+    Результаты детекции воркеров (Celery) по камерам и остановкам
+    События приходят через Redis pub/sub - процесс API не выполняет инференс.
+    
+    Query параметры: camera_ids, stop_ids - начальные подписки через запятую
+    Команды клиента (JSON):
+        {"action": "subscribe" | "unsubscribe", "camera_ids": [...], "stop_ids": [...]}
+    Сервер отправляет:
+        {"type": "detections", "camera_id", ...} - детекции кадра камеры
+        {"type": "stop_detections", "stop_id", ...} - результаты зоны остановки
+        бинарный кадр с тегом камеры (как в /cameras/stream-ws), если воркеры публикуют кадры
+    """
+    await websocket.accept()
+    
+    queue = new_queue()
+    channels = {}  # канал -> ("camera", camera_id) или ("stop", stop_id)
+    
+    async def send_subscriptions():
         await websocket.send_json({
-            "status": "connected",
-            "camera_name": camera["name"],
-            "detection_enabled": with_detection
+            "type": "subscriptions",
+            "camera_ids": sorted(key for kind, key in channels.values() if kind == "camera"),
+            "stop_ids": sorted(key for kind, key in channels.values() if kind == "stop")
         })
+    
+    async def update(action: str, camera_ids, stop_ids):
+        targets = []
+        for camera_id in camera_ids:
+            if camera_id not in IS74_CAMERAS:
+                await websocket.send_json({"type": "error", "camera_id": camera_id, "error": "Камера не найдена"})
+                continue
+            targets.append((camera_channel(camera_id), ("camera", camera_id)))
+        for stop_id in stop_ids:
+            try:
+                stop_id = int(stop_id)
+            except (TypeError, ValueError):
+                await websocket.send_json({"type": "error", "error": f"Некорректный ID остановки: {stop_id}"})
+                continue
+            targets.append((stop_channel(stop_id), ("stop", stop_id)))
         
-        frame_count = 0
-        last_processing_time = asyncio.get_event_loop().time()
-        
-        # Определяем целевой FPS в зависимости от режима
-        if fps_mode == "active":
-            target_fps = 8  # 8 кадров в секунду для активного просмотра (fullscreen)
-        else:
-            target_fps = 1  # 1 кадр в секунду для пассивного режима
-        
-        frame_interval = 1.0 / target_fps
-        
-        # Получаем FPS потока для правильной синхронизации
-        stream_fps = cap.get(cv2.CAP_PROP_FPS) or 25
-        frames_to_skip = max(1, int(stream_fps / target_fps))  # Сколько кадров пропускать
-        
+        for channel, target in targets:
+            if action == "subscribe" and channel not in channels:
+                channels[channel] = target
+                await event_relay.subscribe(channel, queue)
+            elif action == "unsubscribe" and channel in channels:
+                del channels[channel]
+                await event_relay.unsubscribe(channel, queue)
+    
+    async def receive_commands():
         while True:
-            ret, frame = cap.read()
-            
-            if not ret:
-                await websocket.send_json({"error": "Ошибка чтения кадра"})
-                break
-            
-            frame_count += 1
-            current_time = asyncio.get_event_loop().time()
-            
-            # Пропускаем кадры для достижения 2 FPS
-            if frame_count % frames_to_skip != 0:
-                continue
-            
-            # Контроль времени для точной синхронизации
-            time_since_last = current_time - last_processing_time
-            if time_since_last < frame_interval:
+            message = await websocket.receive_json()
+            action = message.get("action")
+            if action not in ("subscribe", "unsubscribe"):
+                await websocket.send_json({"type": "error", "error": f"Неизвестная команда: {action}"})
                 continue
-            
-            last_processing_time = current_time
-            
-            if with_detection:
-                # Детекция объектов
-                detections = cv_service.detect_objects(frame)
-                # Используем сглаженные значения для стабильности
-                smoothed_counts = cv_service.get_smoothed_counts()
-                result_frame = cv_service.draw_detections(frame, detections)
-                display_counts = smoothed_counts
-            else:
-                result_frame = frame
-                display_counts = {"people": 0, "buses": 0}
-            
-            # Кодируем кадр (используем качество 90 для лучшей детализации)
-            _, encoded = cv2.imencode('.jpg', result_frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
-            
-            # Отправляем кадр
-            await websocket.send_bytes(encoded.tobytes())
-            
-            # Отправляем метаданные если включена детекция (со сглаженными значениями)
-            if with_detection:
-                await asyncio.sleep(0.001)
-                await websocket.send_json({
-                    "people_count": display_counts['people'],
-                    "buses_count": display_counts['buses'],
-                    "frame_number": frame_count,
-                    "raw_people": len(detections['people']),  # Сырые значения для отладки
-                    "raw_buses": len(detections['buses'])
-                })
-            
-            # Небольшая задержка для стабильности (уже контролируется через frame_interval)
-            await asyncio.sleep(0.01)
-            
+            await update(action, message.get("camera_ids") or [], message.get("stop_ids") or [])
+            await send_subscriptions()
+    
+    async def send_events():
+        while True:
+            message = await queue.get()
+            # Событие могло прийти до отписки - не отправляем лишнего
+            if message.get("type") == "detections":
+                if camera_channel(message.get("camera_id")) not in channels:
+                    continue
+                # Сообщение общее для всех клиентов процесса - не изменяем его
+                jpeg = message.get("jpeg")
+                await websocket.send_json({k: v for k, v in message.items() if k != "jpeg"})
+                if jpeg:
+                    await websocket.send_bytes(encode_tagged_frame(message["camera_id"], base64.b64decode(jpeg)))
+            elif message.get("type") == "stop_detections":
+                if stop_channel(message.get("stop_id")) not in channels:
+                    continue
+                await websocket.send_json(message)
+    
+    query_params = websocket.query_params
+    tasks = []
+    try:
+        await update(
+            "subscribe",
+            [c for c in query_params.get('camera_ids', '').split(',') if c],
+            [s for s in query_params.get('stop_ids', '').split(',') if s]
+        )
+        await send_subscriptions()
+        
+        tasks = [asyncio.create_task(receive_commands()), asyncio.create_task(send_events())]
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
     except WebSocketDisconnect:
         pass
     except Exception as e:
-        print(f"Ошибка обработки потока камеры {camera_id}: {e}")
-        try:
-            await websocket.send_json({"error": str(e)})
-        except:
-            pass
+        print(f"Ошибка потока результатов детекции: {e}")
     finally:
-        if 'cap' in locals() and cap is not None:
-            cap.release()
+        for task in tasks:
+            task.cancel()
+        for channel in list(channels.keys()):
+            await event_relay.unsubscribe(channel, queue)
         try:
             await websocket.close()
         except:
             pass
 
 
+@router.get("/camera/{camera_id}/hls")
+async def get_camera_hls(camera_id: str):
+    """
+    HLS поток камеры с аннотациями детекции
+    Сегменты пишутся один раз на камеру и раздаются nginx как статические файлы
+    """
+    if camera_id not in IS74_CAMERAS:
+        raise HTTPException(status_code=404, detail="Камера не найдена")
+    if not hls_service.available:
+        raise HTTPException(status_code=503, detail="HLS отключен или ffmpeg недоступен")
+    
+    # Запускаем запись по первому запросу
+    hls_service.start(camera_id)
+    
+    return {
+        "camera_id": camera_id,
+        "camera_name": IS74_CAMERAS[camera_id]["name"],
+        "playlist_url": hls_service.playlist_url(camera_id),
+        "running": hls_service.is_running(camera_id)
+    }
+
+
+@router.delete("/camera/{camera_id}/hls")
+async def stop_camera_hls(camera_id: str):
+    """Остановка HLS записи камеры"""
+    if camera_id not in IS74_CAMERAS:
+        raise HTTPException(status_code=404, detail="Камера не найдена")
+    hls_service.stop(camera_id)
+    return {"camera_id": camera_id, "running": False}
+
+
 @router.get("/camera/{camera_id}/snapshot")
 async def get_camera_snapshot(camera_id: str, with_detection: bool = False):
     """
@@ -389,284 +822,196 @@ async def get_camera_snapshot(camera_id: str, with_detection: bool = False):
     if camera_id not in IS74_CAMERAS:
         raise HTTPException(status_code=404, detail="Камера не найдена")
     
-    camera = IS74_CAMERAS[camera_id]
+    try:
+        image = (await snapshot_cache.get_frame(camera_id))["image"]
+    except SnapshotError as e:
+        raise HTTPException(status_code=500, detail=str(e))
     
     try:
-        # Получаем снимок через API (пробуем разные варианты URL)
-        snapshot_urls = [
-            f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}&lossy=1",
-            f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}",
-            f"https://cdn.cams.is74.ru/snapshot/{camera['uuid']}",
-        ]
-        
-        import httpx
-        frame = None
-        last_error = None
-        
-        async with httpx.AsyncClient() as client:
-            for snapshot_url in snapshot_urls:
-                try:
-                    response = await client.get(snapshot_url, timeout=10.0, follow_redirects=True)
-                    if response.status_code == 200:
-                        # Декодируем изображение
-                        nparr = np.frombuffer(response.content, np.uint8)
-                        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                        if frame is not None:
-                            break
-                except Exception as e:
-                    last_error = str(e)
-                    continue
-            
-            if frame is None:
-                raise HTTPException(
-                    status_code=500, 
-                    detail=f"Не удалось получить снимок с камеры {camera_id}. Попробованы все варианты URL. Последняя ошибка: {last_error}"
+        detections = None
+        duplicate = False
+        source = None
+        # Снимок без детекций отдается исходным JPEG камеры
+        img_bytes = image.data
+        if with_detection:
+            # Детекции воркеров мониторинга; без них - локальная детекция, тот же снимок
+            # при повторном опросе не детектируется заново. Отрисовка - на кадре,
+            # декодированном для детекции (как в /detect-with-visualization)
+            frame = image.frame
+            
+            def detect_local():
+                nonlocal duplicate
+                result, duplicate = frame_dedup.get_or_compute(
+                    ("snapshot", camera_id), frame, lambda: cv_service.detect_decoded(image), exact=True
                 )
+                return result
             
-            detections = None
-            if with_detection:
-                # Обрабатываем с детекцией
-                detections = cv_service.detect_objects(frame)
+            detections, source = await asyncio.to_thread(camera_detections, camera_id, frame, detect_local)
+            if detections is not None:
                 result_frame = cv_service.draw_detections(frame, detections)
-            else:
-                result_frame = frame
-            
-            # Кодируем результат
-            _, encoded_img = cv2.imencode('.jpg', result_frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
-            img_bytes = encoded_img.tobytes()
-            
-            # Заголовки без кириллицы (избегаем проблем с кодировкой)
-            headers = {}
-            if with_detection and detections:
-                headers["X-People-Count"] = str(len(detections.get('people', [])))
-                headers["X-Buses-Count"] = str(len(detections.get('buses', [])))
-            
-            return StreamingResponse(
-                BytesIO(img_bytes),
-                media_type="image/jpeg",
-                headers=headers
-            )
+                _, encoded_img = cv2.imencode('.jpg', result_frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+                img_bytes = encoded_img.tobytes()
+        
+        # Заголовки без кириллицы (избегаем проблем с кодировкой)
+        headers = {}
+        if with_detection and detections:
+            headers["X-People-Count"] = str(len(detections.get('people', [])))
+            headers["X-Buses-Count"] = str(len(detections.get('buses', [])))
+            headers["X-Duplicate-Frame"] = "1" if duplicate else "0"
+            headers["X-Detection-Source"] = source
+        
+        return StreamingResponse(
+            BytesIO(img_bytes),
+            media_type="image/jpeg",
+            headers=headers
+        )
             
-    except HTTPException:
-        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка получения снимка: {str(e)}")
 
-@router.get("/stop/{stop_id}/zone-snapshot-meta")
-async def get_stop_zone_snapshot_meta(stop_id: int, with_detection: bool = True):
-    '''
-    Возвращает ссылку на изображение + people_count и buses_count (единый JSON для фронта)
-    '''
+
+def _get_zone_stop(stop_id: int):
+    """
+    Загрузка остановки для снимков зоны с проверкой настроек
+    
+    Returns:
+        (camera_id, stop_zone_coords)
+    """
     from core.models import Stop
     from core.database import SessionLocal
     db = SessionLocal()
-    stop = db.query(Stop).filter(Stop.id == stop_id).first()
-    if not stop:
-        db.close()
-        raise HTTPException(status_code=404, detail="Остановка не найдена")
-    if not stop.camera_id or stop.camera_id not in IS74_CAMERAS:
-        db.close()
-        raise HTTPException(status_code=404, detail="Камера не найдена")
-    if not stop.stop_zone_coords:
-        db.close()
-        raise HTTPException(status_code=404, detail="Не задана зона остановки")
-    camera = IS74_CAMERAS[stop.camera_id]
     try:
-        import httpx
-        import time
-        snapshot_urls = [
-            f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}&lossy=1",
-            f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}",
-            f"https://cdn.cams.is74.ru/snapshot/{camera['uuid']}",
-        ]
-        frame = None
-        last_error = None
-        with httpx.Client(timeout=10.0) as client:
-            for snapshot_url in snapshot_urls:
-                try:
-                    response = client.get(snapshot_url, follow_redirects=True)
-                    if response.status_code == 200:
-                        nparr = np.frombuffer(response.content, np.uint8)
-                        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                        if frame is not None:
-                            break
-                except Exception:
-                    continue
-        if frame is None:
-            db.close()
-            raise HTTPException(status_code=500, detail=f"Не удалось получить снимок с камеры {stop.camera_id}")
-        # Получаем ROI зоны
-        coords = stop.stop_zone_coords
-        if not coords or len(coords) < 2:
-            h, w = frame.shape[:2]
-            x1, y1, x2, y2 = 0, 0, w, h
-        else:
-            x_coords = [c[0] for c in coords]
-            y_coords = [c[1] for c in coords]
-            x1, y1 = int(min(x_coords)), int(min(y_coords))
-            x2, y2 = int(max(x_coords)), int(max(y_coords))
-        zone_frame = frame[y1:y2, x1:x2]
-        detections = cv_service.detect_objects(zone_frame) if with_detection else None
-        people_count = len(detections.get('people', [])) if detections else 0
-        buses_count = len(detections.get('buses', [])) if detections else 0
-        # URL для изображения делаем с уникальным nocache=секунды, чтобы избежать кеша браузера
-        url = f"/api/v1/cv/stop/{stop_id}/zone-snapshot?with_detection=true&nocache={int(time.time())}"
-        db.close()
-        return {
-            "zone_img_url": url,
-            "people_count": people_count,
-            "buses_count": buses_count
-        }
-    except Exception as e:
+        stop = db.query(Stop).filter(Stop.id == stop_id).first()
+        if not stop:
+            raise HTTPException(status_code=404, detail="Остановка не найдена")
+        if not stop.camera_id or stop.camera_id not in IS74_CAMERAS:
+            raise HTTPException(status_code=404, detail="Камера не найдена")
+        if not stop.stop_zone_coords:
+            raise HTTPException(status_code=404, detail="Не задана зона остановки")
+        return stop.camera_id, stop.stop_zone_coords
+    finally:
         db.close()
-        raise HTTPException(status_code=500, detail=f"Ошибка snapshot-meta: {str(e)}")
 
-@router.get("/stop/{stop_id}/zone-snapshot")
-async def get_stop_zone_snapshot(stop_id: int, with_detection: bool = True):
+
+def _zone_cache_headers(record: dict) -> dict:
+    """ETag и Last-Modified для снимка зоны из хранилища"""
+    captured_at = datetime.fromisoformat(record["captured_at"]).astimezone(timezone.utc)
+    return {
+        "ETag": f'"{record["snapshot_id"]}"',
+        "Last-Modified": format_datetime(captured_at, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+
+
+def _is_not_modified(request: Request, record: dict) -> bool:
+    """Проверка условного запроса (If-None-Match / If-Modified-Since)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return record["snapshot_id"] in [tag.strip().removeprefix('W/').strip('"') for tag in if_none_match.split(",")]
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+            captured_at = datetime.fromisoformat(record["captured_at"]).astimezone(timezone.utc)
+            return captured_at.replace(microsecond=0) <= since
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+@router.get("/stop/{stop_id}/zone-snapshot-meta")
+async def get_stop_zone_snapshot_meta(request: Request, stop_id: int, with_detection: bool = True):
     '''
-    Возвращает изображение только зоны остановки, пропущенной через детекцию
+    Возвращает ссылку на изображение + people_count и buses_count (единый JSON для фронта)
+    Ссылка содержит snapshot_id - по ней отдается именно то изображение, на котором посчитаны люди
+    Если мониторинг недавно опубликовал снимок зоны, он отдается без детекции (с ETag)
     '''
-    from core.models import Stop
-    from core.database import SessionLocal
-    db = SessionLocal()
-    stop = db.query(Stop).filter(Stop.id == stop_id).first()
-    if not stop:
-        db.close()
-        raise HTTPException(status_code=404, detail="Остановка не найдена")
-    if not stop.camera_id or stop.camera_id not in IS74_CAMERAS:
-        db.close()
-        raise HTTPException(status_code=404, detail="Камера не найдена")
-    if not stop.stop_zone_coords:
-        db.close()
-        raise HTTPException(status_code=404, detail="Не задана зона остановки")
-    camera = IS74_CAMERAS[stop.camera_id]
-    try:
-        import httpx
-        snapshot_urls = [
-            f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}&lossy=1",
-            f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}",
-            f"https://cdn.cams.is74.ru/snapshot/{camera['uuid']}",
-        ]
-        frame = None
-        last_error = None
-        with httpx.Client(timeout=10.0) as client:
-            for snapshot_url in snapshot_urls:
-                try:
-                    response = client.get(snapshot_url, follow_redirects=True)
-                    if response.status_code == 200:
-                        nparr = np.frombuffer(response.content, np.uint8)
-                        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                        if frame is not None:
-                            break
-                except Exception:
-                    continue
-        if frame is None:
-            db.close()
-            raise HTTPException(status_code=500, detail=f"Не удалось получить снимок с камеры {stop.camera_id}")
-        # Получаем ROI зоны
-        coords = stop.stop_zone_coords
-        if not coords or len(coords) < 2:
-            h, w = frame.shape[:2]
-            x1, y1, x2, y2 = 0, 0, w, h
-        else:
-            x_coords = [c[0] for c in coords]
-            y_coords = [c[1] for c in coords]
-            x1, y1 = int(min(x_coords)), int(min(y_coords))
-            x2, y2 = int(max(x_coords)), int(max(y_coords))
-        zone_frame = frame[y1:y2, x1:x2]
-        result_frame = zone_frame
-        detections = None
-        if with_detection:
-            detections = cv_service.detect_objects(zone_frame)
-            result_frame = cv_service.draw_detections(zone_frame, detections)
-        _, encoded_img = cv2.imencode('.jpg', result_frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
-        img_bytes = encoded_img.tobytes()
-        headers = {}
-        if with_detection and detections:
-            headers["X-People-Count"] = str(len(detections.get('people', [])))
-            headers["X-Buses-Count"] = str(len(detections.get('buses', [])))
-        db.close()
-        return StreamingResponse(
-            BytesIO(img_bytes),
-            media_type="image/jpeg",
+    camera_id, stop_zone_coords = _get_zone_stop(stop_id)
+    
+    record = await asyncio.to_thread(zone_store.get_fresh, stop_id) if with_detection else None
+    if record is not None:
+        headers = _zone_cache_headers(record)
+        if _is_not_modified(request, record):
+            return Response(status_code=304, headers=headers)
+        return JSONResponse(
+            content={
+                "zone_img_url": f"/api/v1/cv/stop/{stop_id}/zone-snapshot?with_detection=true&snapshot_id={record['snapshot_id']}",
+                "snapshot_id": record["snapshot_id"],
+                "captured_at": record["captured_at"],
+                "people_count": record["people_count"],
+                "buses_count": record["buses_count"]
+            },
             headers=headers
         )
-    except HTTPException:
-        db.close()
-        raise
+    
+    try:
+        zone = await snapshot_cache.get_zone(camera_id, stop_zone_coords, with_detection)
+    except SnapshotError:
+        raise HTTPException(status_code=500, detail=f"Не удалось получить снимок с камеры {camera_id}")
     except Exception as e:
-        db.close()
-        raise HTTPException(status_code=500, detail=f"Ошибка получения снимка зоны: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка snapshot-meta: {str(e)}")
+    url = (
+        f"/api/v1/cv/stop/{stop_id}/zone-snapshot"
+        f"?with_detection={str(with_detection).lower()}&snapshot_id={zone['snapshot_id']}"
+    )
+    return {
+        "zone_img_url": url,
+        "snapshot_id": zone["snapshot_id"],
+        "captured_at": zone["captured_at"].isoformat(),
+        "people_count": zone["people_count"],
+        "buses_count": zone["buses_count"]
+    }
 
-    """
-    Получение снимка с камеры
+@router.get("/stop/{stop_id}/zone-snapshot")
+async def get_stop_zone_snapshot(request: Request, stop_id: int, with_detection: bool = True,
+                                 snapshot_id: Optional[str] = None):
+    '''
+    Возвращает изображение только зоны остановки, пропущенной через детекцию
     
     Args:
-        camera_id: ID камеры
-        with_detection: Включить детекцию объектов
-    """
-    if camera_id not in IS74_CAMERAS:
-        raise HTTPException(status_code=404, detail="Камера не найдена")
-    
-    camera = IS74_CAMERAS[camera_id]
+        snapshot_id: ID изображения из zone-snapshot-meta; возвращается именно оно,
+                     если оно уже недоступно - 404 (клиент запрашивает meta заново).
+                     Без snapshot_id возвращается последний снимок
+    '''
+    # Снимок, опубликованный мониторингом (текущий или предыдущий по ID)
+    if with_detection:
+        if snapshot_id:
+            record = await asyncio.to_thread(zone_store.get_by_id, stop_id, snapshot_id)
+        else:
+            record = await asyncio.to_thread(zone_store.get_fresh, stop_id)
+        if record is not None:
+            headers = _zone_cache_headers(record)
+            if _is_not_modified(request, record):
+                return Response(status_code=304, headers=headers)
+            if snapshot_id:
+                headers["Cache-Control"] = "private, max-age=300, immutable"
+            headers["X-Snapshot-Id"] = record["snapshot_id"]
+            headers["X-People-Count"] = str(record["people_count"])
+            headers["X-Buses-Count"] = str(record["buses_count"])
+            return Response(content=record["jpeg"], media_type="image/jpeg", headers=headers)
     
-    try:
-        # Получаем снимок через API (пробуем разные варианты URL)
-        snapshot_urls = [
-            f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}&lossy=1",
-            f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}",
-            f"https://cdn.cams.is74.ru/snapshot/{camera['uuid']}",
-        ]
-        
-        import httpx
-        frame = None
-        last_error = None
-        
-        async with httpx.AsyncClient() as client:
-            for snapshot_url in snapshot_urls:
-                try:
-                    response = await client.get(snapshot_url, timeout=10.0, follow_redirects=True)
-                    if response.status_code == 200:
-                        # Декодируем изображение
-                        nparr = np.frombuffer(response.content, np.uint8)
-                        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                        if frame is not None:
-                            break
-                except Exception as e:
-                    last_error = str(e)
-                    continue
-            
-            if frame is None:
-                raise HTTPException(
-                    status_code=500, 
-                    detail=f"Не удалось получить снимок с камеры {camera_id}. Попробованы все варианты URL. Последняя ошибка: {last_error}"
-                )
-            
-            detections = None
-            if with_detection:
-                # Обрабатываем с детекцией
-                detections = cv_service.detect_objects(frame)
-                result_frame = cv_service.draw_detections(frame, detections)
-            else:
-                result_frame = frame
-            
-            # Кодируем результат
-            _, encoded_img = cv2.imencode('.jpg', result_frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
-            img_bytes = encoded_img.tobytes()
-            
-            # Заголовки без кириллицы (избегаем проблем с кодировкой)
-            headers = {}
-            if with_detection and detections:
-                headers["X-People-Count"] = str(len(detections.get('people', [])))
-                headers["X-Buses-Count"] = str(len(detections.get('buses', [])))
-            
-            return StreamingResponse(
-                BytesIO(img_bytes),
-                media_type="image/jpeg",
-                headers=headers
-            )
-            
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ошибка получения снимка: {str(e)}")
+    camera_id, stop_zone_coords = _get_zone_stop(stop_id)
+    # ID другой остановки (другая камера или зона) не подходит
+    zone = snapshot_cache.get_by_id(snapshot_id, camera_id, stop_zone_coords, with_detection) if snapshot_id else None
+    if zone is not None:
+        # Изображение с фиксированным ID не меняется
+        cache_control = "private, max-age=300, immutable"
+    elif snapshot_id:
+        # Под чужим ID нельзя отдавать другой снимок с другими счетчиками
+        raise HTTPException(status_code=404, detail=f"Снимок {snapshot_id} недоступен, запросите zone-snapshot-meta заново")
+    else:
+        try:
+            zone = await snapshot_cache.get_zone(camera_id, stop_zone_coords, with_detection)
+        except SnapshotError:
+            raise HTTPException(status_code=500, detail=f"Не удалось получить снимок с камеры {camera_id}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Ошибка получения снимка зоны: {str(e)}")
+        cache_control = "no-cache"
+    headers = {
+        "X-Snapshot-Id": zone["snapshot_id"],
+        "Cache-Control": cache_control,
+    }
+    if with_detection and zone["people_count"] is not None:
+        headers["X-People-Count"] = str(zone["people_count"])
+        headers["X-Buses-Count"] = str(zone["buses_count"])
+    return Response(content=zone["jpeg"], media_type="image/jpeg", headers=headers)
@@ -1,79 +1,217 @@
 """
 API для пассажиров
 """
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import datetime, timedelta
-from sqlalchemy import func, and_
+import asyncio
+import hashlib
+import json
 
-from core.database import get_db
+from core.database import get_db, SessionLocal
 from core import schemas
-from core.models import Stop, LoadData, BusDetection
+from core.models import Stop
 from services.forecast_service import forecast_service
+from services.stop_state import stop_state, updated_at, recent_buses
+from services.event_bus import event_relay, STOP_LOAD_CHANNEL
 
 router = APIRouter()
 
 
+# Данные старше этого считаются устаревшими (остановка пуста)
+CURRENT_LOAD_MAX_AGE = timedelta(minutes=10)
+# Окно недавно обнаруженных автобусов
+RECENT_BUSES_WINDOW = timedelta(minutes=30)
+# Интервал keepalive комментариев в потоке SSE, секунды
+SSE_KEEPALIVE_SECONDS = 15.0
+
+
+def _load_status(people_count: int) -> str:
+    """Определение статуса загруженности"""
+    if people_count == 0:
+        return "free"
+    elif people_count < 10:
+        return "medium"
+    return "crowded"
+
+
+def _is_fresh_state(state: Optional[dict]) -> bool:
+    return state is not None and updated_at(state) >= datetime.now() - CURRENT_LOAD_MAX_AGE
+
+
+def _build_current_load(stop_id: int, stop_name: str, state: Optional[dict]) -> schemas.CurrentLoadResponse:
+    """Ответ о текущей загруженности по состоянию остановки"""
+    if not _is_fresh_state(state):
+        # Если нет свежих данных, возвращаем пустое значение
+        return schemas.CurrentLoadResponse(
+            stop_id=stop_id,
+            stop_name=stop_name,
+            people_count=0,
+            smoothed_count=0,
+            buses_detected=0,
+            load_status=_load_status(0),
+            updated_at=datetime.now(),
+            recent_buses=recent_buses(state, RECENT_BUSES_WINDOW) if state else []
+        )
+    
+    return schemas.CurrentLoadResponse(
+        stop_id=stop_id,
+        stop_name=stop_name,
+        people_count=state["people_count"],
+        smoothed_count=state.get("smoothed_count", state["people_count"]),
+        buses_detected=state["buses_detected"],
+        load_status=_load_status(state["people_count"]),
+        updated_at=updated_at(state),
+        recent_buses=recent_buses(state, RECENT_BUSES_WINDOW)
+    )
+
+
+def _parse_stop_ids(stop_ids: Optional[str]) -> Optional[List[int]]:
+    """Список ID остановок из строки "1,2,3" """
+    if not stop_ids:
+        return None
+    try:
+        return sorted({int(item) for item in stop_ids.split(",") if item.strip()})
+    except ValueError:
+        raise HTTPException(status_code=400, detail="stop_ids должен быть списком чисел через запятую")
+
+
+def _query_stops(db: Session, ids: Optional[List[int]]) -> list:
+    """(id, name) остановок из списка или всех активных"""
+    query = db.query(Stop.id, Stop.name)
+    if ids is None:
+        query = query.filter(Stop.is_active == True)
+    else:
+        query = query.filter(Stop.id.in_(ids))
+    return query.order_by(Stop.id).all()
+
+
+def _current_load_etag(stops: list, states: dict) -> str:
+    """
+    ETag пакета загруженности по состояниям из Redis, до построения ответа
+    Версия состояния - его updated_at; свежесть и число автобусов в окне меняются
+    со временем без нового состояния, поэтому тоже входят в хэш
+    """
+    payload = []
+    for stop_id, stop_name in stops:
+        state = states.get(stop_id)
+        payload.append([
+            stop_id,
+            stop_name,
+            state["updated_at"] if state else None,
+            _is_fresh_state(state),
+            len(recent_buses(state, RECENT_BUSES_WINDOW)) if state else 0,
+        ])
+    return hashlib.sha1(json.dumps(payload).encode()).hexdigest()[:16]
+
+
+@router.get("/current-load", response_model=schemas.CurrentLoadBatchResponse)
+async def get_current_load_batch(
+    request: Request,
+    response: Response,
+    stop_ids: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Текущая загруженность нескольких остановок одним запросом
+    stop_ids - ID через запятую; без параметра - все активные остановки.
+    Один запрос к БД за списком остановок, состояния - из Redis (одним MGET;
+    остановки без данных помечаются в Redis и не запрашиваются из БД при каждом опросе).
+    Поддерживается If-None-Match: ETag считается по версиям состояний, при совпадении
+    ответ 304 без построения тела
+    """
+    stops = _query_stops(db, _parse_stop_ids(stop_ids))
+    states = stop_state.get_or_load(db, [stop_id for stop_id, _ in stops])
+    
+    etag = _current_load_etag(stops, states)
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip().removeprefix('W/').strip('"') for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    
+    items = [_build_current_load(stop_id, stop_name, states.get(stop_id)) for stop_id, stop_name in stops]
+    response.headers.update(headers)
+    return schemas.CurrentLoadBatchResponse(stops=items)
+
+
+def _sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+
+@router.get("/current-load/stream")
+async def stream_current_load(request: Request, stop_ids: Optional[str] = None):
+    """
+    Push обновлений загруженности (Server-Sent Events)
+    Первое событие snapshot - текущее состояние остановок, далее события load
+    после каждой записи результатов мониторинга. События приходят через Redis pub/sub,
+    поэтому доходят до клиента любого процесса API
+    """
+    ids = _parse_stop_ids(stop_ids)
+    
+    async def events():
+        # Подписка до чтения состояния - обновление между ними не теряется
+        queue = await event_relay.subscribe(STOP_LOAD_CHANNEL)
+        try:
+            # Сессия БД только на время начального состояния, не на все соединение
+            db = SessionLocal()
+            try:
+                stops = _query_stops(db, ids)
+                states = stop_state.get_or_load(db, [stop_id for stop_id, _ in stops])
+            finally:
+                db.close()
+            stop_names = {stop_id: stop_name for stop_id, stop_name in stops}
+            
+            snapshot = [_build_current_load(stop_id, stop_name, states.get(stop_id)) for stop_id, stop_name in stops]
+            yield "retry: 5000\n\n" + _sse_event("snapshot", {"stops": snapshot})
+            
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                
+                items = [
+                    _build_current_load(state["stop_id"], state.get("stop_name") or stop_names.get(state["stop_id"], ""), state)
+                    for state in message.get("states", [])
+                    if ids is None or state["stop_id"] in stop_names
+                ]
+                if items:
+                    yield _sse_event("load", {"stops": items})
+        finally:
+            await event_relay.unsubscribe(STOP_LOAD_CHANNEL, queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.get("/current-load/{stop_id}", response_model=schemas.CurrentLoadResponse)
 async def get_current_load(
     stop_id: int,
     db: Session = Depends(get_db)
 ):
-    """Получение текущей загруженности остановки"""
+    """
+    Получение текущей загруженности остановки
+    Состояние читается из Redis, БД используется только при его отсутствии
+    (остановка без данных отмечается в Redis и не перезагружается из БД при каждом опросе)
+    """
+    state = stop_state.get_or_load(db, [stop_id]).get(stop_id)
+    if state is not None and state.get("stop_name"):
+        return _build_current_load(stop_id, state["stop_name"], state)
+    
     stop = db.query(Stop).filter(Stop.id == stop_id).first()
     if not stop:
         raise HTTPException(status_code=404, detail="Остановка не найдена")
     
-    # Получение последних данных о загруженности
-    latest_data = db.query(LoadData).filter(
-        and_(
-            LoadData.stop_id == stop_id,
-            LoadData.timestamp >= datetime.now() - timedelta(minutes=10)
-        )
-    ).order_by(LoadData.timestamp.desc()).first()
-    
-    if not latest_data:
-        # Если нет данных, возвращаем пустое значение
-        people_count = 0
-        buses_detected = 0
-    else:
-        people_count = latest_data.people_count
-        buses_detected = latest_data.buses_detected
-    
-    # Определение статуса загруженности
-    if people_count == 0:
-        load_status = "free"
-    elif people_count < 10:
-        load_status = "medium"
-    else:
-        load_status = "crowded"
-    
-    # Получение информации о недавно обнаруженных автобусах
-    recent_buses = db.query(BusDetection).filter(
-        and_(
-            BusDetection.stop_id == stop_id,
-            BusDetection.detected_at >= datetime.now() - timedelta(minutes=30)
-        )
-    ).order_by(BusDetection.detected_at.desc()).limit(5).all()
-    
-    recent_buses_list = []
-    for bus_det in recent_buses:
-        recent_buses_list.append({
-            'bus_number': bus_det.bus_number,
-            'detected_at': bus_det.detected_at.isoformat(),
-            'confidence': bus_det.confidence
-        })
-    
-    return schemas.CurrentLoadResponse(
-        stop_id=stop_id,
-        stop_name=stop.name,
-        people_count=people_count,
-        buses_detected=buses_detected,
-        load_status=load_status,
-        updated_at=latest_data.timestamp if latest_data else datetime.now(),
-        recent_buses=recent_buses_list
-    )
+    return _build_current_load(stop_id, stop.name, state)
 
 
 @router.get("/forecast/{stop_id}", response_model=List[schemas.ForecastResponse])
@@ -0,0 +1,38 @@
+"""
+Подключение к Redis (общие данные между API и воркерами Celery)
+"""
+import redis
+
+from core.config import settings
+
+_client = None
+
+
+def get_redis() -> redis.Redis:
+    """Общий клиент Redis процесса (пул соединений создается при первом обращении)"""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(
+            settings.REDIS_URL,
+            socket_timeout=2.0,
+            socket_connect_timeout=2.0,
+            health_check_interval=30,
+        )
+    return _client
+
+
+_async_client = None
+
+
+def get_async_redis():
+    """Асинхронный клиент Redis для цикла событий API (подписки pub/sub)"""
+    global _async_client
+    if _async_client is None:
+        import redis.asyncio as aioredis
+
+        _async_client = aioredis.Redis.from_url(
+            settings.REDIS_URL,
+            socket_connect_timeout=2.0,
+            health_check_interval=30,
+        )
+    return _async_client
@@ -49,3 +49,30 @@ IS74_CAMERAS = {
 }
 
 
+def get_stream_urls(camera: dict) -> list:
+    """
+    Список URL видеопотока камеры в порядке приоритета
+    Сначала HD качество, затем main, HLS как последняя попытка
+    """
+    urls = [
+        # RTSP варианты
+        f"rtsp://cdn.cams.is74.ru:8554/stream?uuid={camera['uuid']}&quality=hd",
+        f"rtsp://cdn.cams.is74.ru:8554/stream?uuid={camera['uuid']}&quality=main",
+        f"rtsp://cdn.cams.is74.ru:8554?uuid={camera['uuid']}&quality=hd",
+        f"rtsp://cdn.cams.is74.ru:8554?uuid={camera['uuid']}&quality=main",
+        f"rtsp://cdn.cams.is74.ru:8554/{camera['uuid']}?quality=hd",
+        camera["rtsp"],
+        camera.get("rtsp_main"),
+        # HLS как последняя попытка (требует специальной обработки)
+        camera.get("hls"),
+    ]
+    return [url for url in urls if url]
+
+
+def get_snapshot_urls(camera: dict) -> list:
+    """Варианты URL снимка камеры в порядке приоритета"""
+    return [
+        f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}&lossy=1",
+        f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}",
+        f"https://cdn.cams.is74.ru/snapshot/{camera['uuid']}",
+    ]
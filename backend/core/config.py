@@ -2,7 +2,7 @@
 Конфигурация приложения
 """
 from pydantic_settings import BaseSettings
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 
 class Settings(BaseSettings):
@@ -29,8 +29,97 @@ class Settings(BaseSettings):
     CONFIDENCE_THRESHOLD: float = 0.1
     
     # Video Processing
-    FRAME_SKIP: int = 5  # Обрабатывать каждый 5-й кадр
-    MAX_FRAMES_PER_SECOND: int = 2
+    FRAME_SKIP: int = 5  # Устарело и не используется: кадры отбираются по времени (MAX_FRAMES_PER_SECOND)
+    MAX_FRAMES_PER_SECOND: int = 2  # Частота анализа по часам потока (FrameSampler), не зависит от FPS камеры
+    DETECTION_BATCH_SIZE: int = 8  # Максимум кадров в одном прогоне YOLO
+    PIPELINE_QUEUE_SIZE: int = 4  # Очереди между стадиями конвейера видеопотока
+    PIPELINE_DROP_POLICY: str = "oldest"  # При отставании инференса: "oldest", "newest" или "block"
+    VIDEO_WS_WINDOW: int = 2  # Кадров клиента в обработке одновременно (WS /cv/process-video-stream)
+    BATCH_DETECT_MAX_IMAGES: int = 10000  # Изображений в одном запросе /cv/detect-batch
+    BATCH_DETECT_MAX_IMAGE_MB: int = 32  # Больший файл архива не распаковывается (ошибка изображения)
+    JPEG_REDUCED_DECODE: bool = True  # Декодировать JPEG уменьшенным в 2/4/8 раз, если длинная сторона не меньше входа модели
+    
+    # Подавление повторных кадров: детекция не выполняется, если кадр источника не изменился
+    FRAME_DEDUP_ENABLED: bool = True
+    FRAME_DEDUP_SIZE: int = 32  # Сторона уменьшенного серого отпечатка кадра, пиксели
+    FRAME_DEDUP_TOLERANCE: int = 4  # Допустимая разница ячейки отпечатка (0..255); снимки камер сравниваются точно
+    FRAME_DEDUP_MAX_AGE: float = 60.0  # Дольше результат повторного кадра не используется, секунды
+    
+    # Офлайн обработка видеофайлов (POST /cv/process-video)
+    VIDEO_JOB_WORKERS: int = 0  # Процессов в пуле (0 - по числу ядер); каждый загружает модели, если INFERENCE_URL не задан
+    VIDEO_JOB_FPS: float = 2.0  # Частота анализа по времени видео
+    VIDEO_JOB_SEGMENT_SECONDS: int = 60  # Длина отрезка, обрабатываемого одним процессом
+    VIDEO_JOB_DIR: str = "/tmp/video-jobs"  # Загруженные файлы и аннотированные результаты
+    VIDEO_JOB_TTL: int = 3600  # Время хранения результатов, секунды
+    
+    # Сервис инференса (модели загружаются один раз на хост)
+    INFERENCE_URL: Optional[str] = None  # "unix:///tmp/inference/inference.sock" или "http://inference:8001"; пусто - модели в процессе
+    INFERENCE_SHM: bool = True  # Передавать кадры через разделяемую память (клиент и сервис на одном хосте)
+    INFERENCE_TIMEOUT: float = 30.0  # Таймаут запроса к сервису, секунды
+    INFERENCE_BATCH_WAIT_MS: int = 10  # Ожидание попутных запросов для общего батча
+    FRAME_RING_SLOTS: int = 8  # Слотов кольцевого буфера кадров на поток при INFERENCE_SHM (0 - отключить)
+    INFERENCE_JPEG_QUALITY: int = 95  # Качество JPEG, если разделяемая память недоступна
+    
+    # Мониторинг остановок
+    MONITORING_MODE: str = "batch"  # "batch" - один цикл на все камеры, "tasks" - задача Celery на камеру
+    MONITORING_INTERVAL: float = 60.0  # Период мониторинга, секунды
+    LOAD_WRITER_MAX_BUFFER: int = 10000  # Максимум записей в буфере при недоступности БД
+    STOP_STATE_TTL: int = 86400  # Время хранения последнего состояния остановки в Redis, секунды
+    STOP_STATE_EMPTY_TTL: int = 60  # Метка остановки без данных в Redis (без повторных запросов к БД), секунды
+    STOP_STATE_SMOOTHING_WINDOW: int = 5  # Замеров для сглаженного (медианного) количества людей
+    
+    # Непрерывный мониторинг видеопотоков (задача process_video_stream, очередь streams)
+    STREAM_MONITOR_CAMERAS: List[str] = []  # Камеры под постоянным наблюдением (перезапуск по расписанию)
+    STREAM_MONITOR_MODE: str = "camera"  # "camera" - задача на камеру, "scheduler" - все камеры в одном процессе
+    STREAM_MONITOR_FPS: float = 1.0  # Частота анализа кадров потока
+    STREAM_CAMERA_FPS: Dict[str, float] = {}  # Частота для отдельных камер (режим scheduler)
+    STREAM_SCHEDULER_MAX_FRAME_AGE: float = 5.0  # Кадры старше не отправляются в модель, секунды
+    STREAM_MONITOR_BATCH: int = 2  # Кадров в одном прогоне модели
+    STREAM_MOTION_THRESHOLD: float = 0.01  # Доля изменившихся пикселей для запуска детекции
+    STREAM_MOTION_MAX_IDLE: float = 30.0  # Детекция не реже, даже без движения, секунды
+    STREAM_STATS_INTERVAL: float = 60.0  # Период записи агрегированной статистики, секунды
+    STREAM_CPU_BUDGET: float = 0.5  # Доля одного ядра на обработку потока камеры
+    STREAM_RECONNECT_DELAY: float = 5.0
+    STREAM_RECONNECT_MAX_DELAY: float = 120.0
+    STREAM_MONITOR_LEASE_TTL: int = 60  # Аренда камеры воркером в Redis, секунды
+    
+    # Шина результатов детекции (Redis pub/sub от воркеров к API)
+    DETECTION_BUS_MAX_AGE: float = 10.0  # Сколько последние детекции камеры используются обработчиками API, секунды
+    API_LOCAL_INFERENCE: bool = True  # Детекция в процессе API, если от воркеров нет свежих результатов (false - модели в API не загружаются)
+    DETECTION_BUS_FRAMES: bool = False  # Публиковать аннотированный JPEG вместе с детекциями
+    DETECTION_BUS_FRAME_WIDTH: int = 640
+    DETECTION_BUS_FRAME_QUALITY: int = 70
+    
+    # Snapshot камер
+    SNAPSHOT_TIMEOUT: float = 10.0  # Общий таймаут запроса снимка, секунды
+    SNAPSHOT_CONNECT_TIMEOUT: float = 3.0
+    SNAPSHOT_MAX_CONCURRENCY: int = 8  # Одновременных запросов снимков на процесс
+    SNAPSHOT_MAX_CONNECTIONS: int = 16  # Размер пула соединений
+    SNAPSHOT_HTTP2: bool = True  # Используется, если установлен пакет h2
+    SNAPSHOT_CACHE_TTL: float = 5.0  # Время жизни снимка и детекции зоны в кэше API, секунды
+    SNAPSHOT_CACHE_RECENT: int = 64  # Сколько последних изображений зон доступно по snapshot_id
+    
+    # Кадры для задач Celery (в задачу передается только ссылка)
+    FRAME_STORE_BACKEND: str = "redis"  # "redis" или "file" (воркеры на одном хосте с API, каталог на tmpfs)
+    FRAME_STORE_DIR: str = "/dev/shm/frame-blobs"
+    FRAME_STORE_TTL: int = 300  # Время хранения необработанного кадра, секунды
+    
+    # Готовые снимки зон остановок, публикуемые мониторингом
+    ZONE_STORE_BACKEND: str = "redis"  # "redis" или "file" (API и воркеры на одном хосте)
+    ZONE_STORE_DIR: str = "/var/zone-snapshots"
+    ZONE_STORE_TTL: int = 600  # Время хранения снимка, секунды
+    ZONE_STORE_MAX_AGE: int = 150  # Старше этого API считает снимок сам
+    
+    # HLS (аннотированное видео для большого числа зрителей)
+    HLS_ENABLED: bool = False
+    HLS_OUTPUT_DIR: str = "/var/hls"  # Каталог сегментов, раздается nginx
+    HLS_PUBLIC_PATH: str = "/hls"  # URL префикс каталога в nginx
+    HLS_CAMERAS: List[str] = []  # Камеры для постоянной записи (пусто - все)
+    HLS_FPS: int = 4
+    HLS_WIDTH: int = 1280
+    HLS_SEGMENT_SECONDS: int = 2
+    HLS_LIST_SIZE: int = 6
+    FFMPEG_PATH: str = "ffmpeg"
     
     # Yandex Maps API
     YANDEX_MAPS_API_KEY: Optional[str] = None
@@ -76,12 +76,17 @@ class CurrentLoadResponse(BaseModel):
     stop_id: int
     stop_name: str
     people_count: int
+    smoothed_count: Optional[int] = None  # Медиана последних замеров
     buses_detected: int
     load_status: str  # "free", "medium", "crowded"
     updated_at: datetime
     recent_buses: List[dict] = []  # Недавно обнаруженные автобусы
 
 
+class CurrentLoadBatchResponse(BaseModel):
+    stops: List[CurrentLoadResponse]
+
+
 class ForecastResponse(BaseModel):
     stop_id: int
     forecast_time: datetime
@@ -0,0 +1,150 @@
+"""
+Сервис инференса - единственный процесс хоста, загружающий YOLO и EasyOCR
+API и воркеры Celery обращаются к нему через services.inference_client
+(INFERENCE_URL). Одновременные запросы детекции объединяются в общие батчи.
+
+Запуск:
+    uvicorn inference_service:app --uds /tmp/inference/inference.sock
+    uvicorn inference_service:app --host 0.0.0.0 --port 8001
+"""
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+
+from core.config import settings
+from services.cv_service import cv_service, CVService
+from services.frame_transport import SharedFrameReader, FrameRefError
+
+if not isinstance(cv_service, CVService):
+    raise RuntimeError("Для сервиса инференса INFERENCE_URL не задается: модели загружаются в этом процессе")
+
+# Модели загружаются при старте, а не на первом запросе
+cv_service.load_models()
+
+
+class DetectRequest(BaseModel):
+    frames: List[Dict]  # Ссылки на кадры: {"shm", "offset", "shape"} или {"jpeg"}
+    imgsz: Optional[List[Optional[int]]] = None  # Размеры входа модели по кадрам (кадры, декодированные с уменьшением)
+
+
+class BusCrop(BaseModel):
+    frame: Dict
+    bbox: List[float]
+
+
+class RecognizeRequest(BaseModel):
+    crops: List[BusCrop]
+
+
+class DetectionBatcher:
+    """
+    Очередь кадров на детекцию с одним потоком модели
+    Поток забирает кадры, ждет попутные запросы до INFERENCE_BATCH_WAIT_MS
+    и запускает detect_objects_batch не более чем на DETECTION_BATCH_SIZE кадров
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="inference-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, frames: List, imgsz: Optional[List[Optional[int]]] = None) -> List[Future]:
+        futures = []
+        for index, frame in enumerate(frames):
+            future = Future()
+            self._queue.put((frame, imgsz[index] if imgsz else None, future))
+            futures.append(future)
+        return futures
+
+    def _collect(self) -> List:
+        items = [self._queue.get()]
+        wait = settings.INFERENCE_BATCH_WAIT_MS / 1000.0
+        batch_size = max(1, settings.DETECTION_BATCH_SIZE)
+        while len(items) < batch_size:
+            try:
+                items.append(self._queue.get(timeout=wait))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            try:
+                results = cv_service.detect_objects_batch(
+                    [frame for frame, _, _ in items], [size for _, size, _ in items]
+                )
+                for (_, _, future), detections in zip(items, results):
+                    future.set_result(detections)
+            except Exception as e:
+                print(f"[INFERENCE] Ошибка детекции батча из {len(items)} кадров: {e}")
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+def serialize_detections(detections: Dict) -> Dict:
+    return {
+        "people": detections["people"],
+        "buses": detections["buses"],
+        "timestamp": detections["timestamp"].isoformat(),
+        "frame_shape": list(detections["frame_shape"]),
+    }
+
+
+app = FastAPI(title="Inference Service", version="1.0.0")
+
+reader = SharedFrameReader()
+batcher = DetectionBatcher()
+
+
+def read_frames(refs: List[Dict]) -> List:
+    try:
+        return [reader.read(ref) for ref in refs]
+    except FrameRefError as e:
+        # 409 - клиент переходит на передачу JPEG
+        raise HTTPException(status_code=409, detail=str(e))
+    except (KeyError, ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Некорректная ссылка на кадр: {e}")
+
+
+@app.post("/detect")
+def detect(request: DetectRequest):
+    """Детекция людей и автобусов на кадрах (результаты в порядке кадров)"""
+    frames = read_frames(request.frames)
+    if request.imgsz is not None and len(request.imgsz) != len(frames):
+        raise HTTPException(status_code=400, detail="Число размеров imgsz не совпадает с числом кадров")
+    futures = batcher.submit(frames, request.imgsz)
+    try:
+        results = [future.result(timeout=settings.INFERENCE_TIMEOUT) for future in futures]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка детекции: {str(e)}")
+    return {"detections": [serialize_detections(detections) for detections in results]}
+
+
+@app.post("/recognize-buses")
+def recognize_buses(request: RecognizeRequest):
+    """Распознавание номеров по вырезанным областям автобусов"""
+    crops = read_frames([crop.frame for crop in request.crops])
+    # Вызовы EasyOCR упорядочивает блокировка CVService
+    numbers = [cv_service.recognize_bus_number(crop, item.bbox) for crop, item in zip(crops, request.crops)]
+    return {"numbers": numbers}
+
+
+@app.get("/health")
+def health():
+    return {
+        "status": "healthy",
+        "model": settings.YOLO_MODEL_PATH,
+        "ocr": cv_service.ocr_reader is not None,
+        "queued_frames": batcher._queue.qsize(),
+    }
+
+
+@app.on_event("shutdown")
+def shutdown():
+    reader.close()
@@ -37,6 +37,27 @@ app.include_router(cv.router, prefix="/api/v1/cv", tags=["Computer Vision"])
 app.include_router(yandex_maps.router, prefix="/api/v1/yandex", tags=["Yandex Maps"])
 
 
+@app.on_event("startup")
+async def start_hls():
+    """Запуск HLS записи камер, если она включена в настройках"""
+    if settings.HLS_ENABLED:
+        from services.hls_writer import hls_service
+        hls_service.start_configured()
+
+
+@app.on_event("shutdown")
+async def stop_hls():
+    if settings.HLS_ENABLED:
+        from services.hls_writer import hls_service
+        hls_service.stop_all()
+
+
+@app.on_event("shutdown")
+async def stop_video_jobs():
+    from services.video_jobs import video_jobs
+    video_jobs.shutdown()
+
+
 @app.get("/")
 async def root():
     return {"message": "Transport Load Monitoring System API", "version": "1.0.0"}
@@ -0,0 +1,188 @@
+"""
+Пакетная детекция на наборе изображений (POST /cv/detect-batch)
+Изображения приходят отдельными файлами multipart или архивами zip/tar
+(в том числе сжатыми) и распознаются порциями по DETECTION_BATCH_SIZE:
+один прогон модели или один запрос к сервису инференса на порцию.
+Пока порция распознается, следующая читается из архива и декодируется
+"""
+import asyncio
+import os
+import tarfile
+import time
+import zipfile
+from typing import AsyncIterator, BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from core.config import settings
+from services.cv_service import cv_service
+from services.image_decode import decode_image
+
+# Расширения файлов архива, которые считаются изображениями
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff"}
+
+# Изображение набора: (имя, содержимое или None, ошибка)
+BatchItem = Tuple[str, Optional[bytes], Optional[str]]
+
+
+class BatchDetectionError(Exception):
+    """Набор изображений не удалось прочитать"""
+    pass
+
+
+def _is_image_name(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def _read_member(name: str, size: int, read) -> BatchItem:
+    if size > settings.BATCH_DETECT_MAX_IMAGE_MB * 1024 * 1024:
+        return name, None, f"Изображение больше {settings.BATCH_DETECT_MAX_IMAGE_MB} МБ"
+    return name, read(), None
+
+
+def _read_upload(fileobj: BinaryIO, filename: str) -> BatchItem:
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    return _read_member(filename, size, fileobj.read)
+
+
+def iter_file_images(fileobj: BinaryIO, filename: str) -> Iterator[BatchItem]:
+    """
+    Изображения одного загруженного файла: архив zip/tar или одно изображение
+    Файлы архива, не являющиеся изображениями по расширению, пропускаются
+    """
+    if _is_image_name(filename):
+        yield _read_upload(fileobj, filename)
+        return
+
+    fileobj.seek(0)
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        try:
+            with zipfile.ZipFile(fileobj) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or not _is_image_name(info.filename):
+                        continue
+                    yield _read_member(
+                        f"{filename}/{info.filename}", info.file_size,
+                        lambda: archive.read(info)
+                    )
+        except zipfile.BadZipFile as e:
+            raise BatchDetectionError(f"Поврежденный архив {filename}: {e}")
+        return
+
+    fileobj.seek(0)
+    try:
+        # Последовательное чтение tar: архив не загружается в память целиком
+        archive = tarfile.open(fileobj=fileobj, mode="r|*")
+    except tarfile.ReadError:
+        # Не архив: файл без расширения изображения передается на декодирование как есть
+        yield _read_upload(fileobj, filename)
+        return
+    try:
+        with archive:
+            for member in archive:
+                if not member.isfile() or not _is_image_name(member.name):
+                    continue
+                yield _read_member(
+                    f"{filename}/{member.name}", member.size,
+                    lambda: archive.extractfile(member).read()
+                )
+    except (tarfile.TarError, EOFError, OSError) as e:
+        raise BatchDetectionError(f"Поврежденный архив {filename}: {e}")
+
+
+def iter_images(files: Sequence[Tuple[str, BinaryIO]]) -> Iterator[BatchItem]:
+    """Изображения всех загруженных файлов по порядку (не больше BATCH_DETECT_MAX_IMAGES)"""
+    count = 0
+    for filename, fileobj in files:
+        for item in iter_file_images(fileobj, filename):
+            count += 1
+            if count > settings.BATCH_DETECT_MAX_IMAGES:
+                raise BatchDetectionError(
+                    f"В наборе больше {settings.BATCH_DETECT_MAX_IMAGES} изображений, остальные не обработаны"
+                )
+            yield item
+
+
+def _next_chunk(items: Iterator[BatchItem], size: int) -> List[Tuple[BatchItem, object]]:
+    """Следующая порция изображений, декодированных для детекции (пустая - набор закончился)"""
+    chunk = []
+    for item in items:
+        data = item[1]
+        chunk.append((item, decode_image(data) if data is not None else None))
+        if len(chunk) >= size:
+            break
+    return chunk
+
+
+def _detect_chunk(chunk: List[Tuple[BatchItem, object]]) -> List[Dict]:
+    """Детекция порции одним вызовом detect_objects_batch; результаты в порядке порции"""
+    images = [image for _, image in chunk if image is not None]
+    detections = iter(cv_service.detect_objects_batch(
+        [image.frame for image in images], [image.imgsz for image in images]
+    ) if images else [])
+
+    results = []
+    for (name, data, error), image in chunk:
+        if image is None:
+            results.append({"name": name, "error": error or "Не удалось декодировать изображение"})
+            continue
+        result = image.to_full(next(detections))
+        results.append({
+            "name": name,
+            "people_count": len(result['people']),
+            "buses_count": len(result['buses']),
+            "detections": result,
+        })
+    return results
+
+
+async def detect_images(files: Sequence[Tuple[str, BinaryIO]]) -> AsyncIterator[Dict]:
+    """
+    Детекция на изображениях файлов; выдает события image (по одному на
+    изображение, в порядке набора) и итоговое событие done
+
+    Raises:
+        BatchDetectionError: архив поврежден или изображений слишком много
+    """
+    started = time.monotonic()
+    items = iter_images(files)
+    size = max(1, settings.DETECTION_BATCH_SIZE)
+    index = 0
+    failed = 0
+
+    chunk = await asyncio.to_thread(_next_chunk, items, size)
+    while chunk:
+        detection = asyncio.ensure_future(asyncio.to_thread(_detect_chunk, chunk))
+        read_error = None
+        try:
+            # Чтение и декодирование следующей порции идет параллельно с детекцией текущей
+            try:
+                next_chunk = await asyncio.to_thread(_next_chunk, items, size)
+            except BatchDetectionError as e:
+                next_chunk, read_error = [], e
+            try:
+                results = await detection
+            except Exception as e:
+                # Сбой детекции порции (модель, сервис инференса) - ошибка для ее
+                # изображений, остальные порции обрабатываются
+                print(f"[BATCH DETECT] Ошибка детекции порции из {len(chunk)} изображений: {e}")
+                results = [{"name": name, "error": f"Ошибка детекции: {e}"} for (name, _, _), _ in chunk]
+        finally:
+            detection.cancel()
+        for result in results:
+            if "error" in result:
+                failed += 1
+            yield {"event": "image", "index": index, **result}
+            index += 1
+        if read_error is not None:
+            # Результаты уже прочитанных изображений отправлены до ошибки
+            raise read_error
+        chunk = next_chunk
+
+    yield {
+        "event": "done",
+        "images": index,
+        "failed": failed,
+        "processing_seconds": round(time.monotonic() - started, 2),
+    }
@@ -0,0 +1,628 @@
+"""
+Общие конвейеры обработки камер
+Один захват видеопотока и одна детекция на камеру независимо от количества зрителей.
+Детекции берутся у воркеров мониторинга (services/detection_bus.py) и рисуются
+на кадрах потока; модель в процессе API запускается, только если их нет
+"""
+import asyncio
+import threading
+import time
+import statistics
+from collections import deque
+from typing import Dict, List, Optional
+
+import cv2
+
+from services.cv_service import cv_service
+from services.detection_bus import camera_detections
+from services.frame_sampler import FrameSampler
+from services.frame_transport import create_frame_ring
+from core.cameras import IS74_CAMERAS, get_stream_urls
+
+
+# Целевой FPS для режимов просмотра
+FPS_MODES = {
+    "active": 8,   # Полноэкранный просмотр
+    "passive": 1,  # Превью и сетка камер
+}
+
+# Сколько секунд конвейер живет без зрителей перед остановкой
+IDLE_TIMEOUT = 5.0
+
+# Пауза перед переподключением камеры с постоянными приемниками (HLS)
+RECONNECT_DELAY = 10.0
+
+# Допустимые параметры кадра, запрашиваемые клиентом
+MAX_FPS = 15
+MIN_WIDTH = 160
+DEFAULT_JPEG_QUALITY = 90
+
+# Профили для автоматического выбора по пропускной способности клиента:
+# (минимальный бюджет байт на кадр, ширина кадра или None для оригинала, качество JPEG)
+AUTO_PROFILES = [
+    (600_000, None, 90),
+    (200_000, 1280, 80),
+    (60_000, 640, 70),
+    (0, 320, 60),
+]
+# Профиль, пока клиент справляется с потоком (выше автоматически не повышается)
+AUTO_DEFAULT_LEVEL = 1
+AUTO_DEFAULT_PROFILE = AUTO_PROFILES[AUTO_DEFAULT_LEVEL][1:]
+# Окно измерения доставленных байт, секунды
+THROUGHPUT_WINDOW = 5.0
+# Пауза после смены профиля, пока кадры прежнего профиля уходят клиенту, секунды
+AUTO_SETTLE = 1.0
+# Без перегрузки столько секунд - профиль повышается на одну ступень, секунды
+AUTO_RECOVERY = 10.0
+# Отправка дольше этой доли интервала кадров - клиент не успевает забирать кадры
+SLOW_SEND_RATIO = 0.5
+
+
+def resolve_fps(fps_mode: str) -> int:
+    """Целевой FPS по названию режима (passive по умолчанию)"""
+    return FPS_MODES.get((fps_mode or "passive").lower(), FPS_MODES["passive"])
+
+
+def parse_stream_profile(params: Dict) -> Dict:
+    """
+    Разбор параметров кадра из query параметров или JSON команды клиента
+    Возвращает только переданные поля: fps, width (None - автоматически), quality
+
+    Поля:
+        - fps_mode: "active" | "passive"
+        - fps: явный FPS (имеет приоритет над fps_mode)
+        - width: ширина кадра в пикселях, "auto" или "original"
+        - quality: качество JPEG 10..95
+    """
+    profile = {}
+    if params.get("fps_mode") is not None:
+        profile["fps"] = resolve_fps(str(params["fps_mode"]))
+    if params.get("fps") not in (None, ""):
+        profile["fps"] = min(MAX_FPS, max(0.2, float(params["fps"])))
+
+    width = params.get("width")
+    if width not in (None, ""):
+        if str(width).lower() == "auto":
+            profile["width"] = None
+            profile["auto"] = True
+        elif str(width).lower() == "original":
+            profile["width"] = None
+            profile["auto"] = False
+        else:
+            profile["width"] = max(MIN_WIDTH, int(width))
+            profile["auto"] = False
+
+    if params.get("quality") not in (None, ""):
+        profile["quality"] = min(95, max(10, int(params["quality"])))
+        # Явное качество отключает автоматический выбор, если ширина не запрошена как "auto"
+        profile.setdefault("auto", False)
+    return profile
+
+
+class ThroughputMeter:
+    """
+    Выбор профиля кадра по пропускной способности клиента
+    send_bytes завершается, как только кадр попал в буфер сокета, поэтому время одной
+    отправки не измеряет канал. Перегрузка видна по пропущенным кадрам (клиент не забрал
+    предыдущий кадр камеры) и по отправке, ожидающей освобождения буфера дольше
+    SLOW_SEND_RATIO интервала кадров. Пока перегрузки нет, используется AUTO_DEFAULT_PROFILE;
+    при перегрузке профиль выбирается по байтам, доставленным за окно (скорость доставки
+    в этот момент ограничена клиентом), и повышается по ступени после AUTO_RECOVERY без перегрузки
+    """
+
+    def __init__(self, window: float = THROUGHPUT_WINDOW):
+        self.window = window
+        self.level = AUTO_DEFAULT_LEVEL
+        self.fps: Optional[float] = None
+        self.congested_at: Optional[float] = None
+        self._adjusted_at = time.monotonic()
+        # (начало отправки, конец отправки, байт) за последние window секунд
+        self._sent: deque = deque()
+        self._lock = threading.Lock()
+
+    def record(self, size: int, seconds: float):
+        """Отправленный кадр: размер и время ожидания send_bytes"""
+        now = time.monotonic()
+        with self._lock:
+            self._sent.append((now - seconds, now, size))
+            self._prune(now)
+        if self.fps and seconds > SLOW_SEND_RATIO / self.fps:
+            self.congested_at = now
+
+    def dropped(self):
+        """Кадр заменен следующим, не дождавшись отправки"""
+        self.congested_at = time.monotonic()
+
+    def _prune(self, now: float):
+        while self._sent and now - self._sent[0][1] > self.window:
+            self._sent.popleft()
+
+    @property
+    def bytes_per_second(self) -> Optional[float]:
+        """Байт в секунду, доставленных за окно (от начала первой до конца последней отправки)"""
+        with self._lock:
+            self._prune(time.monotonic())
+            if len(self._sent) < 2:
+                return None
+            elapsed = self._sent[-1][1] - self._sent[0][0]
+            return sum(size for _, _, size in self._sent) / elapsed if elapsed > 0 else None
+
+    def recommend(self, fps: float):
+        """Ширина и качество JPEG с учетом перегрузки клиента"""
+        self.fps = fps
+        now = time.monotonic()
+        congested_at = self.congested_at
+        if congested_at is not None and congested_at > self._adjusted_at + AUTO_SETTLE:
+            # Новая перегрузка после последней смены профиля - понижение не меньше чем на ступень
+            level = min(self.level + 1, len(AUTO_PROFILES) - 1)
+            rate = self.bytes_per_second
+            if rate is not None:
+                budget = rate / max(fps, 0.2)
+                fitting = next(i for i, (min_budget, _, _) in enumerate(AUTO_PROFILES) if budget >= min_budget)
+                level = max(level, fitting)
+            self.level = level
+            self._adjusted_at = now
+        elif self.level > AUTO_DEFAULT_LEVEL and now - max(self._adjusted_at, congested_at or 0) >= AUTO_RECOVERY:
+            self.level -= 1
+            self._adjusted_at = now
+        return AUTO_PROFILES[self.level][1:]
+
+
+class CameraViewer:
+    """
+    Получатель кадров одного WebSocket соединения
+    Хранит только последний пакет по каждой камере: медленный клиент пропускает кадры,
+    а не копит очередь
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop or asyncio.get_running_loop()
+        self._pending: Dict[str, Dict] = {}
+        self._event = asyncio.Event()
+        self.throughput = ThroughputMeter()
+
+    def offer(self, camera_id: str, packet: Dict):
+        """Передача пакета из потока конвейера (потокобезопасно)"""
+        try:
+            self.loop.call_soon_threadsafe(self._put, camera_id, packet)
+        except RuntimeError:
+            # Цикл событий уже закрыт - соединение завершено
+            pass
+
+    def _put(self, camera_id: str, packet: Dict):
+        previous = self._pending.get(camera_id)
+        if previous is not None and previous["type"] == "frame" and packet["type"] == "frame":
+            # Предыдущий кадр камеры не успел уйти клиенту
+            self.throughput.dropped()
+        self._pending[camera_id] = packet
+        self._event.set()
+
+    async def get(self) -> List[Dict]:
+        """Ожидание и получение всех накопленных пакетов (по одному на камеру)"""
+        await self._event.wait()
+        self._event.clear()
+        packets = list(self._pending.values())
+        self._pending.clear()
+        return packets
+
+
+class CameraPipeline:
+    """
+    Конвейер одной камеры: захват, детекция и кодирование JPEG в отдельном потоке
+    Результат раздается всем подписанным зрителям
+    """
+
+    def __init__(self, camera_id: str, hub: "CameraHub"):
+        self.camera_id = camera_id
+        self.camera = IS74_CAMERAS[camera_id]
+        self.hub = hub
+        self.stream_url: Optional[str] = None
+        self.connected = False
+        self.seq = 0
+        self.sampler = FrameSampler(FPS_MODES["passive"], ring=create_frame_ring())
+
+        # viewer -> {"with_detection", "fps", "width", "quality", "auto", "last_sent"}
+        self._viewers: Dict[CameraViewer, Dict] = {}
+        # Приемники аннотированных кадров (например, HLS): sink -> {"fps", "last_sent"}
+        self._sinks: Dict = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._idle_since: Optional[float] = None
+
+        # Сглаживание счетчиков отдельно для каждой камеры
+        self.history = {
+            'people': deque(maxlen=5),
+            'buses': deque(maxlen=5)
+        }
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name=f"camera-pipeline-{self.camera_id}", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def add_viewer(self, viewer: CameraViewer, with_detection: bool, profile: Dict) -> bool:
+        """Добавление зрителя; False, если конвейер уже останавливается"""
+        with self._lock:
+            if self._stop.is_set():
+                return False
+            options = self._viewers.get(viewer) or {
+                "fps": FPS_MODES["passive"],
+                "width": None,
+                "quality": DEFAULT_JPEG_QUALITY,
+                "auto": True,
+                "last_sent": 0.0,
+            }
+            options.update(profile)
+            options["with_detection"] = with_detection
+            self._viewers[viewer] = options
+            self._idle_since = None
+            connected = self.connected
+        if connected:
+            viewer.offer(self.camera_id, self._status_packet(with_detection))
+        return True
+
+    def add_sink(self, sink) -> bool:
+        """
+        Добавление приемника аннотированных кадров
+        Приемник должен иметь атрибут fps и метод write(frame, meta)
+        """
+        with self._lock:
+            if self._stop.is_set():
+                return False
+            self._sinks[sink] = {"fps": sink.fps, "last_sent": 0.0}
+            self._idle_since = None
+            return True
+
+    def remove_sink(self, sink):
+        with self._lock:
+            self._sinks.pop(sink, None)
+            if not self._viewers and not self._sinks:
+                self._idle_since = time.monotonic()
+
+    def configure_viewer(self, viewer: CameraViewer, profile: Dict) -> bool:
+        """Изменение параметров кадра зрителя на лету"""
+        with self._lock:
+            options = self._viewers.get(viewer)
+            if options is None:
+                return False
+            options.update(profile)
+            return True
+
+    def remove_viewer(self, viewer: CameraViewer):
+        with self._lock:
+            self._viewers.pop(viewer, None)
+            if not self._viewers and not self._sinks:
+                self._idle_since = time.monotonic()
+
+    def _status_packet(self, with_detection: bool) -> Dict:
+        return {
+            "type": "status",
+            "camera_id": self.camera_id,
+            "status": "connected",
+            "camera_name": self.camera["name"],
+            "detection_enabled": with_detection,
+        }
+
+    def _broadcast(self, packet_factory):
+        """Рассылка служебного пакета всем зрителям"""
+        with self._lock:
+            viewers = list(self._viewers.items())
+        for viewer, options in viewers:
+            viewer.offer(self.camera_id, packet_factory(options))
+
+    def _open_capture(self) -> Optional[cv2.VideoCapture]:
+        """Подключение к потоку с перебором форматов URL"""
+        for url in get_stream_urls(self.camera):
+            if self._stop.is_set():
+                return None
+            test_cap = None
+            try:
+                test_cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
+                test_cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Минимальный буфер для снижения задержки
+                test_cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'H264'))
+
+                # Даем больше времени на подключение для RTSP
+                time.sleep(1.0)
+
+                if test_cap.isOpened():
+                    # Проверяем, что поток действительно работает
+                    ret, test_frame = test_cap.read()
+                    if ret and test_frame is not None and test_frame.size > 0:
+                        self.stream_url = url
+                        print(f"✓ Успешное подключение к камере {self.camera_id} через URL: {url}")
+                        return test_cap
+                test_cap.release()
+            except Exception as e:
+                print(f"Ошибка при попытке подключения к {url}: {e}")
+                if test_cap is not None:
+                    try:
+                        test_cap.release()
+                    except Exception:
+                        pass
+        return None
+
+    def _smoothed_counts(self, detections: Dict) -> Dict[str, int]:
+        self.history['people'].append(len(detections['people']))
+        self.history['buses'].append(len(detections['buses']))
+        return {
+            'people': int(statistics.median(self.history['people'])),
+            'buses': int(statistics.median(self.history['buses'])),
+        }
+
+    @staticmethod
+    def _encode_variant(frame, width: Optional[int], quality: int) -> bytes:
+        """Уменьшение кадра до заданной ширины (без увеличения) и кодирование JPEG"""
+        h, w = frame.shape[:2]
+        if width is not None and width < w:
+            frame = cv2.resize(frame, (width, int(h * width / w)), interpolation=cv2.INTER_AREA)
+        _, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return encoded.tobytes()
+
+    def _idle_expired(self) -> bool:
+        """Проверка простоя; при истечении конвейер сразу помечается остановленным"""
+        with self._lock:
+            expired = (
+                not self._viewers
+                and not self._sinks
+                and self._idle_since is not None
+                and time.monotonic() - self._idle_since > IDLE_TIMEOUT
+            )
+            if expired:
+                self._stop.set()
+            return expired
+
+    def _run(self):
+        cap = self._open_capture()
+        if cap is None:
+            self.stop()
+            self._broadcast(lambda options: {
+                "type": "error",
+                "camera_id": self.camera_id,
+                "error": f"Не удалось открыть видеопоток камеры {self.camera_id}. Попробованы все форматы URL."
+            })
+            self.hub._discard(self)
+            return
+
+        self.connected = True
+        self._broadcast(lambda options: self._status_packet(options["with_detection"]))
+
+        try:
+            while not self._stop.is_set():
+                if self._idle_expired():
+                    break
+
+                with self._lock:
+                    viewers = list(self._viewers.items())
+                    sinks = list(self._sinks.items())
+                if viewers or sinks:
+                    # Конвейер работает с максимальным FPS среди зрителей и приемников
+                    self.sampler.set_fps(max(options["fps"] for _, options in viewers + sinks))
+                    ret, frame = self.sampler.read(cap)
+                else:
+                    # Без зрителей поток только вычитывается, кадры не декодируются
+                    ret, frame = self.sampler.grab(cap), None
+                if not ret:
+                    self.stop()
+                    self._broadcast(lambda options: {
+                        "type": "error",
+                        "camera_id": self.camera_id,
+                        "error": "Ошибка чтения кадра"
+                    })
+                    break
+                if frame is None:
+                    continue
+
+                now = time.monotonic()
+                # Кому из зрителей пора отправлять кадр; допуск в полинтервала отбора
+                # поглощает неравномерную доставку кадров, отобранных по часам потока
+                tolerance = 0.5 * self.sampler.interval
+                due = [
+                    (viewer, options) for viewer, options in viewers
+                    if now - options["last_sent"] >= 1.0 / options["fps"] - tolerance
+                ]
+                due_sinks = [
+                    (sink, options) for sink, options in sinks
+                    if now - options["last_sent"] >= 1.0 / options["fps"] - tolerance
+                ]
+                if not due and not due_sinks:
+                    continue
+
+                self.seq += 1
+                need_detection = bool(due_sinks) or any(options["with_detection"] for _, options in due)
+
+                result_frame = frame
+                meta = None
+                detections = None
+                if need_detection:
+                    # Детекции воркеров мониторинга камеры; модель в процессе API - только без них
+                    detections, source = camera_detections(self.camera_id, frame)
+                if detections is not None:
+                    smoothed_counts = self._smoothed_counts(detections)
+                    result_frame = cv_service.draw_detections(frame, detections)
+                    meta = {
+                        "people_count": smoothed_counts['people'],
+                        "buses_count": smoothed_counts['buses'],
+                        "frame_number": self.seq,
+                        "raw_people": len(detections['people']),  # Сырые значения для отладки
+                        "raw_buses": len(detections['buses']),
+                        "detection_source": source
+                    }
+
+                # Варианты кадра кодируются один раз на каждую различную настройку
+                variants: Dict = {}
+                for viewer, options in due:
+                    options["last_sent"] = now
+                    if options["auto"]:
+                        width, quality = viewer.throughput.recommend(options["fps"])
+                    else:
+                        width, quality = options["width"], options["quality"]
+                    annotated = options["with_detection"]
+                    key = (annotated, width, quality)
+                    if key not in variants:
+                        variants[key] = self._encode_variant(
+                            result_frame if annotated else frame, width, quality
+                        )
+                    viewer.offer(self.camera_id, {
+                        "type": "frame",
+                        "camera_id": self.camera_id,
+                        "seq": self.seq,
+                        "jpeg": variants[key],
+                        "meta": meta if annotated else None,
+                        "profile": {"width": width, "quality": quality, "fps": options["fps"]},
+                    })
+
+                for sink, options in due_sinks:
+                    options["last_sent"] = now
+                    try:
+                        sink.write(result_frame, meta)
+                    except Exception as e:
+                        print(f"Ошибка приемника кадров камеры {self.camera_id}: {e}")
+        except Exception as e:
+            print(f"Ошибка обработки потока камеры {self.camera_id}: {e}")
+            self.stop()
+            self._broadcast(lambda options: {
+                "type": "error",
+                "camera_id": self.camera_id,
+                "error": str(e)
+            })
+        finally:
+            cap.release()
+            if self.sampler.ring is not None:
+                self.sampler.ring.close()
+            self.connected = False
+            self.hub._discard(self)
+
+
+class CameraHub:
+    """Реестр общих конвейеров камер процесса API"""
+
+    def __init__(self):
+        self._pipelines: Dict[str, CameraPipeline] = {}
+        # Постоянные приемники по камерам - переживают переподключение конвейера
+        self._sinks: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def _ensure_pipeline(self, camera_id: str, attach) -> CameraPipeline:
+        """Получение работающего конвейера камеры и присоединение к нему (attach -> bool)"""
+        while True:
+            with self._lock:
+                pipeline = self._pipelines.get(camera_id)
+                if pipeline is None or not pipeline.is_alive:
+                    pipeline = CameraPipeline(camera_id, self)
+                    self._pipelines[camera_id] = pipeline
+                    pipeline.start()
+            if attach(pipeline):
+                return pipeline
+
+    def subscribe(self, camera_id: str, viewer: CameraViewer, with_detection: bool = True,
+                  profile: Optional[Dict] = None):
+        """
+        Подписка зрителя на камеру; запускает конвейер, если он еще не работает
+        Повторная подписка обновляет параметры зрителя
+
+        Args:
+            profile: параметры кадра (см. parse_stream_profile); не переданные поля
+                     сохраняются либо берутся по умолчанию (1 FPS, автоматическое качество)
+        """
+        profile = profile or {}
+        if camera_id not in IS74_CAMERAS:
+            raise KeyError(camera_id)
+        self._ensure_pipeline(
+            camera_id, lambda pipeline: pipeline.add_viewer(viewer, with_detection, profile)
+        )
+
+    def add_sink(self, camera_id: str, sink):
+        """
+        Постоянный приемник аннотированных кадров камеры
+        Конвейер работает без зрителей и переподключается при потере потока
+        """
+        if camera_id not in IS74_CAMERAS:
+            raise KeyError(camera_id)
+        with self._lock:
+            self._sinks.setdefault(camera_id, []).append(sink)
+        self._ensure_pipeline(camera_id, lambda pipeline: pipeline.add_sink(sink))
+
+    def remove_sink(self, camera_id: str, sink):
+        with self._lock:
+            sinks = self._sinks.get(camera_id, [])
+            if sink in sinks:
+                sinks.remove(sink)
+            pipeline = self._pipelines.get(camera_id)
+        if pipeline is not None:
+            pipeline.remove_sink(sink)
+
+    def get_sinks(self, camera_id: str) -> list:
+        with self._lock:
+            return list(self._sinks.get(camera_id, []))
+
+    def _reattach_sinks(self, camera_id: str):
+        for sink in self.get_sinks(camera_id):
+            self._ensure_pipeline(camera_id, lambda pipeline: pipeline.add_sink(sink))
+
+    def configure(self, camera_id: str, viewer: CameraViewer, profile: Dict) -> bool:
+        """Изменение параметров кадра для уже подписанного зрителя"""
+        with self._lock:
+            pipeline = self._pipelines.get(camera_id)
+        return pipeline is not None and pipeline.configure_viewer(viewer, profile)
+
+    def unsubscribe(self, camera_id: str, viewer: CameraViewer):
+        with self._lock:
+            pipeline = self._pipelines.get(camera_id)
+        if pipeline is not None:
+            pipeline.remove_viewer(viewer)
+
+    def unsubscribe_all(self, viewer: CameraViewer):
+        with self._lock:
+            pipelines = list(self._pipelines.values())
+        for pipeline in pipelines:
+            pipeline.remove_viewer(viewer)
+
+    def _discard(self, pipeline: CameraPipeline):
+        """Удаление завершившегося конвейера из реестра"""
+        pipeline.stop()
+        with self._lock:
+            if self._pipelines.get(pipeline.camera_id) is pipeline:
+                del self._pipelines[pipeline.camera_id]
+            has_sinks = bool(self._sinks.get(pipeline.camera_id))
+        if has_sinks:
+            # Постоянные приемники требуют восстановления потока
+            timer = threading.Timer(RECONNECT_DELAY, self._reattach_sinks, [pipeline.camera_id])
+            timer.daemon = True
+            timer.start()
+
+    def get_status(self) -> Dict:
+        with self._lock:
+            pipelines = list(self._pipelines.values())
+        return {
+            pipeline.camera_id: {
+                "connected": pipeline.connected,
+                "stream_url": pipeline.stream_url,
+                "viewers": len(pipeline._viewers),
+                "sinks": len(pipeline._sinks),
+                "frames": pipeline.seq,
+                "sampler": pipeline.sampler.snapshot(),
+            }
+            for pipeline in pipelines
+        }
+
+
+def encode_tagged_frame(camera_id: str, jpeg: bytes) -> bytes:
+    """
+    Бинарное сообщение мультиплексированного потока:
+    1 байт длины ID камеры, ID камеры (ASCII), затем JPEG
+    """
+    tag = camera_id.encode('ascii')
+    return bytes([len(tag)]) + tag + jpeg
+
+
+# Глобальный реестр конвейеров
+camera_hub = CameraHub()
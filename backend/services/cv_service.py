@@ -6,19 +6,16 @@ import cv2
 import numpy as np
 from typing import List, Dict, Tuple, Optional
 from datetime import datetime
-from ultralytics import YOLO
-import torch
 import re
+import threading
+from abc import ABC, abstractmethod
 
 from core.config import settings
+from services.image_decode import DecodedImage, select_imgsz
 from collections import deque
 
-# Попытка импорта OCR библиотек
-try:
-    import easyocr
-    EASYOCR_AVAILABLE = True
-except ImportError:
-    EASYOCR_AVAILABLE = False
+# YOLO и EasyOCR импортируются при создании CVService: процессы, работающие
+# через сервис инференса (INFERENCE_URL), не загружают модели
 
 try:
     import pytesseract
@@ -27,133 +24,37 @@ except ImportError:
     TESSERACT_AVAILABLE = False
 
 
-class CVService:
-    """Сервис для обработки видеокадров с помощью YOLO"""
+class BaseCVService(ABC):
+    """
+    Общая логика обработки кадров: зоны остановок, подсчет, отрисовка
+    Детекция и распознавание номеров реализуются в наследниках
+    (локальные модели или удаленный сервис инференса)
+    """
     
     def __init__(self):
-        """Инициализация моделей YOLO"""
-        self.model = YOLO(settings.YOLO_MODEL_PATH)
-        self.confidence_threshold = settings.CONFIDENCE_THRESHOLD
-        
-        # COCO классы YOLO: 0 - person, 2 - car, 5 - bus, 7 - truck
-        self.person_class = 0
-        self.bus_class = 5
-        self.car_class = 2
-        self.truck_class = 7
-        
-        # Инициализация OCR для распознавания номеров автобусов
-        self.ocr_reader = None
-        if EASYOCR_AVAILABLE:
-            try:
-                self.ocr_reader = easyocr.Reader(['en', 'ru'], gpu=False)
-            except Exception as e:
-                print(f"Не удалось инициализировать EasyOCR: {e}")
-        
-        # Для трекинга объектов между кадрами
-        self.tracker = None
-        
         # Для сглаживания результатов детекции (стабильность)
         self.detection_history = {
             'people': deque(maxlen=5),  # История последних 5 детекций
             'buses': deque(maxlen=5)
         }
-        
-    def detect_objects(self, frame: np.ndarray) -> Dict:
-        """
-        Детекция объектов на кадре
-        Оптимизировано для работы с HD кадрами
-        
-        Args:
-            frame: numpy array изображения в формате BGR
-            
-        Returns:
-            Словарь с результатами детекции
-        """
-        # Для HD кадров используем большее разрешение для детекции
-        # Для маленьких объектов (15x8 пикселей на 2688x1520) нужна максимальная детализация
-        h, w = frame.shape[:2]
-        
-        # Для больших разрешений используем максимальный размер для детекции
-        # Это критично для детекции маленьких объектов
-        if h > 1500 or w > 2500:
-            # Для очень больших разрешений используем максимальный размер
-            imgsz = 1920  # Максимальный размер для лучшей детекции маленьких объектов
-        elif h > 720:
-            imgsz = 1280  # HD разрешение
-        else:
-            imgsz = 640  # Стандартное разрешение
-        
-        # Для маленьких объектов снижаем порог уверенности и увеличиваем детализацию
-        # Используем более агрессивные настройки для детекции людей
-        # Для людей используем еще более низкий порог (0.05) для детекции маленьких объектов
-        results = self.model(
-            frame, 
-            conf=0.05,  # Очень низкий порог для детекции маленьких людей (15x8 пикселей)
-            imgsz=imgsz, 
-            verbose=False,
-            agnostic_nms=False,  # Не объединять объекты разных классов
-            max_det=500,  # Увеличиваем максимальное количество детекций для маленьких объектов
-            iou=0.45  # Более строгий IoU для лучшего разделения близких объектов
-        )
-        
-        detections = {
-            'people': [],
-            'buses': [],
-            'timestamp': datetime.now(),
-            'frame_shape': frame.shape
-        }
-        
-        if len(results) > 0:
-            result = results[0]
-            
-            # Извлечение боксов, классов и уверенностей
-            boxes = result.boxes
-            if boxes is not None:
-                for box in boxes:
-                    cls = int(box.cls[0])
-                    conf = float(box.conf[0])  # Явное преобразование во float
-                    x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                    
-                    # Явное преобразование координат во float
-                    x1 = float(x1)
-                    y1 = float(y1)
-                    x2 = float(x2)
-                    y2 = float(y2)
-                    
-                    # Фильтрация по размеру для улучшения детекции маленьких объектов
-                    box_width = x2 - x1
-                    box_height = y2 - y1
-                    box_area = float(box_width * box_height)  # Явное преобразование во float
-                    frame_area = h * w
-                    
-                    detection = {
-                        'bbox': [x1, y1, x2, y2],  # Координаты уже преобразованы во float
-                        'confidence': conf,
-                        'class_id': cls,
-                        'area': box_area
-                    }
-                    
-                    # Детекция только людей и автобусов (машины исключены)
-                    if cls == self.person_class:
-                        # Для людей используем очень низкий порог для маленьких объектов
-                        # Принимаем людей даже если они очень маленькие, но с достаточной уверенностью
-                        min_person_area = frame_area * 0.00005  # 0.005% от площади кадра (для людей 15x8 пикселей)
-                        if box_area >= min_person_area or conf > 0.25:
-                            # Дополнительная проверка: соотношение сторон должно быть разумным для человека
-                            aspect_ratio = box_height / box_width if box_width > 0 else 0
-                            if aspect_ratio > 0.3 and aspect_ratio < 3.0:  # Люди обычно выше, чем шире
-                                detections['people'].append(detection)
-                    elif cls == self.bus_class:
-                        # Для автобусов минимальный размер больше
-                        min_bus_area = frame_area * 0.0005  # 0.05% от площади кадра
-                        if box_area >= min_bus_area or conf > 0.4:
-                            detections['buses'].append(detection)
-        
-        # Сохраняем в историю для сглаживания
+    
+    @abstractmethod
+    def detect_objects(self, frame: np.ndarray, imgsz: Optional[int] = None) -> Dict:
+        """Детекция людей и автобусов на кадре (обновляет историю сглаживания)"""
+    
+    @abstractmethod
+    def detect_objects_batch(self, frames: List[np.ndarray],
+                             imgsz: Optional[List[Optional[int]]] = None) -> List[Dict]:
+        """Детекция на нескольких кадрах; результаты в порядке кадров"""
+    
+    @abstractmethod
+    def recognize_bus_number(self, frame: np.ndarray, bus_bbox: Tuple[int, int, int, int]) -> Optional[str]:
+        """Номер автобуса в области bus_bbox кадра или None"""
+    
+    def _record_history(self, detections: Dict):
+        """Сохранение количества объектов в историю для сглаживания"""
         self.detection_history['people'].append(len(detections['people']))
         self.detection_history['buses'].append(len(detections['buses']))
-        
-        return detections
     
     def get_smoothed_counts(self) -> Dict[str, int]:
         """
@@ -190,23 +91,7 @@ class CVService:
             Количество людей
         """
         detections = self.detect_objects(frame)
-        
-        if zone is None:
-            return len(detections['people'])
-        
-        x1_zone, y1_zone, x2_zone, y2_zone = zone
-        count = 0
-        
-        for person in detections['people']:
-            x1, y1, x2, y2 = person['bbox']
-            # Проверка пересечения с зоной
-            center_x = (x1 + x2) / 2
-            center_y = (y1 + y2) / 2
-            
-            if (x1_zone <= center_x <= x2_zone and y1_zone <= center_y <= y2_zone):
-                count += 1
-        
-        return count
+        return self.count_people_in_detections(detections['people'], zone)
     
     def detect_buses(self, frame: np.ndarray) -> List[Dict]:
         """
@@ -221,87 +106,6 @@ class CVService:
         detections = self.detect_objects(frame)
         return detections['buses']
     
-    def recognize_bus_number(self, frame: np.ndarray, bus_bbox: Tuple[int, int, int, int]) -> Optional[str]:
-        """
-        Распознавание номера автобуса
-        Оптимизировано для работы с HD кадрами - лучшее качество распознавания
-        
-        Args:
-            frame: кадр изображения (HD качество)
-            bus_bbox: координаты автобуса (x1, y1, x2, y2)
-            
-        Returns:
-            Распознанный номер автобуса или None
-        """
-        x1, y1, x2, y2 = map(int, bus_bbox)
-        
-        # Извлечение области автобуса с небольшим отступом для лучшего распознавания
-        padding = 10
-        x1 = max(0, x1 - padding)
-        y1 = max(0, y1 - padding)
-        x2 = min(frame.shape[1], x2 + padding)
-        y2 = min(frame.shape[0], y2 + padding)
-        
-        bus_roi = frame[y1:y2, x1:x2]
-        
-        if bus_roi.size == 0:
-            return None
-        
-        # Для HD кадров можно увеличить размер области для лучшего распознавания
-        h, w = bus_roi.shape[:2]
-        if h < 50 or w < 50:
-            # Увеличиваем маленькие области
-            scale = max(2.0, 100.0 / max(h, w))
-            new_h, new_w = int(h * scale), int(w * scale)
-            bus_roi = cv2.resize(bus_roi, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
-        
-        # Увеличение контрастности для лучшего распознавания
-        gray = cv2.cvtColor(bus_roi, cv2.COLOR_BGR2GRAY)
-        
-        # Улучшение изображения с более агрессивными настройками для HD
-        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-        enhanced = clahe.apply(gray)
-        
-        # Дополнительное улучшение резкости для HD кадров
-        kernel = np.array([[-1,-1,-1], [-1,9,-1], [-1,-1,-1]])
-        sharpened = cv2.filter2D(enhanced, -1, kernel)
-        
-        # Бинаризация для лучшего распознавания текста
-        _, binary = cv2.threshold(sharpened, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        
-        # Попытка распознавания через EasyOCR
-        # Для HD кадров используем более высокий порог уверенности
-        if self.ocr_reader is not None:
-            try:
-                # Используем оба варианта: бинарное и улучшенное изображение
-                results_binary = self.ocr_reader.readtext(binary)
-                results_enhanced = self.ocr_reader.readtext(enhanced)
-                
-                # Объединяем результаты
-                all_results = results_binary + results_enhanced
-                
-                for (bbox, text, confidence) in all_results:
-                    # Для HD кадров можно использовать более высокий порог
-                    if confidence > 0.6:  # Повышенный порог для HD
-                        # Очистка текста от лишних символов
-                        cleaned_text = re.sub(r'[^0-9А-ЯA-Z]', '', text.upper())
-                        if len(cleaned_text) >= 2:  # Номер должен быть минимум 2 символа
-                            return cleaned_text
-            except Exception as e:
-                print(f"Ошибка EasyOCR: {e}")
-        
-        # Попытка распознавания через Tesseract
-        if TESSERACT_AVAILABLE:
-            try:
-                text = pytesseract.image_to_string(binary, config='--psm 7 -c tessedit_char_whitelist=0123456789АБВГДЕЖЗИКЛМНОПРСТУФХЦЧШЩЭЮЯ')
-                cleaned_text = re.sub(r'[^0-9А-ЯA-Z]', '', text.upper())
-                if len(cleaned_text) >= 2:
-                    return cleaned_text
-            except Exception as e:
-                print(f"Ошибка Tesseract: {e}")
-        
-        return None
-    
     def detect_stop_zone(self, frame: np.ndarray, stop_zone_coords: Optional[List[List[float]]] = None) -> Optional[Tuple[int, int, int, int]]:
         """
         Определение зоны остановки на кадре
@@ -313,51 +117,94 @@ class CVService:
         Returns:
             Координаты зоны остановки (x1, y1, x2, y2) или None
         """
-        if stop_zone_coords is None or len(stop_zone_coords) < 2:
+        zone = self.zone_bbox(stop_zone_coords)
+        if zone is None:
             # Если координаты не заданы, используем весь кадр
             h, w = frame.shape[:2]
             return (0, 0, w, h)
+        return zone
+    
+    @staticmethod
+    def zone_bbox(stop_zone_coords: Optional[List[List[float]]]) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Прямоугольник (x1, y1, x2, y2), описанный вокруг зоны остановки
+        None, если координаты не заданы (зона - весь кадр)
+        """
+        if stop_zone_coords is None or len(stop_zone_coords) < 2:
+            return None
         
         # Преобразуем координаты в прямоугольник
         # Берем минимальные и максимальные значения
         x_coords = [coord[0] for coord in stop_zone_coords]
         y_coords = [coord[1] for coord in stop_zone_coords]
         
-        x1 = int(min(x_coords))
-        y1 = int(min(y_coords))
-        x2 = int(max(x_coords))
-        y2 = int(max(y_coords))
-        
-        return (x1, y1, x2, y2)
+        return (int(min(x_coords)), int(min(y_coords)), int(max(x_coords)), int(max(y_coords)))
     
-    def process_video_frame(self, frame: np.ndarray, stop_zone_coords: Optional[List[List[float]]] = None) -> Dict:
+    def count_people_in_detections(self, people: List[Dict], zone: Optional[Tuple[int, int, int, int]] = None) -> int:
         """
-        Обработка кадра видеопотока
+        Подсчет людей в зоне по готовым детекциям (без повторной детекции)
         
         Args:
-            frame: кадр изображения
-            stop_zone_coords: координаты зоны остановки для подсчета людей
+            people: детекции людей в координатах кадра
+            zone: координаты зоны (x1, y1, x2, y2) или None для всего кадра
             
         Returns:
-            Результаты обработки
+            Количество людей, центр которых попадает в зону
         """
-        detections = self.detect_objects(frame)
-        
-        # Определение зоны остановки
-        stop_zone = self.detect_stop_zone(frame, stop_zone_coords)
+        if zone is None:
+            return len(people)
         
-        # Подсчет людей в зоне остановки
-        people_in_stop = self.count_people_in_zone(frame, stop_zone) if stop_zone else len(detections['people'])
+        x1_zone, y1_zone, x2_zone, y2_zone = zone
+        count = 0
+        for person in people:
+            x1, y1, x2, y2 = person['bbox']
+            center_x = (x1 + x2) / 2
+            center_y = (y1 + y2) / 2
+            if x1_zone <= center_x <= x2_zone and y1_zone <= center_y <= y2_zone:
+                count += 1
+        return count
+    
+    def recognize_buses(self, frame: np.ndarray, buses: List[Dict]) -> List[Dict]:
+        """
+        Распознавание номеров для всех обнаруженных автобусов кадра
         
-        # Обработка автобусов - распознавание номеров
+        Args:
+            frame: кадр изображения
+            buses: детекции автобусов
+            
+        Returns:
+            Список автобусов с номерами
+        """
         buses_info = []
-        for bus_det in detections['buses']:
+        for bus_det in buses:
             bus_number = self.recognize_bus_number(frame, bus_det['bbox'])
             buses_info.append({
                 'bbox': bus_det['bbox'],
                 'confidence': bus_det['confidence'],
                 'bus_number': bus_number
             })
+        return buses_info
+    
+    def build_zone_results(self, frame: np.ndarray, detections: Dict, buses_info: List[Dict],
+                           stop_zone_coords: Optional[List[List[float]]] = None) -> Dict:
+        """
+        Результаты для зоны остановки по общим детекциям кадра
+        Несколько остановок одной камеры используют одну детекцию и одно распознавание номеров
+        
+        Args:
+            frame: кадр изображения
+            detections: результат detect_objects для кадра
+            buses_info: результат recognize_buses для кадра
+            stop_zone_coords: координаты зоны остановки для подсчета людей
+            
+        Returns:
+            Результаты обработки (формат process_video_frame)
+        """
+        # Определение зоны остановки
+        stop_zone = self.detect_stop_zone(frame, stop_zone_coords)
+        
+        # Подсчет людей в зоне остановки
+        people_in_stop = self.count_people_in_detections(detections['people'], stop_zone)
         
         return {
             'timestamp': datetime.now(),
@@ -369,6 +216,75 @@ class CVService:
             'total_detections': len(detections['people']) + len(detections['buses'])
         }
     
+    def process_video_frame(self, frame: np.ndarray, stop_zone_coords: Optional[List[List[float]]] = None) -> Dict:
+        """
+        Обработка кадра видеопотока
+        
+        Args:
+            frame: кадр изображения
+            stop_zone_coords: координаты зоны остановки для подсчета людей
+            
+        Returns:
+            Результаты обработки
+        """
+        detections = self.detect_objects(frame)
+        
+        # Обработка автобусов - распознавание номеров
+        buses_info = self.recognize_buses(frame, detections['buses'])
+
+        return self.build_zone_results(frame, detections, buses_info, stop_zone_coords)
+
+    def detect_decoded(self, image: DecodedImage) -> Dict:
+        """
+        Детекция на кадре decode_image; боксы в координатах image.frame
+        (для отрисовки на нем), в координаты исходного кадра - image.to_full
+        """
+        return self.detect_objects(image.frame, imgsz=image.imgsz)
+
+    def process_decoded_frame(self, image: DecodedImage,
+                              stop_zone_coords: Optional[List[List[float]]] = None) -> Dict:
+        """
+        Обработка кадра decode_image (формат process_video_frame, координаты исходного кадра)
+        Кадр в исходном разрешении декодируется только для распознавания номеров
+        """
+        detections = image.to_full(self.detect_decoded(image))
+
+        buses_info = self.recognize_buses(image.full(), detections['buses']) if detections['buses'] else []
+
+        # Зоне остановки нужен только размер кадра
+        return self.build_zone_results(image, detections, buses_info, stop_zone_coords)
+    
+    def render_zone(self, frame: np.ndarray, stop_zone: Tuple[int, int, int, int],
+                    people: List[Dict], buses: List[Dict]) -> np.ndarray:
+        """
+        Вырезание зоны остановки с отрисовкой детекций полного кадра, попавших в зону
+        
+        Args:
+            frame: полный кадр
+            stop_zone: координаты зоны (x1, y1, x2, y2)
+            people, buses: детекции в координатах полного кадра
+            
+        Returns:
+            Изображение зоны с отрисованными детекциями
+        """
+        x1_zone, y1_zone, x2_zone, y2_zone = stop_zone
+        
+        def to_zone(items):
+            zone_items = []
+            for item in items:
+                x1, y1, x2, y2 = item['bbox']
+                center_x = (x1 + x2) / 2
+                center_y = (y1 + y2) / 2
+                if x1_zone <= center_x <= x2_zone and y1_zone <= center_y <= y2_zone:
+                    zone_items.append({
+                        **item,
+                        'bbox': [x1 - x1_zone, y1 - y1_zone, x2 - x1_zone, y2 - y1_zone]
+                    })
+            return zone_items
+        
+        zone_frame = frame[y1_zone:y2_zone, x1_zone:x2_zone]
+        return self.draw_detections(zone_frame, {'people': to_zone(people), 'buses': to_zone(buses)})
+    
     def draw_detections(self, frame: np.ndarray, detections: Dict) -> np.ndarray:
         """
         Отрисовка детекций на кадре (для визуализации)
@@ -416,6 +332,286 @@ class CVService:
         return result_frame
 
 
-# Глобальный экземпляр сервиса
-cv_service = CVService()
+class CVService(BaseCVService):
+    """Сервис для обработки видеокадров с помощью YOLO"""
+    
+    def __init__(self):
+        """
+        Настройки детекции; модели загружаются при первом использовании:
+        процесс, получающий детекции от воркеров (API с API_LOCAL_INFERENCE=false),
+        их не загружает
+        """
+        super().__init__()
+        # YOLO и EasyOCR не рассчитаны на одновременные вызовы: кадры камер, снимков
+        # и WebSocket обрабатываются в разных потоках процесса, прогоны идут по очереди
+        self._model_lock = threading.Lock()
+        self._ocr_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._model = None
+        self._ocr_reader = None
+        self._models_loaded = False
+        self.confidence_threshold = settings.CONFIDENCE_THRESHOLD
+        
+        # COCO классы YOLO: 0 - person, 2 - car, 5 - bus, 7 - truck
+        self.person_class = 0
+        self.bus_class = 5
+        self.car_class = 2
+        self.truck_class = 7
+        
+        # Для трекинга объектов между кадрами
+        self.tracker = None
+    
+    def load_models(self):
+        """Загрузка YOLO и OCR (один раз на процесс)"""
+        with self._load_lock:
+            if self._models_loaded:
+                return
+            from ultralytics import YOLO
+            self._model = YOLO(settings.YOLO_MODEL_PATH)
+            
+            # Инициализация OCR для распознавания номеров автобусов
+            try:
+                import easyocr
+                self._ocr_reader = easyocr.Reader(['en', 'ru'], gpu=False)
+            except ImportError:
+                pass
+            except Exception as e:
+                print(f"Не удалось инициализировать EasyOCR: {e}")
+            self._models_loaded = True
+    
+    @property
+    def model(self):
+        self.load_models()
+        return self._model
+    
+    @property
+    def ocr_reader(self):
+        self.load_models()
+        return self._ocr_reader
+    
+    def _select_imgsz(self, frame: np.ndarray) -> int:
+        """Размер входа модели в зависимости от разрешения кадра"""
+        h, w = frame.shape[:2]
+        return select_imgsz(w, h)
+    
+    def _predict(self, source, imgsz: int):
+        """Прогон модели на кадре или списке кадров (один батч)"""
+        # Для маленьких объектов снижаем порог уверенности и увеличиваем детализацию
+        # Используем более агрессивные настройки для детекции людей
+        # Для людей используем еще более низкий порог (0.05) для детекции маленьких объектов
+        with self._model_lock:
+            return self.model(
+                source, 
+                conf=0.05,  # Очень низкий порог для детекции маленьких людей (15x8 пикселей)
+                imgsz=imgsz, 
+                verbose=False,
+                agnostic_nms=False,  # Не объединять объекты разных классов
+                max_det=500,  # Увеличиваем максимальное количество детекций для маленьких объектов
+                iou=0.45  # Более строгий IoU для лучшего разделения близких объектов
+            )
+    
+    def _parse_result(self, result, frame: np.ndarray) -> Dict:
+        """Преобразование результата YOLO в словарь детекций людей и автобусов"""
+        h, w = frame.shape[:2]
+        
+        detections = {
+            'people': [],
+            'buses': [],
+            'timestamp': datetime.now(),
+            'frame_shape': frame.shape
+        }
+        
+        if result is None:
+            return detections
+        
+        # Извлечение боксов, классов и уверенностей
+        boxes = result.boxes
+        if boxes is not None:
+            for box in boxes:
+                cls = int(box.cls[0])
+                conf = float(box.conf[0])  # Явное преобразование во float
+                x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
+                
+                # Явное преобразование координат во float
+                x1 = float(x1)
+                y1 = float(y1)
+                x2 = float(x2)
+                y2 = float(y2)
+                
+                # Фильтрация по размеру для улучшения детекции маленьких объектов
+                box_width = x2 - x1
+                box_height = y2 - y1
+                box_area = float(box_width * box_height)  # Явное преобразование во float
+                frame_area = h * w
+                
+                detection = {
+                    'bbox': [x1, y1, x2, y2],  # Координаты уже преобразованы во float
+                    'confidence': conf,
+                    'class_id': cls,
+                    'area': box_area
+                }
+                
+                # Детекция только людей и автобусов (машины исключены)
+                if cls == self.person_class:
+                    # Для людей используем очень низкий порог для маленьких объектов
+                    # Принимаем людей даже если они очень маленькие, но с достаточной уверенностью
+                    min_person_area = frame_area * 0.00005  # 0.005% от площади кадра (для людей 15x8 пикселей)
+                    if box_area >= min_person_area or conf > 0.25:
+                        # Дополнительная проверка: соотношение сторон должно быть разумным для человека
+                        aspect_ratio = box_height / box_width if box_width > 0 else 0
+                        if aspect_ratio > 0.3 and aspect_ratio < 3.0:  # Люди обычно выше, чем шире
+                            detections['people'].append(detection)
+                elif cls == self.bus_class:
+                    # Для автобусов минимальный размер больше
+                    min_bus_area = frame_area * 0.0005  # 0.05% от площади кадра
+                    if box_area >= min_bus_area or conf > 0.4:
+                        detections['buses'].append(detection)
+        
+        return detections
+    
+    def detect_objects(self, frame: np.ndarray, imgsz: Optional[int] = None) -> Dict:
+        """
+        Детекция объектов на кадре
+        Оптимизировано для работы с HD кадрами
+        
+        Args:
+            frame: numpy array изображения в формате BGR
+            imgsz: размер входа модели (для кадра, декодированного с уменьшением, -
+                размер для исходного кадра); по умолчанию выбирается по кадру
+            
+        Returns:
+            Словарь с результатами детекции
+        """
+        results = self._predict(frame, imgsz or self._select_imgsz(frame))
+        detections = self._parse_result(results[0] if len(results) > 0 else None, frame)
+        
+        # Сохраняем в историю для сглаживания
+        self._record_history(detections)
+        
+        return detections
+    
+    def detect_objects_batch(self, frames: List[np.ndarray],
+                             imgsz: Optional[List[Optional[int]]] = None) -> List[Dict]:
+        """
+        Детекция объектов на нескольких кадрах батчами (например, снимки всех камер)
+        Кадры группируются по размеру входа модели, каждая группа - один прогон
+        не более DETECTION_BATCH_SIZE кадров. История сглаживания не обновляется:
+        кадры относятся к разным камерам
+        
+        Args:
+            frames: список кадров в формате BGR
+            imgsz: размеры входа модели по кадрам (None - выбор по кадру)
+            
+        Returns:
+            Список словарей детекций в порядке кадров
+        """
+        detections: List[Optional[Dict]] = [None] * len(frames)
+        
+        groups: Dict[int, List[int]] = {}
+        for index, frame in enumerate(frames):
+            size = imgsz[index] if imgsz else None
+            groups.setdefault(size or self._select_imgsz(frame), []).append(index)
+        
+        batch_size = max(1, settings.DETECTION_BATCH_SIZE)
+        for size, indices in groups.items():
+            for start in range(0, len(indices), batch_size):
+                chunk = indices[start:start + batch_size]
+                results = self._predict([frames[i] for i in chunk], size)
+                for i, result in zip(chunk, results):
+                    detections[i] = self._parse_result(result, frames[i])
+        
+        return [d if d is not None else self._parse_result(None, frames[i]) for i, d in enumerate(detections)]
+    
+    def recognize_bus_number(self, frame: np.ndarray, bus_bbox: Tuple[int, int, int, int]) -> Optional[str]:
+        """
+        Распознавание номера автобуса
+        Оптимизировано для работы с HD кадрами - лучшее качество распознавания
+        
+        Args:
+            frame: кадр изображения (HD качество)
+            bus_bbox: координаты автобуса (x1, y1, x2, y2)
+            
+        Returns:
+            Распознанный номер автобуса или None
+        """
+        x1, y1, x2, y2 = map(int, bus_bbox)
+        
+        # Извлечение области автобуса с небольшим отступом для лучшего распознавания
+        padding = 10
+        x1 = max(0, x1 - padding)
+        y1 = max(0, y1 - padding)
+        x2 = min(frame.shape[1], x2 + padding)
+        y2 = min(frame.shape[0], y2 + padding)
+        
+        bus_roi = frame[y1:y2, x1:x2]
+        
+        if bus_roi.size == 0:
+            return None
+        
+        # Для HD кадров можно увеличить размер области для лучшего распознавания
+        h, w = bus_roi.shape[:2]
+        if h < 50 or w < 50:
+            # Увеличиваем маленькие области
+            scale = max(2.0, 100.0 / max(h, w))
+            new_h, new_w = int(h * scale), int(w * scale)
+            bus_roi = cv2.resize(bus_roi, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
+        
+        # Увеличение контрастности для лучшего распознавания
+        gray = cv2.cvtColor(bus_roi, cv2.COLOR_BGR2GRAY)
+        
+        # Улучшение изображения с более агрессивными настройками для HD
+        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
+        enhanced = clahe.apply(gray)
+        
+        # Дополнительное улучшение резкости для HD кадров
+        kernel = np.array([[-1,-1,-1], [-1,9,-1], [-1,-1,-1]])
+        sharpened = cv2.filter2D(enhanced, -1, kernel)
+        
+        # Бинаризация для лучшего распознавания текста
+        _, binary = cv2.threshold(sharpened, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        
+        # Попытка распознавания через EasyOCR
+        # Для HD кадров используем более высокий порог уверенности
+        if self.ocr_reader is not None:
+            try:
+                # Используем оба варианта: бинарное и улучшенное изображение
+                with self._ocr_lock:
+                    results_binary = self.ocr_reader.readtext(binary)
+                    results_enhanced = self.ocr_reader.readtext(enhanced)
+                
+                # Объединяем результаты
+                all_results = results_binary + results_enhanced
+                
+                for (bbox, text, confidence) in all_results:
+                    # Для HD кадров можно использовать более высокий порог
+                    if confidence > 0.6:  # Повышенный порог для HD
+                        # Очистка текста от лишних символов
+                        cleaned_text = re.sub(r'[^0-9А-ЯA-Z]', '', text.upper())
+                        if len(cleaned_text) >= 2:  # Номер должен быть минимум 2 символа
+                            return cleaned_text
+            except Exception as e:
+                print(f"Ошибка EasyOCR: {e}")
+        
+        # Попытка распознавания через Tesseract
+        if TESSERACT_AVAILABLE:
+            try:
+                text = pytesseract.image_to_string(binary, config='--psm 7 -c tessedit_char_whitelist=0123456789АБВГДЕЖЗИКЛМНОПРСТУФХЦЧШЩЭЮЯ')
+                cleaned_text = re.sub(r'[^0-9А-ЯA-Z]', '', text.upper())
+                if len(cleaned_text) >= 2:
+                    return cleaned_text
+            except Exception as e:
+                print(f"Ошибка Tesseract: {e}")
+        
+        return None
+
+
+def create_cv_service() -> BaseCVService:
+    """Локальные модели или клиент сервиса инференса (если задан INFERENCE_URL)"""
+    if settings.INFERENCE_URL:
+        from services.inference_client import RemoteCVService
+        return RemoteCVService(settings.INFERENCE_URL)
+    return CVService()
 
+
+# Глобальный экземпляр сервиса
+cv_service = create_cv_service()
@@ -0,0 +1,161 @@
+"""
+Публикация результатов детекции воркеров в шину событий
+Процессы API получают готовые детекции по камерам и остановкам и
+передают их клиентам без собственного инференса. Последние детекции
+камеры дополнительно хранятся в Redis DETECTION_BUS_MAX_AGE секунд:
+обработчики API (поток камеры, снимки) рисуют их на своих кадрах
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core.config import settings
+from core.cache import get_redis
+from services.event_bus import publish, camera_channel, stop_channel
+
+
+def latest_key(camera_id: str) -> str:
+    return f"detections:latest:{camera_id}"
+
+
+def _boxes(items: List[Dict], with_number: bool = False) -> List[Dict]:
+    result = []
+    for item in items:
+        box = {"bbox": [round(float(v), 1) for v in item["bbox"]], "confidence": round(float(item["confidence"]), 3)}
+        if with_number:
+            box["bus_number"] = item.get("bus_number")
+        result.append(box)
+    return result
+
+
+def _draw(frame: np.ndarray, people: List[Dict], buses: List[Dict]) -> np.ndarray:
+    # Импорт здесь: модуль подключается и в процессах API, где модели не нужны
+    from services.cv_service import cv_service
+    return cv_service.draw_detections(frame, {"people": people, "buses": buses})
+
+
+def encode_preview(frame: np.ndarray, people: List[Dict], buses: List[Dict]) -> Optional[str]:
+    """Аннотированный уменьшенный JPEG кадра в base64 (для публикации вместе с детекциями)"""
+    try:
+        annotated = _draw(frame, people, buses)
+        h, w = annotated.shape[:2]
+        width = settings.DETECTION_BUS_FRAME_WIDTH
+        if width and w > width:
+            annotated = cv2.resize(annotated, (width, int(h * width / w)), interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode('.jpg', annotated, [cv2.IMWRITE_JPEG_QUALITY, settings.DETECTION_BUS_FRAME_QUALITY])
+        if not ok:
+            return None
+        return base64.b64encode(encoded.tobytes()).decode("ascii")
+    except Exception as e:
+        print(f"[DETECTION BUS] Не удалось закодировать кадр: {e}")
+        return None
+
+
+def publish_camera_detections(camera_id: str, frame: Optional[np.ndarray], people: List[Dict],
+                              buses: List[Dict], stops: Optional[List[Dict]] = None,
+                              captured_at: Optional[datetime] = None,
+                              frame_shape: Optional[Tuple[int, ...]] = None) -> bool:
+    """
+    Детекции кадра камеры
+    Args:
+        people, buses: детекции в координатах кадра (buses - с распознанными номерами)
+        stops: [{"stop_id", "people_count", "buses_count"}] для остановок камеры
+        frame_shape: размер кадра, если сам кадр не передается
+    """
+    if frame is not None:
+        frame_shape = frame.shape
+    message = {
+        "type": "detections",
+        "camera_id": camera_id,
+        "captured_at": (captured_at or datetime.now()).isoformat(),
+        "frame_shape": list(frame_shape[:2]) if frame_shape is not None else None,
+        "people_count": len(people),
+        "buses_count": len(buses),
+        "people": _boxes(people),
+        "buses": _boxes(buses, with_number=True),
+        "stops": stops or [],
+    }
+    try:
+        get_redis().set(latest_key(camera_id), json.dumps(message, default=str),
+                        ex=max(1, int(settings.DETECTION_BUS_MAX_AGE)))
+    except Exception as e:
+        print(f"[DETECTION BUS] Не удалось сохранить последние детекции камеры {camera_id}: {e}")
+    if settings.DETECTION_BUS_FRAMES and frame is not None:
+        message["jpeg"] = encode_preview(frame, people, buses)
+    return publish(camera_channel(camera_id), message)
+
+
+def latest_camera_detections(camera_id: str) -> Optional[Dict]:
+    """Последнее сообщение detections камеры от воркеров (не старше DETECTION_BUS_MAX_AGE) или None"""
+    try:
+        data = get_redis().get(latest_key(camera_id))
+    except Exception as e:
+        print(f"[DETECTION BUS] Ошибка чтения последних детекций камеры {camera_id}: {e}")
+        return None
+    return json.loads(data) if data else None
+
+
+def scale_detections(message: Dict, frame_shape: Tuple[int, ...]) -> Dict:
+    """
+    Детекции сообщения в формате detect_objects для кадра размера frame_shape
+    (кадр видеопотока API может отличаться разрешением от снимка воркера)
+    """
+    height, width = frame_shape[:2]
+    source_height, source_width = message.get("frame_shape") or (height, width)
+    scale_x = width / source_width
+    scale_y = height / source_height
+
+    def scale(items):
+        return [
+            dict(item, bbox=[
+                item["bbox"][0] * scale_x, item["bbox"][1] * scale_y,
+                item["bbox"][2] * scale_x, item["bbox"][3] * scale_y
+            ])
+            for item in items
+        ]
+
+    return {
+        "people": scale(message["people"]),
+        "buses": scale(message["buses"]),
+        "timestamp": datetime.fromisoformat(message["captured_at"]),
+        "frame_shape": tuple(frame_shape),
+    }
+
+
+def camera_detections(camera_id: str, frame: np.ndarray,
+                      detect: Optional[Callable[[], Dict]] = None) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    Детекции кадра камеры для обработчиков API
+    Результаты воркеров в приоритете; без них модель запускается в процессе API
+    (detect или detect_objects), только если API_LOCAL_INFERENCE
+    Returns:
+        (детекции или None, источник: "worker", "local" или None)
+    """
+    message = latest_camera_detections(camera_id)
+    if message is not None:
+        return scale_detections(message, frame.shape), "worker"
+    if not settings.API_LOCAL_INFERENCE:
+        return None, None
+    if detect is None:
+        from services.cv_service import cv_service
+        return cv_service.detect_objects(frame), "local"
+    return detect(), "local"
+
+
+def publish_stop_detections(stop_id: int, camera_id: Optional[str], results: Dict) -> bool:
+    """Результаты по зоне остановки (формат process_video_frame / build_zone_results)"""
+    timestamp = results.get("timestamp") or datetime.now()
+    return publish(stop_channel(stop_id), {
+        "type": "stop_detections",
+        "stop_id": stop_id,
+        "camera_id": camera_id,
+        "captured_at": timestamp.isoformat(),
+        "people_count": int(results["people_count"]),
+        "buses_count": int(results.get("buses_count", 0)),
+        "stop_zone": list(results["stop_zone"]) if results.get("stop_zone") else None,
+        "buses": _boxes(results.get("buses", []), with_number=True),
+    })
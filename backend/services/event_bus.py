@@ -0,0 +1,135 @@
+"""
+Шина событий между воркерами и процессами API через Redis pub/sub
+Воркеры публикуют события синхронно, каждый процесс API держит одну подписку
+и раздает сообщения своим клиентам (SSE/WebSocket) через очереди asyncio
+"""
+import asyncio
+import json
+from typing import Dict, Optional, Set
+
+from core.cache import get_redis, get_async_redis
+
+# Обновления загруженности остановок (после записи результатов мониторинга)
+STOP_LOAD_CHANNEL = "events:stop_load"
+
+# Размер очереди клиента; медленный клиент теряет самые старые события
+SUBSCRIBER_QUEUE_SIZE = 32
+RECONNECT_DELAY = 1.0
+
+
+def camera_channel(camera_id: str) -> str:
+    """Результаты детекции по кадрам камеры"""
+    return f"events:detections:camera:{camera_id}"
+
+
+def stop_channel(stop_id: int) -> str:
+    """Результаты детекции по зоне остановки"""
+    return f"events:detections:stop:{stop_id}"
+
+
+def new_queue() -> asyncio.Queue:
+    """Очередь клиента; одну очередь можно подписать на несколько каналов"""
+    return asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+
+def publish(channel: str, message: Dict) -> bool:
+    """Публикация события (для синхронного кода: задачи Celery, сервисы)"""
+    try:
+        get_redis().publish(channel, json.dumps(message, default=str))
+        return True
+    except Exception as e:
+        print(f"[EVENT BUS] Не удалось опубликовать событие в {channel}: {e}")
+        return False
+
+
+class EventRelay:
+    """
+    Одна подписка Redis на процесс API с раздачей событий локальным клиентам
+    Каналы Redis подписываются при появлении первого клиента и отписываются
+    после ухода последнего
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._pubsub = None
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    async def subscribe(self, channel: str, queue: Optional[asyncio.Queue] = None) -> asyncio.Queue:
+        queue = queue if queue is not None else new_queue()
+        async with self._lock:
+            first = channel not in self._subscribers
+            self._subscribers.setdefault(channel, set()).add(queue)
+            if self._task is None or self._task.done():
+                self._task = asyncio.create_task(self._run())
+            elif first and self._pubsub is not None:
+                try:
+                    await self._pubsub.subscribe(channel)
+                except Exception as e:
+                    # Подписка восстановится при переподключении
+                    print(f"[EVENT BUS] Ошибка подписки на {channel}: {e}")
+        return queue
+
+    async def unsubscribe(self, channel: str, queue: asyncio.Queue):
+        async with self._lock:
+            queues = self._subscribers.get(channel)
+            if queues is None:
+                return
+            queues.discard(queue)
+            if queues:
+                return
+            del self._subscribers[channel]
+            if self._pubsub is not None:
+                try:
+                    await self._pubsub.unsubscribe(channel)
+                except Exception:
+                    pass
+
+    def _dispatch(self, channel: str, data: bytes):
+        try:
+            message = json.loads(data)
+        except ValueError:
+            return
+        for queue in list(self._subscribers.get(channel, ())):
+            if queue.full():
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            queue.put_nowait(message)
+
+    async def _run(self):
+        """Чтение подписки с переподключением; завершается, когда клиентов не осталось"""
+        while self._subscribers:
+            pubsub = get_async_redis().pubsub()
+            try:
+                async with self._lock:
+                    channels = list(self._subscribers.keys())
+                    if not channels:
+                        break
+                    await pubsub.subscribe(*channels)
+                    self._pubsub = pubsub
+
+                while self._subscribers:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is None or message.get("type") != "message":
+                        continue
+                    channel = message["channel"]
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    self._dispatch(channel, message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[EVENT BUS] Подписка прервана: {e}, переподключение через {RECONNECT_DELAY} с")
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                self._pubsub = None
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+
+
+# Глобальный экземпляр (используется только в процессе API)
+event_relay = EventRelay()
@@ -0,0 +1,149 @@
+"""
+Подавление повторных кадров перед детекцией
+Отпечаток кадра - уменьшенное серое изображение. Если кадр источника совпадает
+с предыдущим в пределах допуска (пауза видео в браузере, статичная сцена),
+возвращаются результаты предыдущего кадра и модель не запускается.
+Снимки камер сравниваются точно (exact): ячейка отпечатка кадра 2688x1520
+покрывает десятки пикселей, и пришедший на остановку человек меняет ее
+меньше допуска. Повтором считается только тот же снимок (кэш is74)
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core.config import settings
+
+
+class FrameFingerprint:
+    """
+    Уменьшенное серое изображение кадра и хэш для точного совпадения
+    exact - хэш всего кадра без уменьшенного изображения (совпадение только побайтно)
+    """
+
+    __slots__ = ("thumb", "digest")
+
+    def __init__(self, frame: np.ndarray, size: int, exact: bool = False):
+        if exact:
+            self.thumb = None
+            self.digest = hashlib.blake2b(np.ascontiguousarray(frame), digest_size=16).digest()
+            return
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        self.thumb = cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.int16)
+        self.digest = hashlib.blake2b(self.thumb.tobytes(), digest_size=16).digest()
+
+    def matches(self, other: "FrameFingerprint", tolerance: int) -> bool:
+        """Совпадение: одинаковый хэш или разница каждой ячейки не больше tolerance (0..255)"""
+        if self.digest == other.digest:
+            return True
+        if self.thumb is None or other.thumb is None or self.thumb.shape != other.thumb.shape:
+            return False
+        return int(np.abs(self.thumb - other.thumb).max()) <= tolerance
+
+
+class DuplicateFrameFilter:
+    """
+    Последний отпечаток и результат детекции по каждому источнику
+    Источник - камера, зона остановки или соединение WebSocket. Результат
+    повторного кадра не используется дольше max_age секунд
+    """
+
+    def __init__(self, tolerance: Optional[int] = None, size: Optional[int] = None,
+                 max_age: Optional[float] = None, max_sources: int = 1024):
+        self.enabled = settings.FRAME_DEDUP_ENABLED
+        self.tolerance = tolerance if tolerance is not None else settings.FRAME_DEDUP_TOLERANCE
+        self.size = size or settings.FRAME_DEDUP_SIZE
+        self.max_age = max_age or settings.FRAME_DEDUP_MAX_AGE
+        self.max_sources = max_sources
+        # source -> (отпечаток, результат, время результата)
+        self._entries: "OrderedDict[Hashable, Tuple[FrameFingerprint, Any, float]]" = OrderedDict()
+        # Тип источника (первый элемент ключа) -> {"checked", "duplicates"}
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _kind(source: Hashable) -> str:
+        return str(source[0]) if isinstance(source, tuple) else str(source)
+
+    def _count(self, source: Hashable, duplicate: bool):
+        counters = self._counters.setdefault(self._kind(source), {"checked": 0, "duplicates": 0})
+        counters["checked"] += 1
+        if duplicate:
+            counters["duplicates"] += 1
+
+    def check(self, source: Hashable, frame: np.ndarray,
+              exact: bool = False) -> Tuple[Optional[FrameFingerprint], Any]:
+        """
+        Проверка кадра источника
+        Args:
+            exact: повтором считается только тот же кадр (снимки камер мониторинга)
+        Returns:
+            (отпечаток для remember, результат предыдущего кадра или None)
+        """
+        if not self.enabled:
+            return None, None
+        fingerprint = FrameFingerprint(frame, self.size, exact)
+        with self._lock:
+            entry = self._entries.get(source)
+            duplicate = (
+                entry is not None
+                and time.monotonic() - entry[2] <= self.max_age
+                and fingerprint.matches(entry[0], self.tolerance)
+            )
+            self._count(source, duplicate)
+            if duplicate:
+                self._entries.move_to_end(source)
+                return fingerprint, entry[1]
+        return fingerprint, None
+
+    def remember(self, source: Hashable, fingerprint: Optional[FrameFingerprint], result: Any):
+        """Результат детекции кадра с отпечатком fingerprint"""
+        if fingerprint is None:
+            return
+        with self._lock:
+            self._entries[source] = (fingerprint, result, time.monotonic())
+            self._entries.move_to_end(source)
+            while len(self._entries) > self.max_sources:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, source: Hashable, frame: np.ndarray, compute: Callable[[], Any],
+                       exact: bool = False) -> Tuple[Any, bool]:
+        """
+        Результат для кадра: предыдущий при повторе, иначе compute()
+        Returns:
+            (результат, повторный ли кадр)
+        """
+        fingerprint, cached = self.check(source, frame, exact)
+        if cached is not None:
+            return cached, True
+        result = compute()
+        self.remember(source, fingerprint, result)
+        return result, False
+
+    def forget(self, source: Hashable):
+        with self._lock:
+            self._entries.pop(source, None)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            counters = {kind: dict(values) for kind, values in self._counters.items()}
+            sources = len(self._entries)
+        checked = sum(values["checked"] for values in counters.values())
+        duplicates = sum(values["duplicates"] for values in counters.values())
+        return {
+            "enabled": self.enabled,
+            "checked": checked,
+            "duplicates": duplicates,
+            # Доля кадров, для которых детекция не выполнялась
+            "saved_ratio": round(duplicates / checked, 3) if checked else 0.0,
+            "sources": sources,
+            "by_source": counters,
+        }
+
+
+# Глобальный экземпляр фильтра процесса
+frame_dedup = DuplicateFrameFilter()
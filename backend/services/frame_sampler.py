@@ -0,0 +1,141 @@
+"""
+Отбор кадров видеопотока с заданной частотой
+Решение о кадре принимается по часам потока (метка времени кадра), а не по
+номеру кадра: частота анализа не зависит от фактического FPS камеры.
+Невыбранные кадры только захватываются (grab) без декодирования
+"""
+import time
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from services.frame_transport import FrameRing
+
+# Сколько захватов подряд метка времени может не меняться, прежде чем отбор
+# перейдет на монотонные часы (поток не передает метки времени)
+STALL_LIMIT = 5
+
+# Скачок часов потока больше этого значения (перемотка, новый поток) начинает расписание заново, с
+MAX_CLOCK_JUMP = 10.0
+
+# Допуск сравнения со сроком отсчета: метки кадров округлены до миллисекунд
+DUE_TOLERANCE = 0.001
+
+
+class FrameSampler:
+    """
+    Отбор кадров с частотой fps по часам потока
+    Часы потока - CAP_PROP_POS_MSEC захваченного кадра. Для файлов это время
+    видео, поэтому отбор не зависит от скорости чтения; для камер - метки RTP,
+    поэтому неравномерная доставка кадров не меняет частоту анализа. Если метки
+    не меняются, используются монотонные часы процесса
+    """
+
+    def __init__(self, fps: float, ring: Optional[FrameRing] = None):
+        self.set_fps(fps)
+        # Кольцевой буфер в разделяемой памяти: отобранные кадры декодируются сразу в его слоты
+        self.ring = ring
+        self.use_stream_clock = True
+        self.grabbed = 0
+        self.decoded = 0
+        self.skipped = 0
+        # Время последнего отобранного кадра по используемым часам, с
+        self.timestamp: Optional[float] = None
+
+        self._next_due: Optional[float] = None
+        self._last_pos: Optional[float] = None
+        self._stalled = 0
+
+    def set_fps(self, fps: float):
+        """Изменение частоты отбора; расписание продолжается от последнего кадра"""
+        if fps <= 0:
+            raise ValueError("Частота отбора кадров должна быть положительной")
+        self.fps = fps
+        self.interval = 1.0 / fps
+
+    def reset(self, start: Optional[float] = None):
+        """
+        Новое расписание (например, после переподключения к потоку)
+        start - первый отсчет по часам потока: более ранние кадры пропускаются
+        (перемотка файла останавливается на ключевом кадре до нужной позиции)
+        """
+        self._next_due = start
+        self._last_pos = None
+        self._stalled = 0
+
+    def _clock(self, cap: cv2.VideoCapture) -> float:
+        if self.use_stream_clock:
+            pos = cap.get(cv2.CAP_PROP_POS_MSEC)
+            if pos >= 0 and pos != self._last_pos:
+                seconds = pos / 1000.0
+                if self._last_pos is not None:
+                    jump = seconds - self._last_pos / 1000.0
+                    if jump < 0 or jump > MAX_CLOCK_JUMP:
+                        self._next_due = None
+                self._last_pos = pos
+                self._stalled = 0
+                return seconds
+            self._stalled += 1
+            if self._stalled < STALL_LIMIT and self._last_pos is not None:
+                # Метка повторилась: кадр считается одновременным с предыдущим
+                return self._last_pos / 1000.0
+            if self._stalled >= STALL_LIMIT:
+                print("[SAMPLER] Поток не передает метки времени, отбор кадров по часам процесса")
+                self.use_stream_clock = False
+                self._next_due = None
+        return time.monotonic()
+
+    def _due(self, now: float) -> bool:
+        if self._next_due is not None and now < self._next_due - DUE_TOLERANCE:
+            return False
+        # Срок следующего отсчета от предыдущего срока: сетка не сдвигается, отставание не накапливается.
+        # После разрыва больше интервала (кадры не приходили) сетка начинается от текущего кадра,
+        # иначе следующий кадр тоже оказался бы просроченным и был бы отобран сразу
+        if self._next_due is None or now - self._next_due >= self.interval:
+            self._next_due = now + self.interval
+        else:
+            self._next_due += self.interval
+        return True
+
+    def grab(self, cap: cv2.VideoCapture) -> bool:
+        """Захват кадра без отбора и декодирования (когда кадры никому не нужны)"""
+        if not cap.grab():
+            return False
+        self.grabbed += 1
+        self.skipped += 1
+        return True
+
+    def read(self, cap: cv2.VideoCapture) -> Tuple[bool, Optional[np.ndarray]]:
+        """
+        Захват следующего кадра потока
+        Returns:
+            (False, None) - поток закончился или кадр не декодировался;
+            (True, None) - кадр пропущен без декодирования;
+            (True, frame) - отобранный кадр
+        """
+        if not cap.grab():
+            return False, None
+        self.grabbed += 1
+        now = self._clock(cap)
+        if not self._due(now):
+            self.skipped += 1
+            return True, None
+        ret, frame = self.ring.capture(cap) if self.ring is not None else cap.retrieve()
+        if not ret or frame is None:
+            return False, None
+        self.decoded += 1
+        self.timestamp = now
+        return True, frame
+
+    def snapshot(self) -> Dict:
+        stats = {
+            "fps": self.fps,
+            "clock": "stream" if self.use_stream_clock else "monotonic",
+            "grabbed": self.grabbed,
+            "decoded": self.decoded,
+            "skipped": self.skipped,
+        }
+        if self.ring is not None:
+            stats["ring"] = self.ring.snapshot()
+        return stats
@@ -0,0 +1,127 @@
+"""
+Временное хранилище кадров для задач Celery
+API кладет изображение в хранилище и передает задаче только ссылку, поэтому
+кадры не проходят через брокер и не сериализуются в сообщение задачи.
+Бэкенды: Redis с TTL (общий для всех хостов) или файлы в tmpfs (/dev/shm)
+для воркеров на одном хосте с API
+"""
+import os
+import tempfile
+import time
+import uuid
+from typing import Optional
+
+from core.config import settings
+from core.cache import get_redis
+
+
+class RedisFrameStore:
+    """Кадры в Redis; ключ удаляется при чтении задачей или по TTL"""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(frame_id: str) -> str:
+        return f"frame_blob:{frame_id}"
+
+    def put(self, frame_id: str, data: bytes):
+        get_redis().set(self._key(frame_id), data, ex=self.ttl)
+
+    def take(self, frame_id: str) -> Optional[bytes]:
+        return get_redis().getdel(self._key(frame_id))
+
+
+class FileFrameStore:
+    """
+    Кадры в файлах каталога на tmpfs
+    Запись во временный файл и os.replace; просроченные файлы (задача не
+    выполнилась) удаляются при записи новых кадров
+    """
+
+    def __init__(self, directory: str, ttl: int):
+        self.directory = directory
+        self.ttl = ttl
+        self._last_cleanup = 0.0
+
+    def _path(self, frame_id: str) -> str:
+        return os.path.join(self.directory, f"frame_{frame_id}.bin")
+
+    def _cleanup(self):
+        now = time.time()
+        if now - self._last_cleanup < self.ttl:
+            return
+        self._last_cleanup = now
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def put(self, frame_id: str, data: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        self._cleanup()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".frame_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(frame_id))
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def take(self, frame_id: str) -> Optional[bytes]:
+        path = self._path(frame_id)
+        try:
+            with open(path, "rb") as f:
+                age = time.time() - os.fstat(f.fileno()).st_mtime
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return data if age <= self.ttl else None
+
+
+def create_frame_store():
+    if settings.FRAME_STORE_BACKEND == "file":
+        return FileFrameStore(settings.FRAME_STORE_DIR, settings.FRAME_STORE_TTL)
+    return RedisFrameStore(settings.FRAME_STORE_TTL)
+
+
+class FrameStore:
+    """Обертка над бэкендом: ссылки на кадры и единая обработка ошибок"""
+
+    def __init__(self):
+        self.backend = create_frame_store()
+
+    def put(self, data: bytes) -> str:
+        """
+        Сохранение кадра
+        Returns:
+            Ссылка на кадр для передачи в задачу
+        Raises:
+            Исключение бэкенда, если кадр не удалось сохранить
+        """
+        frame_id = uuid.uuid4().hex
+        self.backend.put(frame_id, data)
+        return frame_id
+
+    def take(self, frame_ref: str) -> Optional[bytes]:
+        """Кадр по ссылке с удалением из хранилища; None - кадр истек или недоступен"""
+        try:
+            return self.backend.take(frame_ref)
+        except Exception as e:
+            print(f"[FRAME STORE] Ошибка чтения кадра {frame_ref}: {e}")
+            return None
+
+
+# Глобальный экземпляр хранилища
+frame_store = FrameStore()
@@ -0,0 +1,346 @@
+"""
+Передача кадров между процессами одного хоста
+Клиент записывает кадры в свой сегмент разделяемой памяти и передает ссылки
+{"shm", "offset", "shape"}; сервис читает их без кодирования JPEG.
+Захват потоков декодирует кадры сразу в кольцевой буфер камеры (FrameRing),
+такие кадры передаются ссылкой на слот без копирования.
+Если сегмент недоступен (другой хост или контейнер без общего /dev/shm),
+кадры передаются как JPEG в base64
+"""
+import atexit
+import base64
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core.config import settings
+
+# Выравнивание заголовка кольцевого буфера и начала слотов
+RING_ALIGNMENT = 64
+
+
+class FrameRefError(Exception):
+    """Ссылка на кадр не может быть прочитана (сегмент недоступен или поврежден)"""
+    pass
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """Подключение к чужому сегменту без регистрации в resource_tracker"""
+    segment = shared_memory.SharedMemory(name=name)
+    # До Python 3.13 resource_tracker удаляет подключенные сегменты при выходе процесса,
+    # хотя ими владеет клиент
+    try:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    except Exception:
+        pass
+    return segment
+
+
+def encode_jpeg_ref(frame: np.ndarray, quality: int) -> Dict:
+    ok, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Не удалось закодировать кадр в JPEG")
+    return {"jpeg": base64.b64encode(encoded.tobytes()).decode("ascii")}
+
+
+class SharedFrameWriter:
+    """
+    Сегменты разделяемой памяти клиента, по одному на поток
+    Сегмент переиспользуется между запросами и увеличивается при необходимости;
+    содержимое не меняется, пока поток ждет ответа сервиса
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        # (pid создателя, сегмент): после fork дочерний процесс не трогает сегменты родителя
+        self._segments: List[Tuple[int, shared_memory.SharedMemory]] = []
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _segment(self, size: int) -> shared_memory.SharedMemory:
+        pid = os.getpid()
+        old = getattr(self._local, "segment", None)
+        if getattr(self._local, "pid", None) != pid:
+            old = None
+        if old is not None and old.size >= size:
+            return old
+        # Запас, чтобы не пересоздавать сегмент при небольшом росте кадров
+        segment = shared_memory.SharedMemory(create=True, size=int(size * 1.25))
+        self._local.segment = segment
+        self._local.pid = pid
+        with self._lock:
+            self._segments.append((pid, segment))
+            if old is not None:
+                self._segments.remove((pid, old))
+        if old is not None:
+            self._release(old)
+        return segment
+
+    def write(self, frames: List[np.ndarray]) -> List[Dict]:
+        """Запись кадров подряд в сегмент потока; возвращает ссылки на кадры"""
+        frames = [np.ascontiguousarray(frame, dtype=np.uint8) for frame in frames]
+        segment = self._segment(sum(frame.nbytes for frame in frames))
+        refs = []
+        offset = 0
+        for frame in frames:
+            target = np.ndarray(frame.shape, dtype=np.uint8, buffer=segment.buf, offset=offset)
+            target[...] = frame
+            refs.append({"shm": segment.name, "offset": offset, "shape": list(frame.shape)})
+            offset += frame.nbytes
+        return refs
+
+    @staticmethod
+    def _release(segment: shared_memory.SharedMemory):
+        try:
+            segment.close()
+            segment.unlink()
+        except Exception:
+            pass
+
+    def close(self):
+        pid = os.getpid()
+        with self._lock:
+            own = [segment for owner, segment in self._segments if owner == pid]
+            self._segments = [item for item in self._segments if item[0] != pid]
+        for segment in own:
+            self._release(segment)
+
+
+class RingFrame(np.ndarray):
+    """
+    Кадр в слоте FrameRing; ref - ссылка на слот для сервиса инференса
+    Срезы и производные массивы ссылки не наследуют, но удерживают слот,
+    пока существуют (base указывает на кадр)
+    """
+
+    def __array_finalize__(self, obj):
+        self.ref: Optional[Dict] = None
+
+
+class FrameRing:
+    """
+    Кольцевой буфер кадров одного потока в разделяемой памяти
+    Декодер пишет кадр прямо в свободный слот (cap.retrieve в представление
+    слота), сервис инференса читает слот по ссылке без копирования.
+    Слот занят, пока в процессе есть ссылки на его кадр, и не перезаписывается.
+    Заголовок сегмента - номера кадров в слотах (int64): по ним сервис
+    отклоняет устаревшие ссылки
+    """
+
+    def __init__(self, slots: int):
+        self.slots = max(2, slots)
+        self.shape: Optional[Tuple[int, ...]] = None
+        self.written = 0
+        self.misses = 0  # Все слоты заняты - кадр размещен в обычной памяти
+
+        self.segment: Optional[shared_memory.SharedMemory] = None
+        self._seqs: Optional[np.ndarray] = None
+        self._views: List[np.ndarray] = []
+        self._pinned: List[bool] = []
+        self._header = 0
+        self._frame_bytes = 0
+        self._seq = 0
+        self._cursor = 0
+        self._retired: List[shared_memory.SharedMemory] = []
+        self._lock = threading.Lock()
+
+    def _allocate(self, shape: Tuple[int, ...]):
+        """Новый сегмент под размер кадра (первый кадр или смена разрешения)"""
+        self._release()
+        self._frame_bytes = int(np.prod(shape))
+        self._header = -(-8 * self.slots // RING_ALIGNMENT) * RING_ALIGNMENT
+        segment = shared_memory.SharedMemory(create=True, size=self._header + self.slots * self._frame_bytes)
+        self._seqs = np.ndarray((self.slots,), dtype=np.int64, buffer=segment.buf)
+        self._seqs[:] = 0
+        self._views = [
+            np.ndarray(shape, dtype=np.uint8, buffer=segment.buf, offset=self._header + slot * self._frame_bytes)
+            for slot in range(self.slots)
+        ]
+        with self._lock:
+            self._pinned = [False] * self.slots
+            self._cursor = 0
+        self.segment = segment
+        self.shape = tuple(shape)
+
+    def _acquire(self) -> Optional[int]:
+        if self.segment is None:
+            return None
+        with self._lock:
+            for i in range(self.slots):
+                slot = (self._cursor + i) % self.slots
+                if not self._pinned[slot]:
+                    self._pinned[slot] = True
+                    self._cursor = slot + 1
+                    return slot
+        return None
+
+    def _unpin(self, name: str, slot: int):
+        with self._lock:
+            if self.segment is not None and self.segment.name == name:
+                self._pinned[slot] = False
+
+    def _commit(self, slot: int) -> RingFrame:
+        self._seq += 1
+        self._seqs[slot] = self._seq
+        frame = self._views[slot].view(RingFrame)
+        frame.ref = {
+            "shm": self.segment.name,
+            "offset": self._header + slot * self._frame_bytes,
+            "shape": list(self.shape),
+            "slot": slot,
+            "seq": self._seq,
+        }
+        # Слот освобождается, когда на кадр не остается ссылок
+        weakref.finalize(frame, self._unpin, self.segment.name, slot)
+        self.written += 1
+        return frame
+
+    def capture(self, cap: cv2.VideoCapture) -> Tuple[bool, Optional[np.ndarray]]:
+        """
+        cap.retrieve() в свободный слот
+        Returns:
+            (ret, кадр); кадр - RingFrame или обычный массив, если слот не нашелся
+        """
+        slot = self._acquire()
+        target = None
+        if slot is not None:
+            # Номер 0 - слот перезаписывается, старые ссылки на него недействительны
+            self._seqs[slot] = 0
+            target = self._views[slot]
+        ret, frame = cap.retrieve(target) if target is not None else cap.retrieve()
+        if not ret or frame is None:
+            if slot is not None:
+                self._unpin(self.segment.name, slot)
+            return False, None
+        if target is not None and frame.ctypes.data == target.ctypes.data:
+            return True, self._commit(slot)
+
+        # Декодер выделил новый кадр: первый кадр, смена разрешения или все слоты заняты
+        if slot is not None:
+            self._unpin(self.segment.name, slot)
+        if frame.dtype != np.uint8:
+            return True, frame
+        if frame.shape != self.shape:
+            self._allocate(frame.shape)
+        slot = self._acquire()
+        if slot is None:
+            self.misses += 1
+            return True, frame
+        self._seqs[slot] = 0
+        self._views[slot][...] = frame
+        return True, self._commit(slot)
+
+    def _release(self):
+        """Удаление текущего сегмента; сегменты с живыми кадрами закрываются позже"""
+        segment = self.segment
+        self.segment = None
+        self._seqs = None
+        self._views = []
+        if segment is not None:
+            try:
+                segment.unlink()
+            except Exception:
+                pass
+            self._retired.append(segment)
+        retired = []
+        for old in self._retired:
+            try:
+                old.close()
+            except BufferError:
+                # Кадры сегмента еще используются
+                retired.append(old)
+            except Exception:
+                pass
+        self._retired = retired
+
+    def close(self):
+        self._release()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            pinned = sum(self._pinned)
+        return {"slots": self.slots, "pinned": pinned, "written": self.written, "misses": self.misses}
+
+
+def create_frame_ring() -> Optional[FrameRing]:
+    """
+    Кольцевой буфер для захвата потока, если инференс выполняется в сервисе
+    инференса и кадры передаются через разделяемую память; иначе None
+    """
+    if not settings.INFERENCE_URL or not settings.INFERENCE_SHM or settings.FRAME_RING_SLOTS <= 0:
+        return None
+    return FrameRing(settings.FRAME_RING_SLOTS)
+
+
+class SharedFrameReader:
+    """Чтение кадров по ссылкам (сторона сервиса); подключенные сегменты кэшируются"""
+
+    def __init__(self, max_segments: int = 64):
+        self.max_segments = max_segments
+        self._segments: "OrderedDict[str, shared_memory.SharedMemory]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_segment(self, name: str) -> shared_memory.SharedMemory:
+        with self._lock:
+            segment = self._segments.get(name)
+            if segment is not None:
+                self._segments.move_to_end(name)
+                return segment
+        try:
+            segment = _attach(name)
+        except (FileNotFoundError, PermissionError, OSError) as e:
+            raise FrameRefError(f"Сегмент {name} недоступен: {e}")
+        with self._lock:
+            self._segments[name] = segment
+            while len(self._segments) > self.max_segments:
+                _, old = self._segments.popitem(last=False)
+                try:
+                    old.close()
+                except Exception:
+                    pass
+        return segment
+
+    def read(self, ref: Dict) -> np.ndarray:
+        """
+        Кадр по ссылке
+        Кадры SharedFrameWriter копируются: клиент переиспользует сегмент.
+        Слоты FrameRing (ссылка с seq) читаются без копирования - клиент не
+        перезаписывает слот, пока ждет ответа
+        """
+        if "jpeg" in ref:
+            data = np.frombuffer(base64.b64decode(ref["jpeg"]), dtype=np.uint8)
+            frame = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            if frame is None:
+                raise FrameRefError("Не удалось декодировать JPEG")
+            return frame
+
+        shape = tuple(int(v) for v in ref["shape"])
+        offset = int(ref.get("offset", 0))
+        segment = self._get_segment(ref["shm"])
+        size = int(np.prod(shape))
+        if offset < 0 or offset + size > segment.size:
+            raise FrameRefError(f"Кадр выходит за границы сегмента {ref['shm']}")
+        frame = np.ndarray(shape, dtype=np.uint8, buffer=segment.buf, offset=offset)
+        if "seq" not in ref:
+            return frame.copy()
+        slot = int(ref["slot"])
+        if slot < 0 or 8 * (slot + 1) > offset:
+            raise FrameRefError(f"Некорректный слот {slot} сегмента {ref['shm']}")
+        if np.ndarray((1,), dtype=np.int64, buffer=segment.buf, offset=8 * slot)[0] != int(ref["seq"]):
+            raise FrameRefError(f"Кадр в слоте {slot} сегмента {ref['shm']} перезаписан")
+        return frame
+
+    def close(self):
+        with self._lock:
+            segments, self._segments = list(self._segments.values()), OrderedDict()
+        for segment in segments:
+            try:
+                segment.close()
+            except Exception:
+                pass
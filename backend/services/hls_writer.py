@@ -0,0 +1,186 @@
+"""
+Запись аннотированных кадров камер в скользящие HLS сегменты
+Кодирование выполняется один раз на камеру независимо от количества зрителей,
+файлы раздаются nginx как статика
+"""
+import os
+import shutil
+import subprocess
+import threading
+import time
+from typing import Dict, Optional
+
+import cv2
+import numpy as np
+
+from core.config import settings
+
+
+class HLSWriter:
+    """
+    Приемник кадров конвейера камеры, передающий их в ffmpeg
+    ffmpeg кодирует H.264 и поддерживает плейлист с ограниченным числом сегментов
+    """
+
+    def __init__(self, camera_id: str, output_dir: Optional[str] = None):
+        self.camera_id = camera_id
+        self.fps = settings.HLS_FPS
+        self.width = settings.HLS_WIDTH
+        self.output_dir = os.path.join(output_dir or settings.HLS_OUTPUT_DIR, camera_id)
+        self.playlist_path = os.path.join(self.output_dir, "index.m3u8")
+
+        self._process: Optional[subprocess.Popen] = None
+        self._frame_size = None
+        self._started_at = 0.0
+        self._frames_written = 0
+        self._lock = threading.Lock()
+
+    def _start_process(self, width: int, height: int):
+        os.makedirs(self.output_dir, exist_ok=True)
+        gop = max(1, int(self.fps * settings.HLS_SEGMENT_SECONDS))
+        command = [
+            settings.FFMPEG_PATH,
+            "-loglevel", "error",
+            "-f", "rawvideo",
+            "-pix_fmt", "bgr24",
+            "-s", f"{width}x{height}",
+            "-r", str(self.fps),
+            "-i", "-",
+            "-c:v", "libx264",
+            "-preset", "veryfast",
+            "-tune", "zerolatency",
+            "-pix_fmt", "yuv420p",
+            # Ключевой кадр на границе каждого сегмента
+            "-g", str(gop),
+            "-keyint_min", str(gop),
+            "-sc_threshold", "0",
+            "-f", "hls",
+            "-hls_time", str(settings.HLS_SEGMENT_SECONDS),
+            "-hls_list_size", str(settings.HLS_LIST_SIZE),
+            # Старые сегменты удаляются, плейлист переписывается атомарно
+            "-hls_flags", "delete_segments+independent_segments+temp_file",
+            "-hls_segment_filename", os.path.join(self.output_dir, "segment_%06d.ts"),
+            self.playlist_path,
+        ]
+        self._process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        self._frame_size = (width, height)
+        self._started_at = time.monotonic()
+        self._frames_written = 0
+        print(f"[HLS] Запущено кодирование камеры {self.camera_id} в {self.output_dir}")
+
+    def _prepare(self, frame: np.ndarray) -> np.ndarray:
+        """Уменьшение кадра до ширины HLS (четные размеры для yuv420p)"""
+        h, w = frame.shape[:2]
+        if self.width and w > self.width:
+            h, w = int(h * self.width / w), self.width
+        size = (w - w % 2, h - h % 2)
+        if size != (frame.shape[1], frame.shape[0]):
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if self._frame_size is not None and size != self._frame_size:
+            frame = cv2.resize(frame, self._frame_size, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def write(self, frame: np.ndarray, meta: Optional[Dict] = None):
+        """Запись кадра; вызывается из потока конвейера камеры"""
+        with self._lock:
+            frame = self._prepare(frame)
+            if self._process is None or self._process.poll() is not None:
+                self._start_process(frame.shape[1], frame.shape[0])
+
+            # ffmpeg получает кадры с постоянным FPS: при отставании конвейера
+            # последний кадр повторяется, чтобы время в плейлисте шло равномерно
+            expected = int((time.monotonic() - self._started_at) * self.fps) + 1
+            repeats = max(1, min(expected - self._frames_written, self.fps * 2))
+            data = np.ascontiguousarray(frame).tobytes()
+            try:
+                for _ in range(repeats):
+                    self._process.stdin.write(data)
+                self._process.stdin.flush()
+                self._frames_written += repeats
+            except (BrokenPipeError, OSError) as e:
+                print(f"[HLS] ffmpeg камеры {self.camera_id} завершился: {e}")
+                self._close_process()
+
+    def _close_process(self):
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.close()
+        except Exception:
+            pass
+        try:
+            self._process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+        self._process = None
+        self._frame_size = None
+
+    def close(self):
+        with self._lock:
+            self._close_process()
+
+
+class HLSService:
+    """Управление HLS приемниками камер процесса"""
+
+    def __init__(self):
+        self._writers: Dict[str, HLSWriter] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return settings.HLS_ENABLED and shutil.which(settings.FFMPEG_PATH) is not None
+
+    def playlist_url(self, camera_id: str) -> str:
+        return f"{settings.HLS_PUBLIC_PATH.rstrip('/')}/{camera_id}/index.m3u8"
+
+    def start(self, camera_id: str) -> HLSWriter:
+        """Запуск HLS для камеры (повторный вызов возвращает существующий приемник)"""
+        # Импорт здесь: реестр камер загружает модели CV
+        from services.camera_hub import camera_hub
+
+        with self._lock:
+            writer = self._writers.get(camera_id)
+            if writer is not None:
+                return writer
+            writer = HLSWriter(camera_id)
+            self._writers[camera_id] = writer
+        camera_hub.add_sink(camera_id, writer)
+        return writer
+
+    def stop(self, camera_id: str):
+        from services.camera_hub import camera_hub
+
+        with self._lock:
+            writer = self._writers.pop(camera_id, None)
+        if writer is not None:
+            camera_hub.remove_sink(camera_id, writer)
+            writer.close()
+
+    def is_running(self, camera_id: str) -> bool:
+        with self._lock:
+            return camera_id in self._writers
+
+    def start_configured(self):
+        """Запуск HLS для камер из настроек (все камеры, если список пуст)"""
+        from core.cameras import IS74_CAMERAS
+
+        if not self.available:
+            if settings.HLS_ENABLED:
+                print(f"[HLS] ffmpeg не найден ({settings.FFMPEG_PATH}), HLS отключен")
+            return
+        for camera_id in settings.HLS_CAMERAS or list(IS74_CAMERAS.keys()):
+            if camera_id in IS74_CAMERAS:
+                self.start(camera_id)
+
+    def stop_all(self):
+        with self._lock:
+            camera_ids = list(self._writers.keys())
+        for camera_id in camera_ids:
+            self.stop(camera_id)
+
+
+# Глобальный экземпляр сервиса
+hls_service = HLSService()
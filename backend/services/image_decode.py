@@ -0,0 +1,186 @@
+"""
+Декодирование JPEG для детекции с уменьшением разрешения
+YOLO все равно уменьшает кадр до размера входа модели (imgsz), поэтому кадр
+декодируется сразу уменьшенным в 2/4/8 раз (масштабирование DCT в libjpeg),
+если его длинная сторона остается не меньше imgsz исходного кадра, а зоны
+остановок, которые вырезаются из кадра, - не меньше imgsz своего размера.
+Боксы переводятся в координаты исходного кадра, полный кадр декодируется
+только для распознавания номеров
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from core.config import settings
+
+# Ориентация EXIF не применяется: размер берется из SOF (хранимые ширина и высота),
+# и полный и уменьшенный кадры должны совпадать с ним по осям
+FULL_FLAGS = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+
+# Флаги уменьшенного декодирования по коэффициенту
+REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8 | cv2.IMREAD_IGNORE_ORIENTATION,
+    4: cv2.IMREAD_REDUCED_COLOR_4 | cv2.IMREAD_IGNORE_ORIENTATION,
+    2: cv2.IMREAD_REDUCED_COLOR_2 | cv2.IMREAD_IGNORE_ORIENTATION,
+}
+
+# Маркеры SOF (начало кадра) JPEG, содержащие размеры изображения
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def select_imgsz(width: int, height: int) -> int:
+    """Размер входа модели в зависимости от разрешения кадра"""
+    # Для маленьких объектов (15x8 пикселей на 2688x1520) нужна максимальная детализация
+    if height > 1500 or width > 2500:
+        return 1920
+    if height > 720:
+        return 1280
+    return 640
+
+
+def jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """Размер (ширина, высота) JPEG по заголовку без декодирования; None - не JPEG"""
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Заполняющий байт перед маркером
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if marker in SOF_MARKERS:
+            height = int.from_bytes(data[i + 5:i + 7], "big")
+            width = int.from_bytes(data[i + 7:i + 9], "big")
+            return width, height
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+
+def reduction_factor(width: int, height: int, zones: Sequence[Tuple[int, int, int, int]] = ()) -> int:
+    """
+    Наибольшее уменьшение, при котором длинная сторона не меньше imgsz исходного кадра:
+    вход модели получается из того же числа пикселей, что и при полном декодировании
+    Args:
+        zones: области кадра (x1, y1, x2, y2), которые вырезаются и отрисовываются
+            (зоны остановок); их длинная сторона тоже остается не меньше imgsz
+            для размера зоны (или не уменьшается, если зона меньше imgsz)
+    """
+    required = [(max(width, height), select_imgsz(width, height))]
+    for x1, y1, x2, y2 in zones:
+        zone_width, zone_height = x2 - x1, y2 - y1
+        if zone_width > 0 and zone_height > 0:
+            required.append((max(zone_width, zone_height), select_imgsz(zone_width, zone_height)))
+    for factor in sorted(REDUCED_FLAGS, reverse=True):
+        if all(side // factor >= imgsz for side, imgsz in required):
+            return factor
+    return 1
+
+
+class DecodedImage:
+    """
+    Кадр для детекции: frame (возможно уменьшенный) и исходный JPEG
+    imgsz - размер входа модели для исходного кадра; детекции frame
+    переводятся в координаты исходного кадра через to_full
+    """
+
+    def __init__(self, data: bytes, frame: np.ndarray, width: int, height: int):
+        self.data = data
+        self.frame = frame
+        self.width = width
+        self.height = height
+        self.imgsz = select_imgsz(width, height)
+        # Фактический масштаб по осям (libjpeg округляет размер уменьшенного кадра вверх)
+        self.scale_x = width / frame.shape[1]
+        self.scale_y = height / frame.shape[0]
+        self._full: Optional[np.ndarray] = frame if frame.shape[:2] == (height, width) else None
+
+    @property
+    def reduced(self) -> bool:
+        return self._full is not self.frame
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """Размер исходного кадра (для функций, которым нужен только размер)"""
+        return (self.height, self.width, 3)
+
+    def full(self) -> np.ndarray:
+        """Кадр в исходном разрешении; декодируется при первом обращении (например, для OCR)"""
+        if self._full is None:
+            frame = cv2.imdecode(np.frombuffer(self.data, np.uint8), FULL_FLAGS)
+            if frame is None:
+                raise ValueError("Не удалось декодировать изображение")
+            self._full = frame
+        return self._full
+
+    def box_to_frame(self, bbox: Sequence[float]) -> Tuple[int, int, int, int]:
+        """Прямоугольник исходного кадра (например, зона остановки) в координатах frame"""
+        return (
+            int(bbox[0] / self.scale_x), int(bbox[1] / self.scale_y),
+            int(bbox[2] / self.scale_x), int(bbox[3] / self.scale_y)
+        )
+
+    def to_frame(self, items: List[Dict]) -> List[Dict]:
+        """Детекции в координатах исходного кадра - в координатах frame (для отрисовки)"""
+        if not self.reduced:
+            return items
+        return [
+            dict(item, bbox=[
+                item['bbox'][0] / self.scale_x, item['bbox'][1] / self.scale_y,
+                item['bbox'][2] / self.scale_x, item['bbox'][3] / self.scale_y
+            ])
+            for item in items
+        ]
+
+    def to_full(self, detections: Dict) -> Dict:
+        """Детекции frame в координатах исходного кадра"""
+        if not self.reduced:
+            return detections
+
+        def scale(items):
+            return [
+                dict(
+                    item,
+                    bbox=[
+                        item['bbox'][0] * self.scale_x, item['bbox'][1] * self.scale_y,
+                        item['bbox'][2] * self.scale_x, item['bbox'][3] * self.scale_y
+                    ],
+                    area=item.get('area', 0.0) * self.scale_x * self.scale_y
+                )
+                for item in items
+            ]
+
+        return dict(
+            detections,
+            people=scale(detections['people']),
+            buses=scale(detections['buses']),
+            frame_shape=self.shape
+        )
+
+
+def decode_image(data: bytes, zones: Sequence[Tuple[int, int, int, int]] = ()) -> Optional[DecodedImage]:
+    """
+    Декодирование изображения для детекции (JPEG - с уменьшением, если оно не
+    влияет на вход модели; остальные форматы - в исходном разрешении)
+    Args:
+        zones: зоны (x1, y1, x2, y2) исходного кадра, которые будут вырезаны из frame
+    Returns:
+        DecodedImage или None, если изображение не декодируется
+    """
+    buffer = np.frombuffer(data, np.uint8)
+    size = jpeg_size(data) if settings.JPEG_REDUCED_DECODE else None
+    factor = reduction_factor(size[0], size[1], zones) if size else 1
+    if factor > 1:
+        frame = cv2.imdecode(buffer, REDUCED_FLAGS[factor])
+        if frame is not None:
+            return DecodedImage(data, frame, size[0], size[1])
+    frame = cv2.imdecode(buffer, FULL_FLAGS)
+    if frame is None:
+        return None
+    return DecodedImage(data, frame, frame.shape[1], frame.shape[0])
@@ -0,0 +1,183 @@
+"""
+Клиент сервиса инференса (inference_service.py)
+Процессы API и воркеры Celery не загружают модели: детекция и распознавание
+номеров выполняются в сервисе инференса хоста. Кадры передаются через
+разделяемую память, при ее недоступности - в JPEG
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+
+from core.config import settings
+from services.cv_service import BaseCVService
+from services.frame_transport import SharedFrameWriter, encode_jpeg_ref
+
+# Отступ вокруг автобуса при вырезании области для OCR (как в CVService.recognize_bus_number)
+OCR_CROP_PADDING = 10
+
+# Отказов разделяемой памяти подряд, после которых кадры передаются в JPEG,
+# и через сколько секунд разделяемая память пробуется снова
+SHM_FAILURE_LIMIT = 3
+SHM_RETRY_INTERVAL = 60.0
+
+
+class InferenceError(Exception):
+    """Сервис инференса недоступен или вернул ошибку"""
+    pass
+
+
+class RemoteCVService(BaseCVService):
+    """Реализация BaseCVService поверх сервиса инференса"""
+
+    def __init__(self, url: str):
+        super().__init__()
+        if url.startswith("unix://"):
+            self._socket_path = url[len("unix://"):]
+            self._base_url = "http://inference"
+        else:
+            self._socket_path = None
+            self._base_url = url.rstrip("/")
+        self.use_shm = settings.INFERENCE_SHM
+        self._writer = SharedFrameWriter() if self.use_shm else None
+        self._shm_failures = 0
+        self._shm_disabled_until = 0.0
+        self._client = None
+        self._client_pid = None
+        self._lock = threading.Lock()
+
+    def _get_client(self) -> httpx.Client:
+        # Клиент создается в каждом процессе заново: соединения не переживают fork воркера Celery
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            with self._lock:
+                if self._client is None or self._client_pid != pid:
+                    transport = httpx.HTTPTransport(uds=self._socket_path) if self._socket_path else None
+                    self._client = httpx.Client(
+                        base_url=self._base_url,
+                        transport=transport,
+                        timeout=settings.INFERENCE_TIMEOUT
+                    )
+                    self._client_pid = pid
+        return self._client
+
+    def _shm_enabled(self) -> bool:
+        return self.use_shm and time.monotonic() >= self._shm_disabled_until
+
+    def _shm_failed(self, detail):
+        """Отказ сервиса прочитать кадр из разделяемой памяти (409)"""
+        with self._lock:
+            self._shm_failures += 1
+            if self._shm_failures < SHM_FAILURE_LIMIT:
+                return
+            self._shm_failures = 0
+            self._shm_disabled_until = time.monotonic() + SHM_RETRY_INTERVAL
+        print(f"[INFERENCE] Разделяемая память недоступна сервису ({detail}), "
+              f"кадры передаются в JPEG {SHM_RETRY_INTERVAL:.0f} с")
+
+    def _frame_refs(self, frames: List[np.ndarray], use_shm: bool) -> List[Dict]:
+        if use_shm:
+            # Кадры из кольцевого буфера захвата (RingFrame) передаются ссылкой на слот без копирования
+            refs = [getattr(frame, "ref", None) for frame in frames]
+            copies = [frame for frame, ref in zip(frames, refs) if ref is None]
+            written = iter(self._writer.write(copies) if copies else [])
+            return [ref if ref is not None else next(written) for ref in refs]
+        return [encode_jpeg_ref(frame, settings.INFERENCE_JPEG_QUALITY) for frame in frames]
+
+    def _post(self, path: str, frames: List[np.ndarray], payload) -> Dict:
+        """
+        Запрос к сервису; payload(refs) строит тело по ссылкам на кадры
+        Если сервис не прочитал кадры из разделяемой памяти (409, например слот
+        кольцевого буфера уже перезаписан), этот запрос повторяется в JPEG.
+        После SHM_FAILURE_LIMIT отказов подряд клиент передает JPEG
+        SHM_RETRY_INTERVAL секунд, затем снова пробует разделяемую память
+        """
+        use_shm = self._shm_enabled()
+        try:
+            response = self._get_client().post(path, json=payload(self._frame_refs(frames, use_shm)))
+            if response.status_code == 409 and use_shm:
+                self._shm_failed(response.json().get('detail'))
+                response = self._get_client().post(path, json=payload(self._frame_refs(frames, False)))
+            elif use_shm and response.is_success:
+                self._shm_failures = 0
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as e:
+            raise InferenceError(f"Ошибка запроса {path} к сервису инференса: {e}")
+
+    @staticmethod
+    def _parse_detections(data: Dict) -> Dict:
+        return {
+            'people': data['people'],
+            'buses': data['buses'],
+            'timestamp': datetime.fromisoformat(data['timestamp']),
+            'frame_shape': tuple(data['frame_shape'])
+        }
+
+    def detect_objects_batch(self, frames: List[np.ndarray],
+                             imgsz: Optional[List[Optional[int]]] = None) -> List[Dict]:
+        if not frames:
+            return []
+        data = self._post("/detect", frames, lambda refs: {"frames": refs, "imgsz": imgsz})
+        return [self._parse_detections(item) for item in data["detections"]]
+
+    def detect_objects(self, frame: np.ndarray, imgsz: Optional[int] = None) -> Dict:
+        detections = self.detect_objects_batch([frame], [imgsz] if imgsz else None)[0]
+        self._record_history(detections)
+        return detections
+
+    @staticmethod
+    def _crop(frame: np.ndarray, bbox) -> Tuple[np.ndarray, List[float]]:
+        """Область автобуса с отступом и bbox в ее координатах"""
+        x1, y1, x2, y2 = map(int, bbox)
+        cx1 = max(0, x1 - OCR_CROP_PADDING)
+        cy1 = max(0, y1 - OCR_CROP_PADDING)
+        cx2 = min(frame.shape[1], x2 + OCR_CROP_PADDING)
+        cy2 = min(frame.shape[0], y2 + OCR_CROP_PADDING)
+        return frame[cy1:cy2, cx1:cx2], [x1 - cx1, y1 - cy1, x2 - cx1, y2 - cy1]
+
+    def _recognize_numbers(self, frame: np.ndarray, bboxes: List) -> List[Optional[str]]:
+        # В сервис уходят только области автобусов, а не весь кадр
+        crops = []
+        boxes = []
+        for bbox in bboxes:
+            crop, box = self._crop(frame, bbox)
+            crops.append(crop)
+            boxes.append(box)
+        indices = [i for i, crop in enumerate(crops) if crop.size > 0]
+        numbers: List[Optional[str]] = [None] * len(bboxes)
+        if not indices:
+            return numbers
+        try:
+            data = self._post(
+                "/recognize-buses",
+                [crops[i] for i in indices],
+                lambda refs: {"crops": [{"frame": ref, "bbox": boxes[i]} for ref, i in zip(refs, indices)]}
+            )
+        except InferenceError as e:
+            print(f"[INFERENCE] {e}")
+            return numbers
+        for i, number in zip(indices, data["numbers"]):
+            numbers[i] = number
+        return numbers
+
+    def recognize_bus_number(self, frame: np.ndarray, bus_bbox: Tuple[int, int, int, int]) -> Optional[str]:
+        return self._recognize_numbers(frame, [bus_bbox])[0]
+
+    def recognize_buses(self, frame: np.ndarray, buses: List[Dict]) -> List[Dict]:
+        """Номера всех автобусов кадра одним запросом"""
+        if not buses:
+            return []
+        numbers = self._recognize_numbers(frame, [bus['bbox'] for bus in buses])
+        return [
+            {
+                'bbox': bus['bbox'],
+                'confidence': bus['confidence'],
+                'bus_number': number
+            }
+            for bus, number in zip(buses, numbers)
+        ]
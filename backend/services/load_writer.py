@@ -0,0 +1,198 @@
+"""
+Отложенная пакетная запись результатов мониторинга (write-behind)
+Результаты остановок накапливаются в буфере процесса и записываются
+многострочными INSERT в одной транзакции. people_before берется из состояния
+остановки в Redis (одно чтение на цикл для всех остановок), а не отдельным
+запросом на каждую остановку. После записи обновляется состояние остановок
+"""
+import threading
+import traceback
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, insert
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from core.database import SessionLocal
+from core.models import LoadData, BusDetection
+from services.stop_state import stop_state
+
+
+class LoadWriter:
+    """
+    Буфер записей LoadData и BusDetection
+    Задачи мониторинга добавляют результаты через add() и вызывают flush()
+    в конце цикла; при ошибке БД записи остаются в буфере до следующего flush()
+    """
+
+    def __init__(self, max_buffer: Optional[int] = None):
+        self.max_buffer = max_buffer or settings.LOAD_WRITER_MAX_BUFFER
+        self._load_rows: List[Dict] = []
+        self._bus_rows: List[Dict] = []
+        # Обновления состояния остановок, применяемые после записи в БД
+        self._state_updates: List[Dict] = []
+        # stop_id -> people_count до следующего flush(): значения из Redis и добавленные в буфер.
+        # После записи сбрасываются - остановку могла обработать другая копия воркера
+        self._latest: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _query_last_counts(db: Session, stop_ids: List[int]) -> Dict[int, int]:
+        """Количество людей по последней записи LoadData для каждой остановки (один запрос)"""
+        latest = db.query(
+            LoadData.stop_id,
+            func.max(LoadData.timestamp).label('timestamp')
+        ).filter(LoadData.stop_id.in_(stop_ids)).group_by(LoadData.stop_id).subquery()
+        rows = db.query(LoadData.stop_id, LoadData.people_count).join(
+            latest,
+            (LoadData.stop_id == latest.c.stop_id) & (LoadData.timestamp == latest.c.timestamp)
+        ).all()
+        return {stop_id: people_count for stop_id, people_count in rows}
+
+    def prime(self, stop_ids: List[int]):
+        """
+        Загрузка последних значений остановок из состояния в Redis (один MGET),
+        при его отсутствии - из БД. Вызывается в начале цикла мониторинга
+        """
+        with self._lock:
+            missing = [stop_id for stop_id in stop_ids if stop_id not in self._latest]
+        if not missing:
+            return
+
+        counts = {
+            stop_id: state["people_count"] for stop_id, state in stop_state.get_many(missing).items()
+        }
+        not_cached = [stop_id for stop_id in missing if stop_id not in counts]
+        if not_cached:
+            db = SessionLocal()
+            try:
+                counts.update(self._query_last_counts(db, not_cached))
+            finally:
+                db.close()
+
+        with self._lock:
+            for stop_id in missing:
+                self._latest.setdefault(stop_id, int(counts.get(stop_id) or 0))
+
+    def add(self, stop_id: int, results: Dict, timestamp: Optional[datetime] = None,
+            stop_name: Optional[str] = None, extra: Optional[Dict] = None) -> int:
+        """
+        Добавление результатов остановки в буфер
+        Args:
+            stop_id: ID остановки
+            results: результаты build_zone_results / process_video_frame
+            timestamp: время записи (по умолчанию - текущее)
+            stop_name: название остановки для состояния в Redis
+            extra: дополнительные поля detection_data (например, статистика интервала)
+        Returns:
+            Количество людей по предыдущему значению (people_before)
+        """
+        self.prime([stop_id])
+        timestamp = timestamp or datetime.now()
+        people_count = int(results['people_count'])
+
+        with self._lock:
+            people_before = self._latest[stop_id]
+            self._latest[stop_id] = people_count
+
+            detection_data = {
+                'people_detections': results.get('people_detections', []),
+                'stop_zone': results.get('stop_zone'),
+                'people_before': people_before
+            }
+            if extra:
+                detection_data.update(extra)
+            self._load_rows.append({
+                'stop_id': stop_id,
+                'timestamp': timestamp,
+                'people_count': people_count,
+                'buses_detected': int(results.get('buses_count', 0)),
+                'detection_data': detection_data
+            })
+            for bus_info in results.get('buses', []):
+                self._bus_rows.append({
+                    'stop_id': stop_id,
+                    'bus_number': bus_info.get('bus_number'),
+                    'detected_at': timestamp,
+                    'confidence': bus_info.get('confidence', 0.0),
+                    'bus_bbox': bus_info.get('bbox'),
+                    'detection_data': {
+                        'people_before': people_before,
+                        'people_after': people_count
+                    }
+                })
+            self._state_updates.append({
+                'stop_id': stop_id,
+                'stop_name': stop_name,
+                'people_count': people_count,
+                'buses_detected': int(results.get('buses_count', 0)),
+                'buses': results.get('buses', []),
+                'timestamp': timestamp
+            })
+            self._trim()
+
+        return people_before
+
+    def _trim(self):
+        """Ограничение буфера при длительной недоступности БД (отбрасываются старые записи)"""
+        dropped = len(self._load_rows) - self.max_buffer
+        if dropped > 0:
+            del self._load_rows[:dropped]
+            print(f"[LOAD WRITER] Буфер переполнен, отброшено записей загруженности: {dropped}")
+        dropped = len(self._bus_rows) - self.max_buffer
+        if dropped > 0:
+            del self._bus_rows[:dropped]
+            print(f"[LOAD WRITER] Буфер переполнен, отброшено детекций автобусов: {dropped}")
+        dropped = len(self._state_updates) - self.max_buffer
+        if dropped > 0:
+            del self._state_updates[:dropped]
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._load_rows) + len(self._bus_rows)
+
+    def flush(self) -> int:
+        """
+        Запись буфера в БД одной транзакцией (многострочные INSERT)
+        Returns:
+            Количество записанных строк
+        """
+        with self._lock:
+            load_rows, self._load_rows = self._load_rows, []
+            bus_rows, self._bus_rows = self._bus_rows, []
+            state_updates, self._state_updates = self._state_updates, []
+            latest, self._latest = self._latest, {}
+        if not load_rows and not bus_rows:
+            return 0
+
+        db = SessionLocal()
+        try:
+            if load_rows:
+                db.execute(insert(LoadData), load_rows)
+            if bus_rows:
+                db.execute(insert(BusDetection), bus_rows)
+            db.commit()
+            print(f"[LOAD WRITER] Записано: load_data={len(load_rows)}, bus_detections={len(bus_rows)}")
+        except Exception as e:
+            db.rollback()
+            tb = traceback.format_exc()
+            print(f"[ERROR][DB COMMIT batch] {str(e)}\nTraceback:\n{tb}")
+            # Возвращаем записи в буфер для повторной попытки
+            with self._lock:
+                self._load_rows = load_rows + self._load_rows
+                self._bus_rows = bus_rows + self._bus_rows
+                self._state_updates = state_updates + self._state_updates
+                # Состояние в Redis не обновлено - значения буфера остаются источником people_before
+                self._latest = {**latest, **self._latest}
+                self._trim()
+            raise
+        finally:
+            db.close()
+
+        stop_state.apply(state_updates)
+        return len(load_rows) + len(bus_rows)
+
+
+# Глобальный экземпляр буфера записи
+load_writer = LoadWriter()
@@ -0,0 +1,188 @@
+"""
+Кэш снимков камер и результатов детекции по зонам остановок
+Короткий TTL и объединение одновременных запросов: параллельные запросы
+одной камеры/зоны разделяют одну загрузку снимка и один прогон YOLO
+(если детекций воркеров мониторинга для камеры нет)
+"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import cv2
+
+from core.config import settings
+from services.cv_service import cv_service
+from services.detection_bus import latest_camera_detections, scale_detections
+from services.frame_dedup import frame_dedup
+from services.image_decode import DecodedImage
+from services.snapshot_service import snapshot_service
+
+
+class SnapshotCache:
+    """
+    Кэш последнего снимка каждой камеры и отрисованных зон остановок
+    Работает в цикле событий процесса API
+    """
+
+    def __init__(self, ttl: Optional[float] = None, recent_size: Optional[int] = None):
+        self.ttl = ttl if ttl is not None else settings.SNAPSHOT_CACHE_TTL
+        self.recent_size = recent_size or settings.SNAPSHOT_CACHE_RECENT
+
+        # camera_id -> {"frame_id", "image", "fetched_at", "captured_at"}
+        self._frames: Dict[str, Dict] = {}
+        # (camera_id, zone, with_detection) -> результат зоны для последнего снимка
+        self._zones: Dict[tuple, Dict] = {}
+        # snapshot_id -> результат зоны (последние N изображений, отданных клиентам)
+        self._recent: "OrderedDict[str, Dict]" = OrderedDict()
+        # Выполняющиеся загрузки/детекции по ключу
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+
+    def _is_fresh(self, entry: Optional[Dict]) -> bool:
+        return entry is not None and time.monotonic() - entry["fetched_at"] < self.ttl
+
+    async def _single_flight(self, key: tuple, factory: Callable[[], Awaitable]):
+        """
+        Объединение одновременных запросов по ключу
+        Задача не отменяется при отключении первого клиента - ее результат ждут остальные
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def get_frame(self, camera_id: str) -> Dict:
+        """Последний снимок камеры не старше TTL"""
+        entry = self._frames.get(camera_id)
+        if self._is_fresh(entry):
+            return entry
+        return await self._single_flight(("frame", camera_id), lambda: self._fetch_frame(camera_id))
+
+    async def _fetch_frame(self, camera_id: str) -> Dict:
+        image = await snapshot_service.fetch_image(camera_id)
+        fetched_at = time.monotonic()
+        entry = {
+            "frame_id": f"{camera_id}-{int(time.time() * 1000)}",
+            "image": image,
+            "fetched_at": fetched_at,
+            "captured_at": datetime.now(),
+        }
+        self._frames[camera_id] = entry
+        return entry
+
+    @staticmethod
+    def _zone_key(stop_zone_coords: Optional[List[List[float]]]) -> tuple:
+        return tuple(tuple(point) for point in (stop_zone_coords or []))
+
+    async def get_zone(self, camera_id: str, stop_zone_coords: Optional[List[List[float]]],
+                       with_detection: bool = True) -> Dict:
+        """
+        Зона остановки на последнем снимке: счетчики и отрисованный JPEG
+
+        Returns:
+            {"snapshot_id", "camera_id", "captured_at", "people_count", "buses_count", "jpeg"}
+        """
+        key = (camera_id, self._zone_key(stop_zone_coords), with_detection)
+        entry = self._zones.get(key)
+        if self._is_fresh(entry):
+            return entry
+        return await self._single_flight(
+            ("zone",) + key, lambda: self._compute_zone(key, stop_zone_coords)
+        )
+
+    async def _compute_zone(self, key: tuple, stop_zone_coords) -> Dict:
+        camera_id, zone, with_detection = key
+        frame_entry = await self.get_frame(camera_id)
+
+        # Зона уже посчитана для этого снимка (например, другим запросом до истечения TTL снимка)
+        entry = self._zones.get(key)
+        if entry is not None and entry["frame_id"] == frame_entry["frame_id"]:
+            return entry
+
+        result = await asyncio.to_thread(
+            self._render_zone, frame_entry["image"], camera_id, stop_zone_coords, with_detection,
+            ("zone", camera_id, zone)
+        )
+        digest = hashlib.sha1(
+            json.dumps([frame_entry["frame_id"], zone, with_detection]).encode()
+        ).hexdigest()[:16]
+        entry = {
+            "snapshot_id": digest,
+            "frame_id": frame_entry["frame_id"],
+            "camera_id": camera_id,
+            "zone": zone,
+            "with_detection": with_detection,
+            "fetched_at": frame_entry["fetched_at"],
+            "captured_at": frame_entry["captured_at"],
+            **result,
+        }
+        self._zones[key] = entry
+        self._remember(entry)
+        return entry
+
+    @staticmethod
+    def _render_zone(image: DecodedImage, camera_id: str, stop_zone_coords, with_detection: bool,
+                     dedup_source: tuple) -> Dict:
+        """
+        Вырезание зоны, детекция и кодирование JPEG (выполняется в пуле потоков)
+        Детекции берутся у воркеров мониторинга камеры; без них зона детектируется
+        в процессе API (API_LOCAL_INFERENCE), а если зона не изменилась с прошлого
+        снимка (камера отдала тот же кадр), детекции повторяются.
+        Зона вырезается из снимка в исходном разрешении
+        """
+        frame = image.full()
+        stop_zone = cv_service.detect_stop_zone(frame, stop_zone_coords)
+        x1, y1, x2, y2 = stop_zone
+        zone_frame = frame[y1:y2, x1:x2]
+        result_frame = zone_frame
+        people_count = buses_count = None if with_detection else 0
+        if with_detection:
+            message = latest_camera_detections(camera_id)
+            if message is not None:
+                detections = scale_detections(message, frame.shape)
+                people_count = cv_service.count_people_in_detections(detections['people'], stop_zone)
+                buses_count = cv_service.count_people_in_detections(detections['buses'], stop_zone)
+                result_frame = cv_service.render_zone(frame, stop_zone, detections['people'], detections['buses'])
+            elif settings.API_LOCAL_INFERENCE:
+                detections, _ = frame_dedup.get_or_compute(
+                    dedup_source, zone_frame, lambda: cv_service.detect_objects(zone_frame), exact=True
+                )
+                people_count = len(detections.get('people', []))
+                buses_count = len(detections.get('buses', []))
+                result_frame = cv_service.draw_detections(zone_frame, detections)
+        _, encoded_img = cv2.imencode('.jpg', result_frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        return {
+            # None - детекция запрошена, но результатов нет (воркеры не обрабатывают камеру)
+            "people_count": people_count,
+            "buses_count": buses_count,
+            "jpeg": encoded_img.tobytes(),
+        }
+
+    def _remember(self, entry: Dict):
+        self._recent[entry["snapshot_id"]] = entry
+        self._recent.move_to_end(entry["snapshot_id"])
+        while len(self._recent) > self.recent_size:
+            self._recent.popitem(last=False)
+
+    def get_by_id(self, snapshot_id: str, camera_id: str, stop_zone_coords: Optional[List[List[float]]],
+                  with_detection: bool = True) -> Optional[Dict]:
+        """
+        Ранее отданное изображение зоны по его ID
+        None, если ID неизвестен или изображение относится к другой камере, зоне или режиму детекции
+        """
+        entry = self._recent.get(snapshot_id)
+        if entry is None:
+            return None
+        if (entry["camera_id"], entry["zone"], entry["with_detection"]) != (
+                camera_id, self._zone_key(stop_zone_coords), with_detection):
+            return None
+        return entry
+
+
+# Глобальный экземпляр кэша
+snapshot_cache = SnapshotCache()
@@ -0,0 +1,187 @@
+"""
+Сервис получения снимков с камер is74
+Один пул HTTP соединений на процесс (keep-alive, HTTP/2 при наличии h2),
+запоминание рабочего URL для каждой камеры и ограничение параллельных запросов
+"""
+import asyncio
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import httpx
+
+from core.config import settings
+from core.cameras import IS74_CAMERAS, get_snapshot_urls
+from services.image_decode import DecodedImage, decode_image
+
+# Зона остановки (x1, y1, x2, y2) в координатах исходного снимка
+Zone = Tuple[int, int, int, int]
+
+# HTTP/2 требует пакет h2 (httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class SnapshotError(Exception):
+    """Не удалось получить снимок ни по одному URL"""
+
+
+class SnapshotService:
+    """
+    Асинхронный загрузчик снимков
+    Клиент httpx живет в собственном цикле событий в фоновом потоке, поэтому
+    пул соединений общий для async эндпоинтов и синхронных задач Celery
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+        # camera_id -> URL, который ответил последним
+        self._preferred_urls: Dict[str, str] = {}
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        """Ленивый запуск цикла событий (после fork воркера Celery - заново)"""
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return self._loop
+
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                self._client = httpx.AsyncClient(
+                    http2=settings.SNAPSHOT_HTTP2 and HTTP2_AVAILABLE,
+                    timeout=httpx.Timeout(
+                        settings.SNAPSHOT_TIMEOUT, connect=settings.SNAPSHOT_CONNECT_TIMEOUT
+                    ),
+                    limits=httpx.Limits(
+                        max_connections=settings.SNAPSHOT_MAX_CONNECTIONS,
+                        max_keepalive_connections=settings.SNAPSHOT_MAX_CONNECTIONS,
+                        keepalive_expiry=60.0,
+                    ),
+                    follow_redirects=True,
+                )
+                self._semaphore = asyncio.Semaphore(settings.SNAPSHOT_MAX_CONCURRENCY)
+                ready.set()
+                loop.run_forever()
+
+            thread = threading.Thread(target=run, name="snapshot-service", daemon=True)
+            thread.start()
+            ready.wait()
+            self._loop = loop
+            self._pid = os.getpid()
+            return loop
+
+    def _candidate_urls(self, camera_id: str) -> list:
+        """URL камеры: сначала последний рабочий, затем остальные"""
+        urls = get_snapshot_urls(IS74_CAMERAS[camera_id])
+        preferred = self._preferred_urls.get(camera_id)
+        if preferred in urls:
+            urls.remove(preferred)
+            urls.insert(0, preferred)
+        return urls
+
+    async def _fetch(self, camera_id: str) -> bytes:
+        """Загрузка снимка в цикле событий сервиса"""
+        last_error = None
+        async with self._semaphore:
+            for url in self._candidate_urls(camera_id):
+                try:
+                    response = await self._client.get(url)
+                    if response.status_code == 200 and response.content:
+                        self._preferred_urls[camera_id] = url
+                        return response.content
+                    last_error = f"HTTP {response.status_code}"
+                except httpx.HTTPError as e:
+                    last_error = str(e) or type(e).__name__
+        # Ни один URL не ответил - в следующий раз начинаем с начала списка
+        self._preferred_urls.pop(camera_id, None)
+        raise SnapshotError(
+            f"Не удалось получить снимок с камеры {camera_id}. Последняя ошибка: {last_error}"
+        )
+
+    def _submit(self, camera_id: str):
+        if camera_id not in IS74_CAMERAS:
+            raise SnapshotError(f"Камера {camera_id} не найдена")
+        loop = self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self._fetch(camera_id), loop)
+
+    async def fetch_bytes(self, camera_id: str) -> bytes:
+        """Получение JPEG снимка камеры (для async кода)"""
+        return await asyncio.wrap_future(self._submit(camera_id))
+
+    def fetch_bytes_sync(self, camera_id: str) -> bytes:
+        """Получение JPEG снимка камеры (для синхронного кода, например задач Celery)"""
+        return self._submit(camera_id).result()
+
+    async def _fetch_many(self, camera_ids: List[str]) -> Dict[str, Union[bytes, Exception]]:
+        """Одновременная загрузка снимков камер; ошибка одной камеры не прерывает остальные"""
+        results = await asyncio.gather(
+            *(self._fetch(camera_id) for camera_id in camera_ids), return_exceptions=True
+        )
+        return dict(zip(camera_ids, results))
+
+    def fetch_many_bytes_sync(self, camera_ids: List[str]) -> Dict[str, Union[bytes, Exception]]:
+        """
+        Снимки нескольких камер параллельно (время - как у самой медленной камеры)
+        Returns:
+            camera_id -> JPEG или исключение (SnapshotError для неизвестной камеры или сбоя загрузки)
+        """
+        results: Dict[str, Union[bytes, Exception]] = {}
+        known = []
+        for camera_id in camera_ids:
+            if camera_id in IS74_CAMERAS:
+                known.append(camera_id)
+            else:
+                results[camera_id] = SnapshotError(f"Камера {camera_id} не найдена")
+        if known:
+            loop = self._ensure_started()
+            results.update(asyncio.run_coroutine_threadsafe(self._fetch_many(known), loop).result())
+        return results
+
+    def fetch_images_sync(self, camera_ids: List[str],
+                          zones: Optional[Dict[str, Sequence[Zone]]] = None) -> Dict[str, Union[DecodedImage, Exception]]:
+        """
+        Снимки нескольких камер параллельно, декодированные для детекции
+        Args:
+            zones: camera_id -> зоны остановок камеры (см. decode_image)
+        """
+        zones = zones or {}
+        images: Dict[str, Union[DecodedImage, Exception]] = {}
+        for camera_id, data in self.fetch_many_bytes_sync(camera_ids).items():
+            if isinstance(data, Exception):
+                images[camera_id] = data
+                continue
+            try:
+                images[camera_id] = self.decode(data, zones.get(camera_id, ()))
+            except SnapshotError as e:
+                images[camera_id] = e
+        return images
+
+    @staticmethod
+    def decode(data: bytes, zones: Sequence[Zone] = ()) -> DecodedImage:
+        """Снимок для детекции (уменьшенный, если это не влияет на вход модели и зоны)"""
+        image = decode_image(data, zones)
+        if image is None:
+            raise SnapshotError("Не удалось декодировать снимок")
+        return image
+
+    async def fetch_image(self, camera_id: str) -> DecodedImage:
+        """Снимок камеры для детекции; декодирование вне цикла событий"""
+        data = await self.fetch_bytes(camera_id)
+        return await asyncio.to_thread(self.decode, data)
+
+    def fetch_image_sync(self, camera_id: str, zones: Sequence[Zone] = ()) -> DecodedImage:
+        return self.decode(self.fetch_bytes_sync(camera_id), zones)
+
+
+# Глобальный экземпляр сервиса
+snapshot_service = SnapshotService()
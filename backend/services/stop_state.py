@@ -0,0 +1,286 @@
+"""
+Последнее состояние остановок в Redis
+Текущее и сглаженное количество людей, последние автобусы и время обновления.
+Мониторинг обновляет состояние после записи в БД, API и задачи читают его
+за O(1) без запросов к Postgres (БД - запасной вариант при отсутствии записи).
+Обновления публикуются в шину событий для push-уведомлений клиентов
+"""
+import json
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, func
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from core.cache import get_redis
+from core.models import Stop, LoadData, BusDetection
+from services.event_bus import publish, STOP_LOAD_CHANNEL
+
+# Сколько автобусов хранится в состоянии
+RECENT_BUSES_LIMIT = 5
+# Автобусы старше этого не попадают в состояние
+RECENT_BUSES_WINDOW = timedelta(minutes=30)
+
+
+def to_local_naive(value: datetime) -> datetime:
+    """Время в локальной зоне без tzinfo (так пишет мониторинг)"""
+    if value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+
+def median(values: List[int]) -> int:
+    if not values:
+        return 0
+    sorted_values = sorted(values)
+    n = len(sorted_values)
+    if n % 2 == 0:
+        return int((sorted_values[n // 2 - 1] + sorted_values[n // 2]) / 2)
+    return int(sorted_values[n // 2])
+
+
+def updated_at(state: Dict) -> datetime:
+    return datetime.fromisoformat(state["updated_at"])
+
+
+def recent_buses(state: Dict, window: timedelta) -> List[Dict]:
+    """Автобусы из состояния, обнаруженные не раньше window назад"""
+    since = datetime.now() - window
+    return [
+        bus for bus in state.get("recent_buses", [])
+        if datetime.fromisoformat(bus["detected_at"]) >= since
+    ]
+
+
+class StopStateStore:
+    """
+    Состояние остановки: {"stop_id", "stop_name", "people_count", "smoothed_count",
+    "buses_detected", "history", "recent_buses", "updated_at"}
+    Для остановок без записей в БД хранится метка {"stop_id", "empty": true}
+    на STOP_STATE_EMPTY_TTL, чтобы опросы не повторяли запросы к БД.
+    Ошибки Redis не пробрасываются - читатели переходят на БД
+    """
+
+    def __init__(self, ttl: Optional[int] = None, window: Optional[int] = None):
+        self.ttl = ttl or settings.STOP_STATE_TTL
+        self.empty_ttl = settings.STOP_STATE_EMPTY_TTL
+        self.window = window or settings.STOP_STATE_SMOOTHING_WINDOW
+
+    @staticmethod
+    def _key(stop_id: int) -> str:
+        return f"stop_state:{stop_id}"
+
+    def get(self, stop_id: int) -> Optional[Dict]:
+        try:
+            data = get_redis().get(self._key(stop_id))
+        except Exception as e:
+            print(f"[STOP STATE] Ошибка чтения состояния остановки {stop_id}: {e}")
+            return None
+        state = json.loads(data) if data else None
+        return None if state is None or state.get("empty") else state
+
+    def _fetch(self, stop_ids: List[int]) -> Tuple[Dict[int, Dict], Set[int]]:
+        """Состояния остановок одним MGET и остановки с меткой отсутствия данных"""
+        if not stop_ids:
+            return {}, set()
+        try:
+            values = get_redis().mget([self._key(stop_id) for stop_id in stop_ids])
+        except Exception as e:
+            print(f"[STOP STATE] Ошибка чтения состояний остановок: {e}")
+            return {}, set()
+        states = {}
+        empty = set()
+        for stop_id, value in zip(stop_ids, values):
+            if not value:
+                continue
+            state = json.loads(value)
+            if state.get("empty"):
+                empty.add(stop_id)
+            else:
+                states[stop_id] = state
+        return states, empty
+
+    def get_many(self, stop_ids: List[int]) -> Dict[int, Dict]:
+        """Состояния нескольких остановок одним запросом (отсутствующие не возвращаются)"""
+        return self._fetch(stop_ids)[0]
+
+    def put_many(self, states: List[Dict]):
+        if not states:
+            return
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for state in states:
+                pipe.set(self._key(state["stop_id"]), json.dumps(state), ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            print(f"[STOP STATE] Не удалось сохранить состояния остановок: {e}")
+
+    def mark_empty(self, stop_ids: List[int]):
+        """Метка отсутствия данных: следующие чтения до empty_ttl не обращаются к БД"""
+        if not stop_ids:
+            return
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for stop_id in stop_ids:
+                # NX: не затирать состояние, записанное мониторингом после запроса к БД
+                pipe.set(self._key(stop_id), json.dumps({"stop_id": stop_id, "empty": True}),
+                         ex=self.empty_ttl, nx=True)
+            pipe.execute()
+        except Exception as e:
+            print(f"[STOP STATE] Не удалось сохранить метки остановок без данных: {e}")
+
+    def invalidate(self, stop_id: int):
+        """Сброс состояния (например, после изменения остановки) - следующее чтение из БД"""
+        try:
+            get_redis().delete(self._key(stop_id))
+        except Exception as e:
+            print(f"[STOP STATE] Не удалось сбросить состояние остановки {stop_id}: {e}")
+
+    def merge(self, previous: Optional[Dict], update: Dict) -> Dict:
+        """
+        Новое состояние по предыдущему и результатам мониторинга
+        Args:
+            update: {"stop_id", "stop_name", "people_count", "buses_detected", "buses", "timestamp"}
+        """
+        previous = previous or {}
+        history = (previous.get("history", []) + [int(update["people_count"])])[-self.window:]
+
+        timestamp = to_local_naive(update["timestamp"])
+        new_buses = [
+            {
+                "bus_number": bus.get("bus_number"),
+                "detected_at": timestamp.isoformat(),
+                "confidence": bus.get("confidence", 0.0),
+            }
+            for bus in update.get("buses", [])
+        ]
+        buses = new_buses + recent_buses(previous, RECENT_BUSES_WINDOW)
+
+        return {
+            "stop_id": update["stop_id"],
+            "stop_name": update.get("stop_name") or previous.get("stop_name"),
+            "people_count": int(update["people_count"]),
+            "smoothed_count": median(history),
+            "buses_detected": int(update.get("buses_detected", 0)),
+            "history": history,
+            "recent_buses": buses[:RECENT_BUSES_LIMIT],
+            "updated_at": timestamp.isoformat(),
+        }
+
+    def apply(self, updates: List[Dict]):
+        """
+        Обновление состояний по результатам мониторинга
+        Чтение и запись - одна транзакция Redis (WATCH/MULTI, повтор при конфликте):
+        история и автобусы, записанные другим процессом между чтением и записью, не теряются.
+        Новые состояния публикуются одним событием в STOP_LOAD_CHANNEL
+        """
+        if not updates:
+            return
+        keys = [self._key(stop_id) for stop_id in dict.fromkeys(update["stop_id"] for update in updates)]
+
+        def merge_all(pipe) -> List[Dict]:
+            previous = {}
+            for value in pipe.mget(keys):
+                state = json.loads(value) if value else None
+                if state is not None and not state.get("empty"):
+                    previous[state["stop_id"]] = state
+            states = []
+            for update in updates:
+                state = self.merge(previous.get(update["stop_id"]), update)
+                previous[update["stop_id"]] = state
+                states.append(state)
+            pipe.multi()
+            for state in states:
+                pipe.set(self._key(state["stop_id"]), json.dumps(state), ex=self.ttl)
+            return states
+
+        try:
+            states = get_redis().transaction(merge_all, *keys, value_from_callable=True)
+        except Exception as e:
+            print(f"[STOP STATE] Не удалось обновить состояния остановок: {e}")
+            return
+        publish(STOP_LOAD_CHANNEL, {
+            "type": "stop_load",
+            "states": [{k: v for k, v in state.items() if k != "history"} for state in states],
+        })
+
+    def load_from_db(self, db: Session, stop_ids: List[int]) -> Dict[int, Dict]:
+        """
+        Построение состояний из Postgres для остановок без записи в Redis
+        Запросы по множеству остановок сразу; результат сохраняется в Redis,
+        остановки без записей получают метку отсутствия данных
+        """
+        if not stop_ids:
+            return {}
+        stops = db.query(Stop.id, Stop.name).filter(Stop.id.in_(stop_ids)).all()
+        if not stops:
+            self.mark_empty(stop_ids)
+            return {}
+        found_ids = [stop_id for stop_id, _ in stops]
+
+        # Последние window записей каждой остановки
+        ranked = db.query(
+            LoadData.stop_id,
+            LoadData.people_count,
+            LoadData.buses_detected,
+            LoadData.timestamp,
+            func.row_number().over(
+                partition_by=LoadData.stop_id, order_by=LoadData.timestamp.desc()
+            ).label("rank")
+        ).filter(LoadData.stop_id.in_(found_ids)).subquery()
+        rows = db.query(ranked).filter(ranked.c.rank <= self.window).order_by(
+            ranked.c.stop_id, ranked.c.rank
+        ).all()
+        load_rows: Dict[int, list] = {}
+        for row in rows:
+            load_rows.setdefault(row.stop_id, []).append(row)
+
+        buses = db.query(BusDetection).filter(
+            and_(
+                BusDetection.stop_id.in_(found_ids),
+                BusDetection.detected_at >= datetime.now() - RECENT_BUSES_WINDOW
+            )
+        ).order_by(BusDetection.detected_at.desc()).all()
+        buses_by_stop: Dict[int, List[Dict]] = {}
+        for bus in buses:
+            stop_buses = buses_by_stop.setdefault(bus.stop_id, [])
+            if len(stop_buses) < RECENT_BUSES_LIMIT:
+                stop_buses.append({
+                    "bus_number": bus.bus_number,
+                    "detected_at": to_local_naive(bus.detected_at).isoformat(),
+                    "confidence": bus.confidence,
+                })
+
+        states = {}
+        for stop_id, stop_name in stops:
+            history_rows = load_rows.get(stop_id)
+            if not history_rows:
+                continue
+            latest = history_rows[0]
+            history = [row.people_count or 0 for row in reversed(history_rows)]
+            states[stop_id] = {
+                "stop_id": stop_id,
+                "stop_name": stop_name,
+                "people_count": latest.people_count or 0,
+                "smoothed_count": median(history),
+                "buses_detected": latest.buses_detected or 0,
+                "history": history,
+                "recent_buses": buses_by_stop.get(stop_id, []),
+                "updated_at": to_local_naive(latest.timestamp).isoformat(),
+            }
+        self.put_many(list(states.values()))
+        self.mark_empty([stop_id for stop_id in stop_ids if stop_id not in states])
+        return states
+
+    def get_or_load(self, db: Session, stop_ids: List[int]) -> Dict[int, Dict]:
+        """Состояния остановок: из Redis, недостающие - из БД (кроме отмеченных как пустые)"""
+        states, empty = self._fetch(stop_ids)
+        missing = [stop_id for stop_id in stop_ids if stop_id not in states and stop_id not in empty]
+        if missing:
+            states.update(self.load_from_db(db, missing))
+        return states
+
+
+# Глобальный экземпляр хранилища
+stop_state = StopStateStore()
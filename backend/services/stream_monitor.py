@@ -0,0 +1,452 @@
+"""
+Непрерывный мониторинг остановок по видеопотоку камеры
+Воркер анализирует поток с низкой частотой (детекция только при движении в кадре,
+пакетами), копит статистику по каждой остановке камеры и раз в интервал пишет
+агрегированную запись через load_writer. Короткие скопления людей и прибытия
+автобусов между минутными снимками не теряются.
+
+Один воркер на камеру: аренда в Redis не дает запустить второй, ее потеря
+(остановка через API) завершает воркер. При обрыве потока - переподключение
+с нарастающей паузой. MultiStreamMonitor обслуживает несколько камер в одном
+процессе через общий планировщик и одну модель
+"""
+import asyncio
+import json
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from core.config import settings
+from core.cache import get_redis
+from core.cameras import IS74_CAMERAS, get_stream_urls
+from services.cv_service import cv_service
+from services.video_processor import VideoProcessor, MotionGate, StreamLostError
+from services.stream_scheduler import MultiStreamScheduler
+from services.load_writer import load_writer
+from services.detection_bus import publish_camera_detections
+from services.stop_state import median
+
+# Как часто воркер продлевает аренду и обновляет статус, секунды
+HEARTBEAT_INTERVAL = 5.0
+
+
+def publish_results(camera_id: str, frame, results: Dict):
+    """Детекции кадра в шину: процессы API показывают их в потоке камеры и на снимках"""
+    publish_camera_detections(
+        camera_id, frame, results['people_detections'], results['buses'],
+        captured_at=results.get('timestamp'), frame_shape=results.get('frame_shape')
+    )
+
+
+def lease_key(camera_id: str) -> str:
+    return f"stream_monitor:{camera_id}"
+
+
+def status_key(camera_id: str) -> str:
+    return f"stream_monitor:{camera_id}:status"
+
+
+def get_status(camera_ids: List[str]) -> Dict[str, Dict]:
+    """Статусы воркеров камер (только запущенные)"""
+    if not camera_ids:
+        return {}
+    values = get_redis().mget([status_key(camera_id) for camera_id in camera_ids])
+    return {camera_id: json.loads(value) for camera_id, value in zip(camera_ids, values) if value}
+
+
+def starting_key(camera_id: str) -> str:
+    return f"stream_monitor:{camera_id}:starting"
+
+
+def is_running(camera_id: str) -> bool:
+    return bool(get_redis().exists(lease_key(camera_id)))
+
+
+def mark_starting(camera_id: str) -> bool:
+    """
+    Метка запуска воркера камеры до получения аренды (на STREAM_MONITOR_LEASE_TTL)
+    False - запуск уже поставлен в очередь, повторно ставить не нужно
+    """
+    return bool(get_redis().set(starting_key(camera_id), 1, nx=True, ex=settings.STREAM_MONITOR_LEASE_TTL))
+
+
+def request_stop(camera_id: str) -> bool:
+    """Остановка воркера камеры: воркер завершится при следующем продлении аренды"""
+    return bool(get_redis().delete(lease_key(camera_id)))
+
+
+def acquire_lease(camera_id: str, token: str) -> bool:
+    return bool(get_redis().set(lease_key(camera_id), token, nx=True, ex=settings.STREAM_MONITOR_LEASE_TTL))
+
+
+def renew_lease(camera_id: str, token: str, status: Dict) -> bool:
+    """Продление аренды и статуса; False - аренда потеряна (остановка через API или истекла)"""
+    redis = get_redis()
+    try:
+        if redis.get(lease_key(camera_id)) != token.encode():
+            return False
+        redis.expire(lease_key(camera_id), settings.STREAM_MONITOR_LEASE_TTL)
+        redis.set(status_key(camera_id), json.dumps(status), ex=settings.STREAM_MONITOR_LEASE_TTL)
+    except Exception as e:
+        # Временная недоступность Redis не должна останавливать поток
+        print(f"[STREAM] Камера {camera_id}: не удалось продлить аренду: {e}")
+    return True
+
+
+def release_lease(camera_id: str, token: str):
+    try:
+        redis = get_redis()
+        if redis.get(lease_key(camera_id)) == token.encode():
+            redis.delete(lease_key(camera_id))
+        redis.delete(status_key(camera_id))
+    except Exception as e:
+        print(f"[STREAM] Камера {camera_id}: не удалось снять аренду: {e}")
+
+
+class IntervalStats:
+    """Статистика остановки за интервал: выборки людей и прибывшие автобусы"""
+
+    def __init__(self):
+        self.started_at = datetime.now()
+        self.samples: List[int] = []
+        self.frames_detected = 0
+        self.frames_reused = 0
+        self.buses: List[Dict] = []
+        self._bus_numbers = set()
+        self.max_buses = 0
+        self.last_results: Optional[Dict] = None
+
+    def add(self, people_count: int, results: Dict, arrived: bool):
+        self.samples.append(people_count)
+        if results.get('reused'):
+            self.frames_reused += 1
+        else:
+            self.frames_detected += 1
+            self.last_results = results
+        self.max_buses = max(self.max_buses, results.get('buses_count', 0))
+        if not arrived:
+            return
+        for bus in results.get('buses', []):
+            number = bus.get('bus_number')
+            # Один и тот же автобус с распознанным номером учитывается один раз за интервал
+            if number and number in self._bus_numbers:
+                continue
+            if number:
+                self._bus_numbers.add(number)
+            self.buses.append(bus)
+
+    def summary(self, stop_zone) -> Dict:
+        """Результаты интервала в формате process_video_frame и статистика для detection_data"""
+        people_detections = self.last_results.get('people_detections', []) if self.last_results else []
+        results = {
+            'people_count': median(self.samples),
+            'people_detections': people_detections,
+            'buses': self.buses,
+            'buses_count': self.max_buses,
+            'stop_zone': stop_zone,
+        }
+        stats = {
+            'interval_start': self.started_at.isoformat(),
+            'samples': len(self.samples),
+            'people_min': min(self.samples),
+            'people_max': max(self.samples),
+            'people_mean': round(sum(self.samples) / len(self.samples), 2),
+            'frames_detected': self.frames_detected,
+            'frames_reused': self.frames_reused,
+            'buses_arrived': len(self.buses),
+        }
+        return {'results': results, 'stats': stats}
+
+
+class CameraAggregator:
+    """
+    Статистика интервала по остановкам одной камеры
+    stops: [{"id", "name", "stop_zone_coords"}]
+    """
+
+    def __init__(self, camera_id: str, stops: List[Dict]):
+        self.camera_id = camera_id
+        self.stops = []
+        self.zones = {}
+        for stop in stops:
+            zone = cv_service.zone_bbox(stop['stop_zone_coords'])
+            if zone is None:
+                # Без зоны люди считались бы по всему кадру - остановка пропускается
+                print(f"[STREAM] Камера {camera_id}: у остановки {stop['id']} не задана зона, пропуск")
+                continue
+            self.stops.append(stop)
+            self.zones[stop['id']] = zone
+        self.frames = 0
+        self.last_frame_at: Optional[datetime] = None
+        self._stats: Dict[int, IntervalStats] = {}
+        self._interval_start = time.monotonic()
+        self._prev_buses = 0
+
+    def add(self, results: Dict):
+        """Результаты кадра (build_zone_results по всему кадру)"""
+        self.frames += 1
+        self.last_frame_at = results['timestamp']
+        # Прибытие автобуса - рост числа автобусов в кадре по сравнению с предыдущей детекцией
+        arrived = False
+        if not results.get('reused'):
+            arrived = results['buses_count'] > self._prev_buses
+            self._prev_buses = results['buses_count']
+
+        for stop in self.stops:
+            people = cv_service.count_people_in_detections(results['people_detections'], self.zones[stop['id']])
+            self._stats.setdefault(stop['id'], IntervalStats()).add(people, results, arrived)
+
+    def interval_due(self) -> bool:
+        return time.monotonic() - self._interval_start >= settings.STREAM_STATS_INTERVAL
+
+    def flush(self, timestamp: Optional[datetime] = None):
+        """Передача статистики интервала в load_writer (запись - load_writer.flush())"""
+        stats, self._stats = self._stats, {}
+        self._interval_start = time.monotonic()
+        timestamp = timestamp or datetime.now()
+        for stop in self.stops:
+            stop_stats = stats.get(stop['id'])
+            if stop_stats is None or not stop_stats.samples:
+                continue
+            summary = stop_stats.summary(self.zones[stop['id']])
+            load_writer.add(stop['id'], summary['results'], timestamp=timestamp,
+                            stop_name=stop['name'], extra={'stream_stats': summary['stats']})
+
+
+def flush_load_writer():
+    try:
+        load_writer.flush()
+    except Exception:
+        # Записи остались в буфере load_writer до следующего интервала
+        pass
+
+
+class StreamMonitor:
+    """
+    Воркер видеопотока одной камеры для всех ее остановок
+    stops: [{"id", "name", "stop_zone_coords"}]
+    """
+
+    def __init__(self, camera_id: str, stops: List[Dict], stream_url: Optional[str] = None):
+        self.camera_id = camera_id
+        self.stops = stops
+        self.stream_urls = [stream_url] if stream_url else get_stream_urls(IS74_CAMERAS[camera_id])
+        self.aggregator = CameraAggregator(camera_id, stops)
+        self.processor = VideoProcessor()
+        self.token = uuid.uuid4().hex
+        self.deadline: Optional[float] = None
+
+        self.restarts = 0
+        self.stream_url: Optional[str] = None
+        self.connected = False
+        self.started_at = datetime.now()
+        self._last_heartbeat = 0.0
+        self._stopped = False
+
+    def _renew(self) -> bool:
+        return renew_lease(self.camera_id, self.token, self._status())
+
+    def _status(self) -> Dict:
+        return {
+            "camera_id": self.camera_id,
+            "mode": "camera",
+            "stop_ids": [stop['id'] for stop in self.aggregator.stops],
+            "started_at": self.started_at.isoformat(),
+            "connected": self.connected,
+            "stream_url": self.stream_url,
+            "restarts": self.restarts,
+            "frames": self.aggregator.frames,
+            "last_frame_at": self.aggregator.last_frame_at.isoformat() if self.aggregator.last_frame_at else None,
+            "pipeline": self.processor.get_stats(),
+        }
+
+    def _should_stop(self) -> bool:
+        return self._stopped or (self.deadline is not None and time.monotonic() >= self.deadline)
+
+    def _stop(self):
+        self._stopped = True
+        self.processor.stop_processing()
+
+    # --- Обработка результатов ---
+
+    async def _on_results(self, results: Dict):
+        self.aggregator.add(results)
+        await asyncio.to_thread(publish_results, self.camera_id, None, results)
+        if self.aggregator.interval_due():
+            # Запись в БД вне цикла событий: приемник конвейера не блокируется
+            await asyncio.to_thread(self._flush_interval)
+        now = time.monotonic()
+        if now - self._last_heartbeat >= HEARTBEAT_INTERVAL:
+            self._last_heartbeat = now
+            if not self._renew():
+                print(f"[STREAM] Камера {self.camera_id}: аренда потеряна, остановка")
+                self._stop()
+        if self._should_stop():
+            self._stop()
+
+    def _flush_interval(self):
+        """Запись статистики интервала по всем остановкам камеры одной транзакцией"""
+        self.aggregator.flush()
+        flush_load_writer()
+
+    # --- Цикл с переподключением ---
+
+    def _run_stream(self) -> bool:
+        """Один сеанс потока с перебором URL; True - поток работал до остановки"""
+        for url in self.stream_urls:
+            if self._should_stop():
+                return True
+            try:
+                self.connected = True
+                self.stream_url = url
+                asyncio.run(self.processor.process_stream(
+                    url,
+                    stop_zone_coords=None,
+                    callback=self._on_results,
+                    fps=settings.STREAM_MONITOR_FPS,
+                    motion_gate=MotionGate(settings.STREAM_MOTION_THRESHOLD, settings.STREAM_MOTION_MAX_IDLE),
+                    batch_size=settings.STREAM_MONITOR_BATCH,
+                    cpu_budget=settings.STREAM_CPU_BUDGET
+                ))
+                return True
+            except StreamLostError as e:
+                print(f"[STREAM] Камера {self.camera_id}: {e}")
+            finally:
+                self.connected = False
+        return False
+
+    def run(self, duration: Optional[float] = None) -> Dict:
+        """
+        Работа воркера до остановки через API, истечения duration или потери аренды
+        Returns:
+            Итоговый статус воркера
+        """
+        if not self.aggregator.stops:
+            return {"error": f"No stops with a zone for camera {self.camera_id}"}
+        if not acquire_lease(self.camera_id, self.token):
+            return {"error": f"Stream monitor for camera {self.camera_id} is already running"}
+        self.deadline = time.monotonic() + duration if duration else None
+        print(f"[STREAM] Камера {self.camera_id}: запуск мониторинга потока, остановки {[stop['id'] for stop in self.aggregator.stops]}")
+
+        delay = settings.STREAM_RECONNECT_DELAY
+        try:
+            self._renew()
+            while not self._should_stop():
+                frames_before = self.aggregator.frames
+                self._run_stream()
+                if self._should_stop():
+                    break
+                # Поток оборвался: пауза растет, пока поток не отдает кадры
+                self.restarts += 1
+                if self.aggregator.frames > frames_before:
+                    delay = settings.STREAM_RECONNECT_DELAY
+                print(f"[STREAM] Камера {self.camera_id}: переподключение через {delay:.0f} с (попытка {self.restarts})")
+                waited = 0.0
+                while waited < delay and not self._should_stop():
+                    time.sleep(min(HEARTBEAT_INTERVAL, delay - waited))
+                    waited += HEARTBEAT_INTERVAL
+                    if not self._renew():
+                        self._stopped = True
+                delay = min(delay * 2, settings.STREAM_RECONNECT_MAX_DELAY)
+        finally:
+            self._flush_interval()
+            release_lease(self.camera_id, self.token)
+            print(f"[STREAM] Камера {self.camera_id}: мониторинг потока остановлен, кадров: {self.aggregator.frames}")
+        return self._status()
+
+
+class MultiStreamMonitor:
+    """
+    Мониторинг нескольких камер в одном процессе: захват каждой камеры в своем
+    потоке, детекция пакетами общей моделью через MultiStreamScheduler
+    cameras: camera_id -> [{"id", "name", "stop_zone_coords"}]
+    """
+
+    def __init__(self, cameras: Dict[str, List[Dict]]):
+        self.cameras = cameras
+        self.token = uuid.uuid4().hex
+        self.aggregators: Dict[str, CameraAggregator] = {}
+        self.scheduler = MultiStreamScheduler(
+            batch_size=settings.DETECTION_BATCH_SIZE,
+            motion_threshold=settings.STREAM_MOTION_THRESHOLD
+        )
+        self.started_at = datetime.now()
+        self.deadline: Optional[float] = None
+        self._last_heartbeat = 0.0
+        self._last_flush = time.monotonic()
+
+    def _status(self, camera_id: str) -> Dict:
+        aggregator = self.aggregators[camera_id]
+        source = self.scheduler.get_stats().get(camera_id, {})
+        return {
+            "camera_id": camera_id,
+            "mode": "scheduler",
+            "stop_ids": [stop['id'] for stop in aggregator.stops],
+            "started_at": self.started_at.isoformat(),
+            "connected": source.get("connected", False),
+            "restarts": source.get("restarts", 0),
+            "frames": aggregator.frames,
+            "last_frame_at": aggregator.last_frame_at.isoformat() if aggregator.last_frame_at else None,
+            "scheduler": source,
+        }
+
+    def _on_results(self, camera_id: str, frame, results: Dict):
+        aggregator = self.aggregators.get(camera_id)
+        if aggregator is not None:
+            aggregator.add(results)
+            publish_results(camera_id, frame, results)
+
+    def _heartbeat(self):
+        for camera_id in list(self.aggregators.keys()):
+            if not renew_lease(camera_id, self.token, self._status(camera_id)):
+                print(f"[STREAM] Камера {camera_id}: аренда потеряна, камера исключена из планировщика")
+                self.scheduler.remove_source(camera_id)
+                self.aggregators.pop(camera_id).flush()
+
+    def _flush(self):
+        for aggregator in self.aggregators.values():
+            aggregator.flush()
+        flush_load_writer()
+
+    def run(self, duration: Optional[float] = None) -> Dict:
+        """
+        Работа до истечения duration или потери аренды всех камер
+        Returns:
+            Счетчики планировщика по камерам
+        """
+        for camera_id, stops in self.cameras.items():
+            aggregator = CameraAggregator(camera_id, stops)
+            if not aggregator.stops:
+                continue
+            if not acquire_lease(camera_id, self.token):
+                print(f"[STREAM] Камера {camera_id}: уже обрабатывается другим воркером, пропуск")
+                continue
+            self.aggregators[camera_id] = aggregator
+            fps = settings.STREAM_CAMERA_FPS.get(camera_id, settings.STREAM_MONITOR_FPS)
+            self.scheduler.add_source(camera_id, get_stream_urls(IS74_CAMERAS[camera_id]), fps)
+        if not self.aggregators:
+            return {"error": "All cameras are already monitored"}
+
+        self.deadline = time.monotonic() + duration if duration else None
+        print(f"[STREAM] Планировщик потоков запущен, камеры: {self.scheduler.camera_ids}")
+        stats = {}
+        try:
+            while self.aggregators and (self.deadline is None or time.monotonic() < self.deadline):
+                self.scheduler.step(self._on_results)
+                now = time.monotonic()
+                if now - self._last_heartbeat >= HEARTBEAT_INTERVAL:
+                    self._last_heartbeat = now
+                    self._heartbeat()
+                # Интервалы всех камер записываются вместе - одна транзакция
+                if now - self._last_flush >= settings.STREAM_STATS_INTERVAL:
+                    self._last_flush = now
+                    self._flush()
+        finally:
+            stats = self.scheduler.get_stats()
+            self.scheduler.stop()
+            self._flush()
+            for camera_id in self.aggregators:
+                release_lease(camera_id, self.token)
+            print(f"[STREAM] Планировщик потоков остановлен: {stats}")
+        return {"cameras": stats}
@@ -0,0 +1,303 @@
+"""
+Планировщик нескольких видеопотоков с одной моделью
+Каждая камера захватывается в своем потоке, хранится только последний кадр.
+Планировщик собирает кадры камер, подошедших по расписанию, в пакеты для общей
+модели: камеры с более ранним сроком обрабатываются первыми (EDF), при равных
+сроках - по очереди, поэтому при перегрузке все камеры замедляются равномерно
+"""
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from core.config import settings
+from services.cv_service import cv_service
+from services.frame_sampler import FrameSampler
+from services.frame_transport import create_frame_ring
+from services.video_processor import MotionGate
+
+
+class CaptureSource:
+    """
+    Захват одного потока: последний кадр с частотой не выше fps по часам потока,
+    переподключение с нарастающей паузой. Кадры между отсчетами только
+    захватываются (grab, см. FrameSampler)
+    """
+
+    def __init__(self, camera_id: str, urls: List[str], fps: float, notify: threading.Event):
+        self.camera_id = camera_id
+        self.urls = urls
+        self.sampler = FrameSampler(fps, ring=create_frame_ring())
+        self.notify = notify
+        self.connected = False
+        self.stream_url: Optional[str] = None
+        self.restarts = 0
+        # Кадры, замененные новыми до того, как их забрал планировщик
+        self.overwritten = 0
+
+        self._frame: Optional[np.ndarray] = None
+        self._captured_at: Optional[datetime] = None
+        self._captured_mono = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"capture-{self.camera_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout: Optional[float] = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def frame_age(self) -> Optional[float]:
+        """Возраст непрочитанного кадра, секунды (None - нового кадра нет)"""
+        with self._lock:
+            if self._frame is None:
+                return None
+            return time.monotonic() - self._captured_mono
+
+    def take(self):
+        """Непрочитанный кадр (frame, captured_at, captured_mono) или None"""
+        with self._lock:
+            if self._frame is None:
+                return None
+            item = (self._frame, self._captured_at, self._captured_mono)
+            self._frame = None
+            return item
+
+    def _open(self) -> Optional[cv2.VideoCapture]:
+        for url in self.urls:
+            if self._stop.is_set():
+                return None
+            cap = cv2.VideoCapture(url)
+            if cap.isOpened():
+                self.stream_url = url
+                return cap
+            cap.release()
+        return None
+
+    def _capture(self, cap: cv2.VideoCapture) -> int:
+        """Чтение потока до обрыва или остановки; возвращает число кадров"""
+        frames = 0
+        self.sampler.reset()
+        while not self._stop.is_set():
+            ok, frame = self.sampler.read(cap)
+            if not ok:
+                break
+            if frame is None:
+                continue
+            now = time.monotonic()
+            with self._lock:
+                if self._frame is not None:
+                    self.overwritten += 1
+                self._frame = frame
+                self._captured_at = datetime.now()
+                self._captured_mono = now
+            frames += 1
+            self.notify.set()
+        return frames
+
+    def _run(self):
+        delay = settings.STREAM_RECONNECT_DELAY
+        while not self._stop.is_set():
+            cap = self._open()
+            frames = 0
+            if cap is not None:
+                self.connected = True
+                try:
+                    frames = self._capture(cap)
+                except Exception as e:
+                    print(f"[SCHEDULER] Камера {self.camera_id}: ошибка захвата: {e}")
+                finally:
+                    cap.release()
+                    self.connected = False
+            if self._stop.is_set():
+                break
+            self.restarts += 1
+            if frames:
+                delay = settings.STREAM_RECONNECT_DELAY
+            print(f"[SCHEDULER] Камера {self.camera_id}: поток недоступен, переподключение через {delay:.0f} с")
+            self._stop.wait(delay)
+            delay = min(delay * 2, settings.STREAM_RECONNECT_MAX_DELAY)
+        if self.sampler.ring is not None:
+            self.sampler.ring.close()
+
+
+class ScheduledStream:
+    """Расписание и счетчики одного потока в планировщике"""
+
+    def __init__(self, source: CaptureSource, fps: float, motion_gate: Optional[MotionGate]):
+        self.source = source
+        self.fps = fps
+        self.interval = 1.0 / fps
+        self.motion_gate = motion_gate
+        self.next_due = time.monotonic()
+        self.turn = 0  # Порядок при равных сроках (очередь)
+        self.last_results: Optional[Dict] = None
+
+        self.processed = 0
+        self.reused = 0
+        self.stale = 0
+        self.deadline_missed = 0
+        self.effective_fps = 0.0
+        self._last_served: Optional[float] = None
+
+    def served(self, now: float):
+        """Обновление расписания и фактического FPS после обработки кадра"""
+        if now > self.next_due + self.interval:
+            self.deadline_missed += 1
+        if self._last_served is not None:
+            rate = 1.0 / max(now - self._last_served, 1e-3)
+            self.effective_fps = rate if self.effective_fps == 0 else 0.8 * self.effective_fps + 0.2 * rate
+        self._last_served = now
+        # Срок следующего кадра от предыдущего срока: отставание не накапливается.
+        # После разрыва больше интервала (кадров не было) сетка начинается от текущего кадра,
+        # иначе следующий кадр тоже оказался бы просроченным и был бы обработан сразу
+        if now - self.next_due >= self.interval:
+            self.next_due = now + self.interval
+        else:
+            self.next_due += self.interval
+
+    def snapshot(self) -> Dict:
+        return {
+            "target_fps": self.fps,
+            "effective_fps": round(self.effective_fps, 2),
+            "processed": self.processed,
+            "reused": self.reused,
+            "stale": self.stale,
+            "deadline_missed": self.deadline_missed,
+            "overwritten": self.source.overwritten,
+            "connected": self.source.connected,
+            "restarts": self.source.restarts,
+            "sampler": self.source.sampler.snapshot(),
+        }
+
+
+class MultiStreamScheduler:
+    """
+    Обработка N потоков одной моделью
+    step() выполняет один пакет: выбирает подошедшие по сроку камеры со свежими
+    кадрами, отбрасывает кадры старше max_frame_age, запускает детекцию пакетом
+    и вызывает on_results(camera_id, frame, results) для каждой камеры пакета
+    """
+
+    def __init__(self, batch_size: Optional[int] = None, max_frame_age: Optional[float] = None,
+                 motion_threshold: Optional[float] = None, motion_max_idle: Optional[float] = None):
+        self.batch_size = max(1, batch_size or settings.DETECTION_BATCH_SIZE)
+        self.max_frame_age = max_frame_age or settings.STREAM_SCHEDULER_MAX_FRAME_AGE
+        self.motion_threshold = motion_threshold
+        self.motion_max_idle = motion_max_idle or settings.STREAM_MOTION_MAX_IDLE
+        self._streams: Dict[str, ScheduledStream] = {}
+        self._notify = threading.Event()
+        self._turn = 0
+
+    def add_source(self, camera_id: str, urls: List[str], fps: float):
+        source = CaptureSource(camera_id, urls, fps, self._notify)
+        gate = MotionGate(self.motion_threshold, self.motion_max_idle) if self.motion_threshold else None
+        self._streams[camera_id] = ScheduledStream(source, fps, gate)
+        source.start()
+
+    def remove_source(self, camera_id: str):
+        stream = self._streams.pop(camera_id, None)
+        if stream is not None:
+            stream.source.stop()
+
+    @property
+    def camera_ids(self) -> List[str]:
+        return list(self._streams.keys())
+
+    def stop(self):
+        for stream in self._streams.values():
+            stream.source.stop()
+        for stream in self._streams.values():
+            stream.source.join(timeout=5.0)
+
+    def get_stats(self) -> Dict[str, Dict]:
+        return {camera_id: stream.snapshot() for camera_id, stream in self._streams.items()}
+
+    def _due_streams(self, now: float) -> List[str]:
+        due = []
+        for camera_id, stream in self._streams.items():
+            if now < stream.next_due:
+                continue
+            age = stream.source.frame_age()
+            if age is None:
+                continue
+            if age > self.max_frame_age:
+                # Кадр устарел (планировщик отстал) - не тратим на него модель
+                stream.source.take()
+                stream.stale += 1
+                continue
+            due.append(camera_id)
+        # Ранний срок - первым, при равных сроках - кто дольше ждал очереди
+        due.sort(key=lambda camera_id: (self._streams[camera_id].next_due, self._streams[camera_id].turn))
+        return due
+
+    def _wait(self, now: float, timeout: float):
+        """
+        Ожидание нового кадра или ближайшего срока
+        Просроченные потоки без кадра не учитываются: их кадр разбудит цикл через _notify
+        """
+        next_due = min((stream.next_due for stream in self._streams.values() if stream.next_due > now),
+                       default=now + timeout)
+        self._notify.wait(min(timeout, max(0.005, next_due - now)))
+        self._notify.clear()
+
+    def step(self, on_results: Callable, timeout: float = 0.5) -> int:
+        """
+        Один цикл планировщика
+        Returns:
+            Количество обработанных камер (0 - ожидание кадров)
+        """
+        now = time.monotonic()
+        due = self._due_streams(now)
+        if not due:
+            self._wait(now, timeout)
+            return 0
+
+        batch = []
+        served = 0
+        for camera_id in due:
+            stream = self._streams[camera_id]
+            item = stream.source.take()
+            if item is None:
+                continue
+            frame, captured_at, _ = item
+            self._turn += 1
+            stream.turn = self._turn
+            if stream.motion_gate is not None and not stream.motion_gate.check(frame) \
+                    and stream.last_results is not None:
+                # Без движения модель не запускается, место в пакете получает другая камера
+                stream.reused += 1
+                stream.served(time.monotonic())
+                on_results(camera_id, frame, dict(stream.last_results, timestamp=captured_at, reused=True))
+                served += 1
+                continue
+            batch.append((camera_id, frame, captured_at))
+            if len(batch) >= self.batch_size:
+                break
+
+        if not batch:
+            return served
+
+        detections_list = cv_service.detect_objects_batch([frame for _, frame, _ in batch])
+        now = time.monotonic()
+        for (camera_id, frame, captured_at), detections in zip(batch, detections_list):
+            stream = self._streams.get(camera_id)
+            if stream is None:
+                continue
+            buses_info = cv_service.recognize_buses(frame, detections['buses']) if detections['buses'] else []
+            results = cv_service.build_zone_results(frame, detections, buses_info)
+            results['timestamp'] = captured_at
+            stream.last_results = results
+            stream.processed += 1
+            stream.served(now)
+            on_results(camera_id, frame, results)
+        return served + len(batch)
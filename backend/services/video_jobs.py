@@ -0,0 +1,328 @@
+"""
+Офлайн обработка видеофайлов
+Файл делится на отрезки по времени, отрезки обрабатываются параллельно в пуле
+процессов: каждый процесс перематывает файл к началу своего отрезка и отбирает
+кадры по времени видео (FrameSampler). Результат - количество людей и автобусов
+по секундам и, по запросу, аннотированное видео
+"""
+import asyncio
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from statistics import median
+from typing import AsyncIterator, Dict, List, Optional
+
+import cv2
+
+from core.config import settings
+from services.frame_sampler import FrameSampler
+from services.frame_transport import create_frame_ring
+
+
+class VideoJobError(Exception):
+    """Видеофайл не удалось открыть или обработать"""
+    pass
+
+
+def _init_worker():
+    # Параллельность дает пул процессов: внутренние потоки OpenCV и torch только мешают друг другу
+    cv2.setNumThreads(1)
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+
+
+def probe_video(path: str) -> Dict:
+    """Длительность и параметры видеофайла"""
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            raise VideoJobError("Не удалось открыть видеофайл")
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if fps <= 0 or total_frames <= 0:
+            raise VideoJobError("Не удалось определить длительность видео")
+        return {
+            "fps": fps,
+            "total_frames": total_frames,
+            "duration": total_frames / fps,
+            "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        }
+    finally:
+        cap.release()
+
+
+def process_segment(path: str, index: int, start: float, end: float, fps: float,
+                    output_path: Optional[str] = None) -> Dict:
+    """
+    Обработка отрезка [start, end) видео в процессе пула
+    Returns:
+        {"index", "frames", "samples": [[время, люди, автобусы], ...], "output"}
+    """
+    # Импорт в процессе пула: модели загружаются один раз на процесс
+    from services.cv_service import cv_service
+
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise VideoJobError(f"Не удалось открыть видеофайл (отрезок {index})")
+    writer = None
+    samples = []
+    batch = []
+
+    def flush():
+        for (position, frame), detections in zip(batch, cv_service.detect_objects_batch([frame for _, frame in batch])):
+            samples.append([round(position, 3), len(detections['people']), len(detections['buses'])])
+            if writer is not None:
+                writer.write(cv_service.draw_detections(frame, detections))
+        batch.clear()
+
+    # При внешнем сервисе инференса кадры декодируются в кольцевой буфер разделяемой памяти
+    sampler = FrameSampler(fps, ring=create_frame_ring())
+    sampler.reset(start)
+    try:
+        if start > 0:
+            cap.set(cv2.CAP_PROP_POS_MSEC, start * 1000.0)
+        while True:
+            ok, frame = sampler.read(cap)
+            if not ok:
+                break
+            position = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            if position >= end:
+                break
+            if frame is None:
+                continue
+            if output_path is not None and writer is None:
+                height, width = frame.shape[:2]
+                writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+            batch.append((position, frame))
+            if len(batch) >= settings.DETECTION_BATCH_SIZE:
+                flush()
+        if batch:
+            flush()
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.release()
+        if sampler.ring is not None:
+            sampler.ring.close()
+
+    return {
+        "index": index,
+        "frames": len(samples),
+        "samples": samples,
+        "output": output_path if writer is not None else None,
+    }
+
+
+def per_second_counts(samples: List[List[float]]) -> List[Dict]:
+    """Медиана людей и максимум автобусов по секундам видео"""
+    seconds: Dict[int, List] = {}
+    for position, people, buses in samples:
+        seconds.setdefault(int(position), []).append((people, buses))
+    return [
+        {
+            "second": second,
+            "people_count": int(median(people for people, _ in items)),
+            "buses_count": max(buses for _, buses in items),
+            "samples": len(items),
+        }
+        for second, items in sorted(seconds.items())
+    ]
+
+
+class VideoJobService:
+    """Пул процессов офлайн обработки и каталог результатов"""
+
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+    @property
+    def workers(self) -> int:
+        return settings.VIDEO_JOB_WORKERS or os.cpu_count() or 1
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Пул общий для всех задач: модели загружаются в процессы пула один раз.
+        # spawn - процессы API уже содержат потоки и загруженные модели, fork их не переносит
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker
+                )
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(settings.VIDEO_JOB_DIR, job_id)
+
+    def output_path(self, job_id: str) -> Optional[str]:
+        """Готовое аннотированное видео задачи или None"""
+        if not job_id.isalnum():
+            return None
+        path = os.path.join(self.job_dir(job_id), "output.mp4")
+        return path if os.path.isfile(path) else None
+
+    def _cleanup(self):
+        """Удаление каталогов задач старше VIDEO_JOB_TTL"""
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        if not os.path.isdir(settings.VIDEO_JOB_DIR):
+            return
+        for name in os.listdir(settings.VIDEO_JOB_DIR):
+            path = os.path.join(settings.VIDEO_JOB_DIR, name)
+            try:
+                if now - os.path.getmtime(path) > settings.VIDEO_JOB_TTL:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def create_job(self) -> str:
+        """Новый каталог задачи; возвращает job_id"""
+        self._cleanup()
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.job_dir(job_id))
+        return job_id
+
+    @staticmethod
+    def _concat(parts: List[str], output: str):
+        """Склейка отрезков в H.264 MP4 для воспроизведения в браузере"""
+        list_path = output + ".txt"
+        with open(list_path, "w") as f:
+            for part in parts:
+                f.write(f"file '{part}'\n")
+        command = [
+            settings.FFMPEG_PATH, "-loglevel", "error", "-y",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+            "-movflags", "+faststart",
+            output,
+        ]
+        try:
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=3600)
+        except subprocess.CalledProcessError as e:
+            raise VideoJobError(f"Ошибка склейки видео: {e.stderr.decode(errors='replace').strip()}")
+        finally:
+            for path in parts + [list_path]:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    async def run(self, job_id: str, path: str, fps: Optional[float] = None,
+                  save_output: bool = False) -> AsyncIterator[Dict]:
+        """
+        Обработка файла задачи; выдает события started, progress и result
+        При закрытии генератора (клиент отключился) необработанные отрезки отменяются
+
+        Raises:
+            VideoJobError: файл не открылся или обработка отрезка завершилась ошибкой
+        """
+        started = time.monotonic()
+        info = await asyncio.to_thread(probe_video, path)
+        fps = min(fps or settings.VIDEO_JOB_FPS, info["fps"])
+        duration = info["duration"]
+
+        segment_seconds = settings.VIDEO_JOB_SEGMENT_SECONDS
+        bounds = []
+        position = 0.0
+        while position < duration:
+            bounds.append((position, min(position + segment_seconds, duration)))
+            position += segment_seconds
+        # Последний отрезок открыт справа: кадры после расчетной длительности не теряются
+        bounds[-1] = (bounds[-1][0], float("inf"))
+
+        output_available = save_output and shutil.which(settings.FFMPEG_PATH) is not None
+        job_dir = self.job_dir(job_id)
+        executor = self._get_executor()
+        loop = asyncio.get_running_loop()
+        futures = [
+            loop.run_in_executor(
+                executor, process_segment, path, index, start, end, fps,
+                os.path.join(job_dir, f"segment_{index:05d}.mp4") if output_available else None
+            )
+            for index, (start, end) in enumerate(bounds)
+        ]
+
+        yield {
+            "event": "started",
+            "job_id": job_id,
+            "duration": round(duration, 3),
+            "total_frames": info["total_frames"],
+            "fps": fps,
+            "segments": len(bounds),
+            "workers": min(self.workers, len(bounds)),
+        }
+
+        results: List[Dict] = []
+        try:
+            for future in asyncio.as_completed(futures):
+                try:
+                    results.append(await future)
+                except VideoJobError:
+                    raise
+                except Exception as e:
+                    raise VideoJobError(f"Ошибка обработки отрезка: {e}")
+                processed = sum(result["frames"] for result in results)
+                yield {
+                    "event": "progress",
+                    "segments_done": len(results),
+                    "segments": len(bounds),
+                    "frames_processed": processed,
+                    "percent": round(100.0 * len(results) / len(bounds), 1),
+                }
+        finally:
+            for future in futures:
+                future.cancel()
+
+        results.sort(key=lambda result: result["index"])
+        samples = [sample for result in results for sample in result["samples"]]
+
+        output_url = None
+        output_error = None
+        if save_output:
+            parts = [result["output"] for result in results if result["output"]]
+            if not output_available:
+                output_error = f"ffmpeg не найден ({settings.FFMPEG_PATH}), аннотированное видео не записано"
+            elif parts:
+                try:
+                    await asyncio.to_thread(self._concat, parts, os.path.join(job_dir, "output.mp4"))
+                    output_url = f"/api/v1/cv/process-video/{job_id}/output"
+                except VideoJobError as e:
+                    output_error = str(e)
+
+        result = {
+            "event": "result",
+            "job_id": job_id,
+            "duration": round(duration, 3),
+            "total_frames": info["total_frames"],
+            "frames_processed": len(samples),
+            "fps": fps,
+            "per_second": per_second_counts(samples),
+            "output_url": output_url,
+            "processing_seconds": round(time.monotonic() - started, 2),
+        }
+        if output_error:
+            result["output_error"] = output_error
+        yield result
+
+
+# Глобальный экземпляр сервиса
+video_jobs = VideoJobService()
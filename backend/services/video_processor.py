@@ -3,70 +3,507 @@
 """
 import cv2
 import asyncio
+import concurrent.futures
+import queue
+import threading
+import time
 from typing import Optional, Callable, Dict, List
 from datetime import datetime
 import numpy as np
 
 from services.cv_service import cv_service
+from services.frame_sampler import FrameSampler
+from services.frame_transport import create_frame_ring
 from core.config import settings
 
 
+class StreamLostError(Exception):
+    """Видеопоток не открылся или оборвался"""
+    pass
+
+
+class MotionGate:
+    """
+    Отбор кадров для детекции по движению
+    Кадр сравнивается с последним кадром, отправленным на детекцию, в уменьшенном
+    сером виде. Без движения детекция не выполняется, но не реже max_idle секунд
+    """
+    
+    def __init__(self, threshold: float, max_idle: float, width: int = 160):
+        self.threshold = threshold  # Доля изменившихся пикселей
+        self.max_idle = max_idle
+        self.width = width
+        self._reference: Optional[np.ndarray] = None
+        self._last_passed = 0.0
+    
+    def _prepare(self, frame: np.ndarray) -> np.ndarray:
+        h, w = frame.shape[:2]
+        small = cv2.resize(frame, (self.width, max(1, int(h * self.width / w))), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(gray, (5, 5), 0)
+    
+    def check(self, frame: np.ndarray) -> bool:
+        """True - кадр нужно отправить на детекцию"""
+        prepared = self._prepare(frame)
+        now = time.monotonic()
+        if (self._reference is None or self._reference.shape != prepared.shape
+                or now - self._last_passed >= self.max_idle):
+            passed = True
+        else:
+            diff = cv2.absdiff(prepared, self._reference)
+            changed = np.count_nonzero(diff > 25) / diff.size
+            passed = changed >= self.threshold
+        if passed:
+            self._reference = prepared
+            self._last_passed = now
+        return passed
+
+
+class CpuBudget:
+    """
+    Ограничение процессорного времени обработки потока
+    fraction - доля одного ядра; после каждого шага вычисляется пауза,
+    при которой потребление не превышает бюджет
+    """
+    
+    def __init__(self, fraction: float):
+        self.fraction = fraction
+        self._cpu_start = 0.0
+        self._wall_start = 0.0
+    
+    def start(self):
+        self._cpu_start = time.process_time()
+        self._wall_start = time.monotonic()
+    
+    def delay(self) -> float:
+        """Пауза после шага обработки, секунды"""
+        if self.fraction <= 0:
+            return 0.0
+        cpu_used = time.process_time() - self._cpu_start
+        wall_used = time.monotonic() - self._wall_start
+        return max(0.0, cpu_used / self.fraction - wall_used)
+
+
+# Маркер конца потока в очередях конвейера
+END_OF_STREAM = object()
+
+# Политики переполнения очередей конвейера
+DROP_POLICIES = ("oldest", "newest", "block")
+
+
+class StageStats:
+    """Счетчики стадии конвейера: обработано, отброшено, пропускная способность, задержка"""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.fps = 0.0
+        self.latency_avg = 0.0
+        self.latency_max = 0.0
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._lock = threading.Lock()
+    
+    def record(self, latency: float, count: int = 1):
+        """Учет обработанных элементов; latency - задержка от захвата кадра, секунды"""
+        with self._lock:
+            self.processed += count
+            self._window_count += count
+            self.latency_avg = latency if self.processed == count else 0.9 * self.latency_avg + 0.1 * latency
+            self.latency_max = max(self.latency_max, latency)
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            if elapsed >= 1.0:
+                self.fps = self._window_count / elapsed
+                self._window_start = now
+                self._window_count = 0
+    
+    def drop(self, count: int = 1):
+        with self._lock:
+            self.dropped += count
+    
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "fps": round(self.fps, 2),
+                "latency_avg_ms": round(self.latency_avg * 1000, 1),
+                "latency_max_ms": round(self.latency_max * 1000, 1),
+            }
+
+
+class StageQueue:
+    """
+    Ограниченная очередь между потоками конвейера
+    При переполнении: oldest - вытесняется самый старый элемент (живой поток,
+    важна свежесть), newest - отбрасывается новый, block - ожидание места
+    """
+    
+    def __init__(self, maxsize: int, policy: str, stats: StageStats):
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(1, maxsize))
+        self.policy = policy
+        self.stats = stats
+    
+    def put(self, item, stop: threading.Event):
+        if item is END_OF_STREAM or self.policy == "oldest":
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self.stats.drop()
+                    except queue.Empty:
+                        pass
+        if self.policy == "newest":
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.stats.drop()
+            return
+        while not stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        self.stats.drop()
+    
+    def get(self, timeout: Optional[float] = None):
+        """Элемент очереди; queue.Empty по таймауту"""
+        if timeout == 0:
+            return self._queue.get_nowait()
+        return self._queue.get(timeout=timeout)
+
+
+class ResultQueue:
+    """Ограниченная очередь из потока инференса в цикл событий (асинхронный приемник)"""
+    
+    def __init__(self, loop: asyncio.AbstractEventLoop, maxsize: int, policy: str, stats: StageStats):
+        self.loop = loop
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, maxsize))
+        self.policy = policy
+        self.stats = stats
+        # Приемник завершен - потоки больше не ждут очередь
+        self.closed = False
+    
+    def _put_nowait(self, item):
+        # Выполняется в цикле событий
+        if self._queue.full():
+            if self.policy == "newest" and item is not END_OF_STREAM:
+                self.stats.drop()
+                return
+            self._queue.get_nowait()
+            self.stats.drop()
+        self._queue.put_nowait(item)
+    
+    def put(self, item, stop: threading.Event):
+        """
+        Передача из потока; при политике block поток ждет места в очереди
+        Маркер конца ожидает всегда: приемник дочитывает очередь до него
+        """
+        if self.closed:
+            return
+        if self.policy != "block" and item is not END_OF_STREAM:
+            try:
+                self.loop.call_soon_threadsafe(self._put_nowait, item)
+            except RuntimeError:
+                # Цикл событий уже закрыт
+                pass
+            return
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._queue.put(item), self.loop)
+        except RuntimeError:
+            return
+        while True:
+            try:
+                future.result(timeout=0.5)
+                return
+            except concurrent.futures.TimeoutError:
+                if self.closed or (stop.is_set() and item is not END_OF_STREAM):
+                    future.cancel()
+                    self.stats.drop()
+                    return
+    
+    async def get(self):
+        return await self._queue.get()
+
+
+class StreamPipeline:
+    """
+    Конвейер обработки видеопотока из трех стадий:
+    декодирование (поток) -> инференс (поток) -> приемник (корутина в цикле событий)
+    Стадии связаны ограниченными очередями, поэтому декодирование следующих кадров
+    идет параллельно с детекцией текущих, а цикл событий не блокируется
+    """
+    
+    def __init__(
+        self,
+        stream_url: str,
+        stop_zone_coords: Optional[List[List[float]]],
+        fps: float,
+        motion_gate: Optional[MotionGate] = None,
+        batch_size: int = 1,
+        cpu_budget: Optional[float] = None,
+        queue_size: int = 4,
+        drop_policy: str = "oldest",
+        sink_policy: str = "block"
+    ):
+        if drop_policy not in DROP_POLICIES or sink_policy not in DROP_POLICIES:
+            raise ValueError(f"Неизвестная политика очереди, допустимы: {DROP_POLICIES}")
+        self.stream_url = stream_url
+        self.stop_zone_coords = stop_zone_coords
+        # При внешнем сервисе инференса кадры декодируются в кольцевой буфер разделяемой памяти
+        self.sampler = FrameSampler(fps, ring=create_frame_ring())
+        self.motion_gate = motion_gate
+        self.batch_size = max(1, batch_size)
+        self.budget = CpuBudget(cpu_budget) if cpu_budget else None
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.sink_policy = sink_policy
+        
+        self.stats = {name: StageStats(name) for name in ("decode", "inference", "sink")}
+        self.error: Optional[BaseException] = None
+        self._stop = threading.Event()
+        self._frames = StageQueue(queue_size, drop_policy, self.stats["decode"])
+        self._results: Optional[ResultQueue] = None
+        self._reused = 0
+    
+    def stop(self):
+        self._stop.set()
+    
+    def _fail(self, error: BaseException):
+        if self.error is None:
+            self.error = error
+        self._stop.set()
+    
+    def get_stats(self) -> Dict:
+        stats = {name: stage.snapshot() for name, stage in self.stats.items()}
+        stats["inference"]["reused"] = self._reused
+        stats["decode"]["sampler"] = self.sampler.snapshot()
+        return stats
+    
+    # --- Стадия декодирования ---
+    
+    def _decode(self):
+        cap = None
+        try:
+            cap = cv2.VideoCapture(self.stream_url)
+            if not cap.isOpened():
+                raise StreamLostError(f"Не удалось открыть видеопоток: {self.stream_url}")
+            while not self._stop.is_set():
+                # Кадры между отсчетами только захватываются, без декодирования
+                started = time.monotonic()
+                ok, frame = self.sampler.read(cap)
+                if not ok:
+                    raise StreamLostError(f"Видеопоток прерван: {self.stream_url}")
+                if frame is None:
+                    continue
+                grabbed_at = time.monotonic()
+                self.stats["decode"].record(grabbed_at - started)
+                self._frames.put({"frame": frame, "captured_at": datetime.now(), "t0": grabbed_at}, self._stop)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            if cap is not None:
+                cap.release()
+            if self.sampler.ring is not None:
+                self.sampler.ring.close()
+            self._frames.put(END_OF_STREAM, self._stop)
+    
+    # --- Стадия инференса ---
+    
+    def _collect_batch(self) -> Optional[List[Dict]]:
+        """
+        Первый кадр с ожиданием, остальные - только уже готовые: пакет набирается,
+        когда инференс отстает от декодирования, и не добавляет задержку
+        None - поток закончился
+        """
+        while True:
+            try:
+                item = self._frames.get(timeout=0.5)
+                break
+            except queue.Empty:
+                if self._stop.is_set():
+                    return None
+        if item is END_OF_STREAM:
+            return None
+        items = [item]
+        while len(items) < self.batch_size:
+            try:
+                item = self._frames.get(timeout=0)
+            except queue.Empty:
+                break
+            if item is END_OF_STREAM:
+                # Вернем маркер, чтобы завершиться после обработки пакета
+                self._frames.put(END_OF_STREAM, self._stop)
+                break
+            items.append(item)
+        return items
+    
+    def _emit(self, results: Dict, t0: float):
+        self._results.put({"results": results, "t0": t0}, self._stop)
+    
+    def _infer(self):
+        last_results: Optional[Dict] = None
+        try:
+            while True:
+                items = self._collect_batch()
+                if items is None:
+                    break
+                if self.budget:
+                    self.budget.start()
+                
+                frames = []
+                for item in items:
+                    if self.motion_gate is not None and not self.motion_gate.check(item["frame"]) \
+                            and last_results is not None:
+                        # Сцена не изменилась - повторяем последние результаты
+                        self._reused += 1
+                        self._emit(dict(last_results, timestamp=item["captured_at"], reused=True), item["t0"])
+                    else:
+                        frames.append(item)
+                if not frames:
+                    continue
+                
+                batch_results = VideoProcessor.process_batch(
+                    [item["frame"] for item in frames],
+                    [item["captured_at"] for item in frames],
+                    self.stop_zone_coords
+                )
+                now = time.monotonic()
+                for item, results in zip(frames, batch_results):
+                    last_results = results
+                    self.stats["inference"].record(now - item["t0"])
+                    self._emit(results, item["t0"])
+                
+                if self.budget:
+                    # Превышение бюджета - пауза инференса; декодирование продолжается
+                    # и вытесняет устаревшие кадры из очереди
+                    delay = self.budget.delay()
+                    if delay > 0:
+                        self._stop.wait(delay)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._results.put(END_OF_STREAM, self._stop)
+    
+    # --- Приемник ---
+    
+    async def run(self, callback: Optional[Callable] = None):
+        """
+        Запуск конвейера; завершается при остановке, конце или обрыве потока
+        Raises:
+            StreamLostError и ошибки стадий/приемника
+        """
+        loop = asyncio.get_running_loop()
+        self._results = ResultQueue(loop, self.queue_size, self.sink_policy, self.stats["sink"])
+        threads = [
+            threading.Thread(target=self._decode, name="stream-decode", daemon=True),
+            threading.Thread(target=self._infer, name="stream-inference", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        
+        try:
+            while True:
+                item = await self._results.get()
+                if item is END_OF_STREAM:
+                    break
+                if callback is None or self.error is not None:
+                    continue
+                try:
+                    await callback(item["results"])
+                except Exception as e:
+                    # Дочитываем очередь до конца, чтобы потоки не ждали приемник
+                    self._fail(e)
+                    continue
+                self.stats["sink"].record(time.monotonic() - item["t0"])
+        finally:
+            self._stop.set()
+            self._results.closed = True
+            for thread in threads:
+                await asyncio.to_thread(thread.join)
+        
+        if self.error is not None:
+            raise self.error
+
+
 class VideoProcessor:
     """Сервис для обработки видеопотоков с камер"""
     
     def __init__(self):
-        self.frame_skip = settings.FRAME_SKIP
         self.max_fps = settings.MAX_FRAMES_PER_SECOND
         self.is_processing = False
+        self.pipeline: Optional[StreamPipeline] = None
+    
+    @staticmethod
+    def process_batch(frames: List[np.ndarray], captured: List[datetime],
+                      stop_zone_coords: Optional[List[List[float]]]) -> List[Dict]:
+        """Детекция пакета кадров одним прогоном модели и расчет результатов по зоне"""
+        results = []
+        for frame, timestamp, detections in zip(frames, captured, cv_service.detect_objects_batch(frames)):
+            buses_info = cv_service.recognize_buses(frame, detections['buses']) if detections['buses'] else []
+            frame_results = cv_service.build_zone_results(frame, detections, buses_info, stop_zone_coords)
+            frame_results['timestamp'] = timestamp
+            frame_results['frame_shape'] = frame.shape[:2]
+            results.append(frame_results)
+        return results
     
     async def process_stream(
         self,
         stream_url: str,
         stop_zone_coords: Optional[List[List[float]]] = None,
-        callback: Optional[Callable] = None
+        callback: Optional[Callable] = None,
+        fps: Optional[float] = None,
+        motion_gate: Optional[MotionGate] = None,
+        batch_size: int = 1,
+        cpu_budget: Optional[float] = None,
+        queue_size: Optional[int] = None,
+        drop_policy: Optional[str] = None
     ):
         """
-        Асинхронная обработка видеопотока
+        Асинхронная обработка видеопотока конвейером (см. StreamPipeline)
         
         Args:
             stream_url: URL видеопотока или путь к файлу
             stop_zone_coords: координаты зоны остановки [[x1,y1], [x2,y2], ...]
-            callback: функция обратного вызова для обработки результатов
-        """
-        cap = cv2.VideoCapture(stream_url)
-        
-        if not cap.isOpened():
-            raise ValueError(f"Не удалось открыть видеопоток: {stream_url}")
+            callback: корутина обработки результатов (выполняется в цикле событий)
+            fps: частота анализа кадров по часам потока (по умолчанию MAX_FRAMES_PER_SECOND);
+                 остальные кадры пропускаются через grab() без декодирования (см. FrameSampler)
+            motion_gate: отбор кадров по движению; для кадров без движения
+                 повторяются последние результаты с флагом reused
+            batch_size: максимум кадров в одном прогоне модели
+            cpu_budget: доля одного ядра на поток (None - без ограничения)
+            queue_size: размер очередей между стадиями
+            drop_policy: политика очереди кадров при отставании инференса
         
+        Raises:
+            StreamLostError: поток не открылся или оборвался
+        """
+        self.pipeline = StreamPipeline(
+            stream_url,
+            stop_zone_coords,
+            fps=fps or self.max_fps,
+            motion_gate=motion_gate,
+            batch_size=batch_size,
+            cpu_budget=cpu_budget,
+            queue_size=queue_size or settings.PIPELINE_QUEUE_SIZE,
+            drop_policy=drop_policy or settings.PIPELINE_DROP_POLICY
+        )
         self.is_processing = True
-        frame_count = 0
-        
         try:
-            while self.is_processing:
-                ret, frame = cap.read()
-                
-                if not ret:
-                    break
-                
-                # Пропуск кадров для оптимизации
-                if frame_count % self.frame_skip != 0:
-                    frame_count += 1
-                    continue
-                
-                # Обработка кадра
-                results = cv_service.process_video_frame(frame, stop_zone_coords)
-                
-                if callback:
-                    await callback(results)
-                
-                # Ограничение FPS
-                await asyncio.sleep(1.0 / self.max_fps)
-                frame_count += 1
-                
+            await self.pipeline.run(callback)
         finally:
-            cap.release()
             self.is_processing = False
     
+    def get_stats(self) -> Optional[Dict]:
+        """Счетчики стадий текущего (или последнего) конвейера"""
+        return self.pipeline.get_stats() if self.pipeline else None
+    
     def process_frame(self, frame: np.ndarray, stop_zone_coords: Optional[List[List[float]]] = None) -> Dict:
         """
         Синхронная обработка одного кадра
@@ -74,7 +511,7 @@ class VideoProcessor:
         Args:
             frame: кадр изображения
             stop_zone_coords: координаты зоны остановки [[x1,y1], [x2,y2], ...]
-            
+        
         Returns:
             Результаты обработки
         """
@@ -83,8 +520,9 @@ class VideoProcessor:
     def stop_processing(self):
         """Остановка обработки видеопотока"""
         self.is_processing = False
+        if self.pipeline is not None:
+            self.pipeline.stop()
 
 
 # Глобальный экземпляр процессора
 video_processor = VideoProcessor()
-
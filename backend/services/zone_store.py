@@ -0,0 +1,203 @@
+"""
+Хранилище готовых снимков зон остановок
+Задача мониторинга публикует отрисованный JPEG зоны и счетчики, эндпоинты API
+отдают их без повторной загрузки снимка и детекции.
+Бэкенды: Redis (общий для всех хостов) или локальные файлы с атомарной заменой
+"""
+import hashlib
+import json
+import os
+import struct
+import tempfile
+from datetime import datetime
+from typing import Dict, Optional
+
+from core.config import settings
+from core.cache import get_redis
+
+
+def make_record(stop_id: int, camera_id: str, jpeg: bytes, people_count: int,
+                buses_count: int, captured_at: Optional[datetime] = None) -> Dict:
+    """Запись снимка зоны; snapshot_id - хэш изображения, используется как ETag"""
+    return {
+        "stop_id": stop_id,
+        "camera_id": camera_id,
+        "snapshot_id": hashlib.sha1(jpeg).hexdigest()[:16],
+        "people_count": int(people_count),
+        "buses_count": int(buses_count),
+        "captured_at": (captured_at or datetime.now()).isoformat(),
+        "jpeg": jpeg,
+    }
+
+
+def record_age_seconds(record: Dict) -> float:
+    return (datetime.now() - datetime.fromisoformat(record["captured_at"])).total_seconds()
+
+
+class RedisZoneStore:
+    """
+    Снимки зон в Redis: метаданные и JPEG в одном хэше, запись в транзакции
+    Предыдущий снимок хранится в том же хэше (prev_meta/prev_jpeg), чтобы ссылка
+    из zone-snapshot-meta оставалась рабочей после следующей публикации
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(stop_id: int) -> str:
+        return f"zone_snapshot:{stop_id}"
+
+    def put(self, record: Dict):
+        meta = {k: v for k, v in record.items() if k != "jpeg"}
+        key = self._key(record["stop_id"])
+        redis_client = get_redis()
+        mapping = {"meta": json.dumps(meta), "jpeg": record["jpeg"]}
+        previous = self._record(*redis_client.hmget(key, "meta", "jpeg"))
+        if previous is not None and previous["snapshot_id"] != meta["snapshot_id"]:
+            mapping["prev_jpeg"] = previous.pop("jpeg")
+            mapping["prev_meta"] = json.dumps(previous)
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    @staticmethod
+    def _record(meta: Optional[bytes], jpeg: Optional[bytes]) -> Optional[Dict]:
+        if meta is None or jpeg is None:
+            return None
+        record = json.loads(meta)
+        record["jpeg"] = jpeg
+        return record
+
+    def get(self, stop_id: int) -> Optional[Dict]:
+        return self._record(*get_redis().hmget(self._key(stop_id), "meta", "jpeg"))
+
+    def get_by_id(self, stop_id: int, snapshot_id: str) -> Optional[Dict]:
+        data = get_redis().hmget(self._key(stop_id), "meta", "jpeg", "prev_meta", "prev_jpeg")
+        for record in (self._record(*data[:2]), self._record(*data[2:])):
+            if record is not None and record["snapshot_id"] == snapshot_id:
+                return record
+        return None
+
+
+class FileZoneStore:
+    """
+    Снимки зон в локальных файлах (для API и воркеров на одном хосте)
+    Файл: 4 байта длины метаданных, JSON метаданных, JPEG.
+    Запись во временный файл и os.replace - читатель видит либо старую, либо новую версию.
+    Перед заменой текущий файл сохраняется как zone_{id}.prev.bin (жесткая ссылка)
+    """
+
+    def __init__(self, directory: str, ttl: int):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, stop_id: int) -> str:
+        return os.path.join(self.directory, f"zone_{stop_id}.bin")
+
+    def _prev_path(self, stop_id: int) -> str:
+        return os.path.join(self.directory, f"zone_{stop_id}.prev.bin")
+
+    def _keep_previous(self, stop_id: int):
+        """Текущий файл становится предыдущим; текущий при этом не пропадает"""
+        link_path = os.path.join(self.directory, f".zone_{stop_id}.{os.getpid()}.prev.tmp")
+        try:
+            os.link(self._path(stop_id), link_path)
+        except FileNotFoundError:
+            return
+        os.replace(link_path, self._prev_path(stop_id))
+
+    def put(self, record: Dict):
+        os.makedirs(self.directory, exist_ok=True)
+        meta = json.dumps({k: v for k, v in record.items() if k != "jpeg"}).encode()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".zone_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(struct.pack(">I", len(meta)))
+                f.write(meta)
+                f.write(record["jpeg"])
+            current = self._read(self._path(record["stop_id"]))
+            if current is not None and current["snapshot_id"] != record["snapshot_id"]:
+                self._keep_previous(record["stop_id"])
+            os.replace(tmp_path, self._path(record["stop_id"]))
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _read(self, path: str) -> Optional[Dict]:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        (meta_length,) = struct.unpack(">I", data[:4])
+        record = json.loads(data[4:4 + meta_length])
+        record["jpeg"] = data[4 + meta_length:]
+        if record_age_seconds(record) > self.ttl:
+            return None
+        return record
+
+    def get(self, stop_id: int) -> Optional[Dict]:
+        return self._read(self._path(stop_id))
+
+    def get_by_id(self, stop_id: int, snapshot_id: str) -> Optional[Dict]:
+        for path in (self._path(stop_id), self._prev_path(stop_id)):
+            record = self._read(path)
+            if record is not None and record["snapshot_id"] == snapshot_id:
+                return record
+        return None
+
+
+def create_zone_store():
+    if settings.ZONE_STORE_BACKEND == "file":
+        return FileZoneStore(settings.ZONE_STORE_DIR, settings.ZONE_STORE_TTL)
+    return RedisZoneStore(settings.ZONE_STORE_TTL)
+
+
+class ZoneStore:
+    """
+    Обертка над бэкендом: ошибки хранилища не должны ломать мониторинг и API
+    Читатели получают None и переходят на расчет по запросу
+    """
+
+    def __init__(self):
+        self.backend = create_zone_store()
+
+    def publish(self, record: Dict) -> bool:
+        try:
+            self.backend.put(record)
+            return True
+        except Exception as e:
+            print(f"[ZONE STORE] Не удалось сохранить снимок зоны остановки {record.get('stop_id')}: {e}")
+            return False
+
+    def get_fresh(self, stop_id: int, max_age: Optional[float] = None) -> Optional[Dict]:
+        """Последний снимок зоны, если он не старше max_age секунд"""
+        max_age = settings.ZONE_STORE_MAX_AGE if max_age is None else max_age
+        try:
+            record = self.backend.get(stop_id)
+        except Exception as e:
+            print(f"[ZONE STORE] Ошибка чтения снимка зоны остановки {stop_id}: {e}")
+            return None
+        if record is None or record_age_seconds(record) > max_age:
+            return None
+        return record
+
+    def get_by_id(self, stop_id: int, snapshot_id: str) -> Optional[Dict]:
+        """
+        Снимок зоны с заданным ID: текущий или предыдущий (в пределах TTL хранилища)
+        Возраст не проверяется - изображение с фиксированным ID не меняется
+        """
+        try:
+            return self.backend.get_by_id(stop_id, snapshot_id)
+        except Exception as e:
+            print(f"[ZONE STORE] Ошибка чтения снимка {snapshot_id} остановки {stop_id}: {e}")
+            return None
+
+
+# Глобальный экземпляр хранилища
+zone_store = ZoneStore()
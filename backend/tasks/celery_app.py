@@ -13,15 +13,30 @@ celery_app = Celery(
 
 celery_app.conf.update(
     task_serializer='json',
-    accept_content=['json'],
+    # msgpack - для задач обработки кадров (serializer задается в задаче)
+    accept_content=['json', 'msgpack'],
     result_serializer='json',
     timezone='UTC',
     enable_utc=True,
     beat_schedule={
         'monitor-all-stops-every-minute': {
-            'task': 'monitor_all_stops_passive',
-            'schedule': 60.0,  # Каждую минуту
+            # batch - один цикл на все камеры, tasks - отдельная задача на каждую камеру
+            'task': 'monitor_all_stops_batch' if settings.MONITORING_MODE == 'batch' else 'monitor_all_stops_passive',
+            'schedule': settings.MONITORING_INTERVAL,  # По умолчанию каждую минуту
+            # Не выполнять устаревший запуск, если воркер не успел его взять
+            'options': {'expires': settings.MONITORING_INTERVAL},
         },
+        'ensure-stream-monitors': {
+            # Перезапуск упавших воркеров непрерывного мониторинга потоков
+            'task': 'ensure_stream_monitors',
+            'schedule': settings.STREAM_MONITOR_LEASE_TTL,
+            'options': {'expires': settings.STREAM_MONITOR_LEASE_TTL},
+        },
+    },
+    # Долгие задачи потоков занимают процесс воркера целиком - отдельная очередь
+    task_routes={
+        'process_video_stream': {'queue': 'streams'},
+        'process_all_streams': {'queue': 'streams'},
     },
 )
 
@@ -2,20 +2,90 @@
 Celery задачи для пассивного мониторинга остановок
 """
 import cv2
-import numpy as np
-import httpx
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 import traceback
 
+from celery.signals import worker_process_shutdown
+
 from tasks.celery_app import celery_app
 from services.cv_service import cv_service
+from services.snapshot_service import snapshot_service, SnapshotError
+from services.zone_store import zone_store, make_record
+from services.load_writer import load_writer
+from services.stop_state import stop_state, recent_buses
+from services.detection_bus import publish_camera_detections, publish_stop_detections
+from services.frame_dedup import frame_dedup
+from services.image_decode import DecodedImage
 from core.database import SessionLocal
-from core.models import LoadData, Stop, BusDetection
+from core.models import Stop
 from core.cameras import IS74_CAMERAS
 
 
+def stop_zones(stops: List[Stop]) -> List[Tuple[int, int, int, int]]:
+    """Прямоугольники зон остановок камеры: снимок уменьшается при декодировании так, чтобы зоны не теряли детализацию"""
+    zones = []
+    for stop in stops:
+        zone = cv_service.zone_bbox(stop.stop_zone_coords)
+        if zone is not None:
+            zones.append(zone)
+    return zones
+
+
+def publish_zone_snapshot(stop_id: int, camera_id: str, image: DecodedImage, results: Dict):
+    """
+    Отрисовка зоны остановки по результатам мониторинга и публикация в хранилище снимков
+    Зона вырезается из декодированного для детекции снимка (координаты результатов - исходного кадра)
+    """
+    try:
+        zone_image = cv_service.render_zone(
+            image.frame, image.box_to_frame(results['stop_zone']),
+            image.to_frame(results.get('people_detections', [])), image.to_frame(results.get('buses', []))
+        )
+        _, encoded_img = cv2.imencode('.jpg', zone_image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        zone_store.publish(make_record(
+            stop_id=stop_id,
+            camera_id=camera_id,
+            jpeg=encoded_img.tobytes(),
+            people_count=results['people_count'],
+            buses_count=results.get('buses_count', 0),
+            captured_at=results.get('timestamp'),
+        ))
+    except Exception as e:
+        print(f"[ERROR] Stop {stop_id} - Failed to publish zone snapshot: {e}")
+
+
+def recognize_image_buses(image: DecodedImage, buses: List[Dict]) -> List[Dict]:
+    """Распознавание номеров по кадру в исходном разрешении (декодируется, только если есть автобусы)"""
+    return cv_service.recognize_buses(image.full(), buses) if buses else []
+
+
+def publish_image_detections(camera_id: str, image: DecodedImage, people: List[Dict], buses: List[Dict], **kwargs):
+    """Детекции снимка (координаты исходного кадра) в шину вместе с декодированным кадром"""
+    publish_camera_detections(camera_id, image.frame, image.to_frame(people), image.to_frame(buses), **kwargs)
+
+
+def detect_camera_frame(camera_id: str, image: DecodedImage) -> Tuple[Dict, List[Dict], bool]:
+    """
+    Детекция и распознавание номеров на снимке камеры (координаты исходного кадра)
+    Если снимок не изменился с прошлого цикла (камера отдала тот же кадр),
+    повторяются результаты прошлого цикла без запуска моделей
+    Returns:
+        (detections, buses_info, повторный ли кадр)
+    """
+    def compute():
+        detections = image.to_full(cv_service.detect_decoded(image))
+        return detections, recognize_image_buses(image, detections['buses'])
+
+    (detections, buses_info), duplicate = frame_dedup.get_or_compute(
+        ("monitor", camera_id), image.frame, compute, exact=True
+    )
+    if duplicate:
+        print(f"[MONITOR] Camera {camera_id}: снимок не изменился, детекция пропущена")
+    return detections, buses_info, duplicate
+
+
 @celery_app.task(name="monitor_stop_passive")
 def monitor_stop_passive_task(stop_id: int):
     """
@@ -43,95 +113,30 @@ def monitor_stop_passive_task(stop_id: int):
             print(f"[ERROR] Stop {stop_id} - No stop_zone_coords!")
             return {"error": "No stop_zone_coords"}
 
-        # Получаем snapshot с камеры
-        snapshot_urls = [
-            f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}&lossy=1",
-            f"https://cdn.cams.is74.ru/snapshot?uuid={camera['uuid']}",
-            f"https://cdn.cams.is74.ru/snapshot/{camera['uuid']}",
-        ]
-
-        frame = None
-        with httpx.Client(timeout=10.0) as client:
-            for snapshot_url in snapshot_urls:
-                try:
-                    response = client.get(snapshot_url, follow_redirects=True)
-                    if response.status_code == 200:
-                        nparr = np.frombuffer(response.content, np.uint8)
-                        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                        if frame is not None:
-                            break
-                except Exception as e:
-                    print(f"[ERROR] Stop {stop_id} - Exception while getting snapshot: {e}")
-                    continue
-
-        if frame is None:
-            print(f"[ERROR] Stop {stop_id} - Failed to get snapshot from camera (camera_id={stop.camera_id}, uuid={camera['uuid']})")
+        # Получаем snapshot с камеры (общий пул соединений процесса)
+        try:
+            image = snapshot_service.fetch_image_sync(stop.camera_id, stop_zones([stop]))
+        except SnapshotError as e:
+            print(f"[ERROR] Stop {stop_id} - Failed to get snapshot from camera (camera_id={stop.camera_id}, uuid={camera['uuid']}): {e}")
             return {"error": "Failed to get snapshot from camera"}
 
         # Обрабатываем кадр
-        results = cv_service.process_video_frame(frame, stop_zone_coords)
+        detections, buses_info, duplicate = detect_camera_frame(stop.camera_id, image)
+        results = cv_service.build_zone_results(image, detections, buses_info, stop_zone_coords)
         print(f"[DEBUG] Stop {stop_id}: detection results: {results}")
 
-        # Получаем количество людей до (последняя запись)
-        last_data = db.query(LoadData).filter(
-            LoadData.stop_id == stop_id
-        ).order_by(LoadData.timestamp.desc()).first()
-
-        people_before = last_data.people_count if last_data else 0
-        print(f"[DEBUG] Stop {stop_id}: people_before = {people_before}")
-
-        # Сохраняем данные о количестве людей и автобусах
-        load_data = LoadData(
-            stop_id=stop_id,
-            timestamp=datetime.now(),
-            people_count=int(results['people_count']),
-            buses_detected=int(results.get('buses_count', 0)),
-            detection_data={
-                'people_detections': results.get('people_detections', []),
-                'stop_zone': results.get('stop_zone'),
-                'people_before': int(people_before)
-            }
+        # Публикуем готовый снимок зоны - API отдает его без повторной детекции
+        publish_zone_snapshot(stop_id, stop.camera_id, image, results)
+        publish_stop_detections(stop_id, stop.camera_id, results)
+        publish_image_detections(
+            stop.camera_id, image, results['people_detections'], results['buses'],
+            stops=[{"stop_id": stop_id, "people_count": results['people_count'], "buses_count": results['buses_count']}]
         )
-        print("[DEBUG] Try insert load_data:",
-              f"stop_id={load_data.stop_id}",
-              f"timestamp={load_data.timestamp}",
-              f"people_count={load_data.people_count}",
-              f"buses_detected={load_data.buses_detected}",
-              f"detection_data={load_data.detection_data}")
-        db.add(load_data)
-        try:
-            db.commit()
-            print(f"[DEBUG] load_data committed succesfully for stop_id={stop_id}!")
-        except Exception as e:
-            db.rollback()
-            tb = traceback.format_exc()
-            print(f"[ERROR][DB COMMIT] {str(e)}\nTraceback:\n{tb}")
-            raise
-
-        # Сохраняем информацию об автобусах
-        buses_info = results.get('buses', [])
-        for bus_info in buses_info:
-            bus_detection = BusDetection(
-                stop_id=stop_id,
-                bus_number=bus_info.get('bus_number'),
-                detected_at=datetime.now(),
-                confidence=bus_info.get('confidence', 0.0),
-                bus_bbox=bus_info.get('bbox'),
-                detection_data={
-                    'people_before': people_before,
-                    'people_after': results['people_count']
-                }
-            )
-            db.add(bus_detection)
 
-        try:
-            db.commit()
-            print(f"[DEBUG] bus_detections committed succesfully for stop_id={stop_id}!")
-        except Exception as e:
-            db.rollback()
-            tb = traceback.format_exc()
-            print(f"[ERROR][DB COMMIT buses] {str(e)}\nTraceback:\n{tb}")
-            raise
+        # Сохраняем данные о количестве людей и автобусах (одна транзакция)
+        people_before = load_writer.add(stop_id, results, stop_name=stop.name)
+        load_writer.flush()
+        buses_info = results.get('buses', [])
 
         return {
             "stop_id": stop_id,
@@ -139,7 +144,8 @@ def monitor_stop_passive_task(stop_id: int):
             "buses_count": results.get('buses_count', 0),
             "people_before": people_before,
             "people_after": results['people_count'],
-            "buses_detected": [b.get('bus_number') for b in buses_info if b.get('bus_number')]
+            "buses_detected": [b.get('bus_number') for b in buses_info if b.get('bus_number')],
+            "duplicate_frame": duplicate
         }
 
     except Exception as e:
@@ -157,6 +163,84 @@ def monitor_stop_passive_task(stop_id: int):
         print(f"[MONITOR] Задача завершена для остановки: {stop_id} -- {datetime.now()}")
 
 
+@celery_app.task(name="monitor_camera_passive")
+def monitor_camera_passive_task(camera_id: str, stop_ids: List[int]):
+    """
+    Пассивный мониторинг всех остановок одной камеры
+    Один snapshot и один прогон детекции (и распознавания номеров) на камеру,
+    люди подсчитываются по зоне каждой остановки из общих детекций
+    Args:
+        camera_id: ID камеры
+        stop_ids: ID остановок этой камеры
+    """
+    db = SessionLocal()
+    print(f"[MONITOR] Задача запущена для камеры: {camera_id}, остановки: {stop_ids} -- {datetime.now()}")
+
+    try:
+        if camera_id not in IS74_CAMERAS:
+            print(f"[ERROR] Camera {camera_id} not found!")
+            return {"error": "Camera not found", "camera_id": camera_id}
+
+        stops = db.query(Stop).filter(Stop.id.in_(stop_ids)).all()
+        stops = [stop for stop in stops if stop.camera_id == camera_id and stop.stop_zone_coords]
+        if not stops:
+            return {"camera_id": camera_id, "stops": []}
+
+        # Получаем snapshot с камеры (общий пул соединений процесса)
+        try:
+            image = snapshot_service.fetch_image_sync(camera_id, stop_zones(stops))
+        except SnapshotError as e:
+            print(f"[ERROR] Camera {camera_id} - Failed to get snapshot (uuid={IS74_CAMERAS[camera_id]['uuid']}): {e}")
+            return {"error": "Failed to get snapshot from camera", "camera_id": camera_id}
+
+        # Детекция и распознавание номеров - один раз на кадр
+        detections, buses_info, duplicate = detect_camera_frame(camera_id, image)
+
+        load_writer.prime([stop.id for stop in stops])
+
+        stop_results = []
+        for stop in stops:
+            try:
+                results = cv_service.build_zone_results(image, detections, buses_info, stop.stop_zone_coords)
+                print(f"[DEBUG] Stop {stop.id}: people_count={results['people_count']}, buses_count={results['buses_count']}")
+
+                publish_zone_snapshot(stop.id, camera_id, image, results)
+                publish_stop_detections(stop.id, camera_id, results)
+                people_before = load_writer.add(stop.id, results, stop_name=stop.name)
+
+                stop_results.append({
+                    "stop_id": stop.id,
+                    "people_count": results['people_count'],
+                    "buses_count": results['buses_count'],
+                    "people_before": people_before,
+                    "people_after": results['people_count'],
+                    "buses_detected": [b.get('bus_number') for b in buses_info if b.get('bus_number')]
+                })
+            except Exception as e:
+                tb = traceback.format_exc()
+                print(f"[ERROR] Stop {stop.id}: {str(e)}\nTraceback:\n{tb}")
+                stop_results.append({"stop_id": stop.id, "error": str(e)})
+
+        publish_image_detections(
+            camera_id, image, detections['people'], buses_info,
+            stops=[r for r in stop_results if "error" not in r]
+        )
+
+        # Все остановки камеры - одной транзакцией
+        load_writer.flush()
+
+        return {"camera_id": camera_id, "stops": stop_results, "duplicate_frame": duplicate}
+
+    except Exception as e:
+        db.rollback()
+        tb = traceback.format_exc()
+        print(f"[CRITICAL ERROR] Camera {camera_id}: {str(e)}\nTraceback:\n{tb}")
+        return {"error": str(e), "camera_id": camera_id}
+    finally:
+        db.close()
+        print(f"[MONITOR] Задача завершена для камеры: {camera_id} -- {datetime.now()}")
+
+
 @celery_app.task(name="monitor_all_stops_passive")
 def monitor_all_stops_passive_task():
     """
@@ -173,24 +257,32 @@ def monitor_all_stops_passive_task():
             Stop.stop_zone_coords.isnot(None)
         ).all()
 
-        results = []
+        # Группируем остановки по камерам: один snapshot и одна детекция на камеру
+        stops_by_camera: Dict[str, List[Stop]] = {}
         for stop in stops:
+            stops_by_camera.setdefault(stop.camera_id, []).append(stop)
+
+        results = []
+        for camera_id, camera_stops in stops_by_camera.items():
+            stop_ids = [stop.id for stop in camera_stops]
             try:
-                result = monitor_stop_passive_task.delay(stop.id)
+                result = monitor_camera_passive_task.delay(camera_id, stop_ids)
                 results.append({
-                    "stop_id": stop.id,
-                    "stop_name": stop.name,
+                    "camera_id": camera_id,
+                    "stop_ids": stop_ids,
+                    "stop_names": [stop.name for stop in camera_stops],
                     "task_id": result.id
                 })
             except Exception as e:
                 results.append({
-                    "stop_id": stop.id,
-                    "stop_name": stop.name,
+                    "camera_id": camera_id,
+                    "stop_ids": stop_ids,
                     "error": str(e)
                 })
 
         return {
-            "monitored_stops": len(results),
+            "monitored_stops": len(stops),
+            "monitored_cameras": len(results),
             "results": results
         }
 
@@ -198,6 +290,148 @@ def monitor_all_stops_passive_task():
         db.close()
 
 
+@celery_app.task(name="monitor_all_stops_batch")
+def monitor_all_stops_batch_task():
+    """
+    Пакетный мониторинг всех активных остановок за один цикл
+    Снимки всех камер загружаются одновременно, детекция - одним батчем YOLO,
+    результаты всех остановок сохраняются в одной транзакции.
+    Время цикла - примерно самая медленная камера плюс один прогон модели
+    """
+    db = SessionLocal()
+    started_at = datetime.now()
+    print(f"[MONITOR] Пакетный мониторинг запущен -- {started_at}")
+
+    try:
+        stops = db.query(Stop).filter(
+            Stop.is_active == True,
+            Stop.camera_id.isnot(None),
+            Stop.stop_zone_coords.isnot(None)
+        ).all()
+
+        stops_by_camera: Dict[str, List[Stop]] = {}
+        for stop in stops:
+            stops_by_camera.setdefault(stop.camera_id, []).append(stop)
+
+        # Снимки всех камер одновременно
+        images = snapshot_service.fetch_images_sync(
+            list(stops_by_camera.keys()),
+            {camera_id: stop_zones(camera_stops) for camera_id, camera_stops in stops_by_camera.items()}
+        )
+
+        errors = []
+        camera_ids = []
+        for camera_id, image in images.items():
+            if isinstance(image, Exception):
+                print(f"[ERROR] Camera {camera_id} - Failed to get snapshot: {image}")
+                errors.append({
+                    "camera_id": camera_id,
+                    "stop_ids": [stop.id for stop in stops_by_camera[camera_id]],
+                    "error": str(image)
+                })
+            else:
+                camera_ids.append(camera_id)
+
+        # Кадры, не изменившиеся с прошлого цикла, получают прошлые результаты без детекции
+        cached: Dict[str, Tuple[Dict, List[Dict]]] = {}
+        fingerprints = {}
+        for camera_id in camera_ids:
+            fingerprints[camera_id], previous = frame_dedup.check(
+                ("monitor", camera_id), images[camera_id].frame, exact=True
+            )
+            if previous is not None:
+                cached[camera_id] = previous
+        detect_ids = [camera_id for camera_id in camera_ids if camera_id not in cached]
+
+        # Одна батч-детекция для всех измененных кадров
+        pending = [images[camera_id] for camera_id in detect_ids]
+        detected = dict(zip(detect_ids, cv_service.detect_objects_batch(
+            [image.frame for image in pending], [image.imgsz for image in pending]
+        )))
+
+        load_writer.prime([stop.id for camera_id in camera_ids for stop in stops_by_camera[camera_id]])
+        timestamp = datetime.now()
+
+        stop_results: List[Tuple[int, Dict]] = []
+        people_before_map: Dict[int, int] = {}
+        for camera_id in camera_ids:
+            image = images[camera_id]
+            camera_stops = []
+            try:
+                if camera_id in cached:
+                    detections, buses_info = cached[camera_id]
+                else:
+                    detections = image.to_full(detected[camera_id])
+                    buses_info = recognize_image_buses(image, detections['buses'])
+                    frame_dedup.remember(("monitor", camera_id), fingerprints[camera_id], (detections, buses_info))
+                for stop in stops_by_camera[camera_id]:
+                    results = cv_service.build_zone_results(image, detections, buses_info, stop.stop_zone_coords)
+                    publish_zone_snapshot(stop.id, camera_id, image, results)
+                    publish_stop_detections(stop.id, camera_id, results)
+                    people_before_map[stop.id] = load_writer.add(stop.id, results, timestamp, stop_name=stop.name)
+                    stop_results.append((stop.id, results))
+                    camera_stops.append({
+                        "stop_id": stop.id,
+                        "people_count": results['people_count'],
+                        "buses_count": results['buses_count']
+                    })
+                publish_image_detections(
+                    camera_id, image, detections['people'], buses_info, stops=camera_stops, captured_at=timestamp
+                )
+            except Exception as e:
+                tb = traceback.format_exc()
+                print(f"[ERROR] Camera {camera_id}: {str(e)}\nTraceback:\n{tb}")
+                errors.append({
+                    "camera_id": camera_id,
+                    "stop_ids": [stop.id for stop in stops_by_camera[camera_id]],
+                    "error": str(e)
+                })
+
+        # Все остановки города - одной транзакцией
+        load_writer.flush()
+
+        duration = (datetime.now() - started_at).total_seconds()
+        print(f"[MONITOR] Пакетный мониторинг завершен за {duration:.1f} с: "
+              f"камер {len(camera_ids)} (без изменений {len(cached)}), остановок {len(stop_results)}, ошибок {len(errors)}")
+
+        return {
+            "monitored_stops": len(stop_results),
+            "monitored_cameras": len(camera_ids),
+            "duration_seconds": round(duration, 3),
+            "duplicate_frames": len(cached),
+            "dedup": frame_dedup.get_stats(),
+            "results": [
+                {
+                    "stop_id": stop_id,
+                    "people_count": results['people_count'],
+                    "buses_count": results['buses_count'],
+                    "people_before": people_before_map.get(stop_id, 0),
+                    "people_after": results['people_count'],
+                    "buses_detected": [b.get('bus_number') for b in results['buses'] if b.get('bus_number')]
+                }
+                for stop_id, results in stop_results
+            ],
+            "errors": errors
+        }
+
+    except Exception as e:
+        db.rollback()
+        tb = traceback.format_exc()
+        print(f"[CRITICAL ERROR][BatchMonitoring] {str(e)}\nTraceback:\n{tb}")
+        return {"error": str(e)}
+    finally:
+        db.close()
+
+
+@worker_process_shutdown.connect
+def flush_pending_results(**kwargs):
+    """Запись оставшихся в буфере результатов при остановке процесса воркера"""
+    try:
+        load_writer.flush()
+    except Exception as e:
+        print(f"[ERROR] Failed to flush monitoring results on shutdown: {e}")
+
+
 @celery_app.task(name="check_buses_from_yandex_maps")
 def check_buses_from_yandex_maps_task(stop_id: int):
     """
@@ -215,28 +449,22 @@ def check_buses_from_yandex_maps_task(stop_id: int):
         if not stop.yandex_map_url:
             return {"error": "Yandex Map URL not configured"}
 
-        # Получаем последние данные о количестве людей
-        last_data = db.query(LoadData).filter(
-            LoadData.stop_id == stop_id
-        ).order_by(LoadData.timestamp.desc()).first()
-
-        people_before = last_data.people_count if last_data else 0
+        # Последнее состояние остановки (Redis, при отсутствии - БД)
+        state = stop_state.get_or_load(db, [stop_id]).get(stop_id)
+        people_before = state["people_count"] if state else 0
 
         # TODO: Реализовать интеграцию с Yandex Maps API
         # Здесь будет запрос к Yandex Maps API для получения информации о приближающихся автобусах
         # Пока используем данные из детекций камер
 
         # Проверяем, есть ли новые автобусы (обнаруженные в последние 2 минуты)
-        recent_buses = db.query(BusDetection).filter(
-            BusDetection.stop_id == stop_id,
-            BusDetection.detected_at >= datetime.now() - timedelta(minutes=2)
-        ).order_by(BusDetection.detected_at.desc()).all()
+        recent = recent_buses(state, timedelta(minutes=2)) if state else []
 
         return {
             "stop_id": stop_id,
             "people_before": people_before,
-            "recent_buses_count": len(recent_buses),
-            "recent_buses": [b.bus_number for b in recent_buses],
+            "recent_buses_count": len(recent),
+            "recent_buses": [b["bus_number"] for b in recent],
         }
     except Exception as e:
         db.rollback()
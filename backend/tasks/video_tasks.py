@@ -1,35 +1,42 @@
 """
 Celery задачи для обработки видеопотоков
 """
-import cv2
-import numpy as np
-from datetime import datetime
+from typing import Dict, List, Optional
 from sqlalchemy.orm import Session
 
 from tasks.celery_app import celery_app
-from services.video_processor import video_processor
 from services.cv_service import cv_service
+from services.detection_bus import publish_stop_detections
+from services.frame_store import frame_store
+from services.image_decode import decode_image
+from services.load_writer import load_writer
+from services.stream_monitor import StreamMonitor, MultiStreamMonitor, is_running, mark_starting
+from core.config import settings
 from core.database import SessionLocal
-from core.models import LoadData, Stop, BusDetection
+from core.models import Stop
+from core.cameras import IS74_CAMERAS
 
 
-@celery_app.task(name="process_video_frame")
-def process_video_frame_task(frame_data: bytes, stop_id: int):
+@celery_app.task(name="process_video_frame", serializer="msgpack")
+def process_video_frame_task(frame_ref: str, stop_id: int):
     """
     Обработка одного кадра видеопотока
     
     Args:
-        frame_data: данные кадра в формате bytes
+        frame_ref: ссылка на изображение в frame_store
         stop_id: ID остановки
     """
+    frame_data = frame_store.take(frame_ref)
+    if frame_data is None:
+        return {"error": "Frame expired or not found"}
+    
     db = SessionLocal()
     
     try:
-        # Декодирование кадра
-        nparr = np.frombuffer(frame_data, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # Декодирование кадра (с уменьшением до размера входа модели, если возможно)
+        image = decode_image(frame_data)
         
-        if frame is None:
+        if image is None:
             return {"error": "Failed to decode frame"}
         
         # Получение информации об остановке
@@ -40,59 +47,136 @@ def process_video_frame_task(frame_data: bytes, stop_id: int):
         # Получение координат зоны остановки
         stop_zone_coords = stop.stop_zone_coords if stop.stop_zone_coords else None
         
-        # Обработка кадра
-        results = video_processor.process_frame(frame, stop_zone_coords)
-        
-        # Сохранение данных о количестве людей и автобусах
-        load_data = LoadData(
-            stop_id=stop_id,
-            timestamp=datetime.now(),
-            people_count=results['people_count'],
-            buses_detected=results.get('buses_count', 0),
-            detection_data={
-                'people_detections': results.get('people_detections', []),
-                'stop_zone': results.get('stop_zone')
-            }
-        )
-        db.add(load_data)
+        # Обработка кадра (координаты детекций - исходного кадра)
+        results = cv_service.process_decoded_frame(image, stop_zone_coords)
         
-        # Обработка автобусов - сохранение детекций
-        for bus_info in results.get('buses', []):
-            detection = BusDetection(
-                stop_id=stop_id,
-                bus_number=bus_info.get('bus_number'),
-                detected_at=datetime.now(),
-                confidence=bus_info.get('confidence'),
-                bus_bbox=bus_info.get('bbox'),
-                detection_data=bus_info
-            )
-            db.add(detection)
+        # Сохранение данных о количестве людей и автобусах и обновление состояния
+        # остановки в Redis (его читают API текущей загруженности)
+        people_before = load_writer.add(stop_id, results, stop_name=stop.name)
+        load_writer.flush()
         
-        db.commit()
+        # Результат доступен клиентам API через шину событий
+        publish_stop_detections(stop_id, stop.camera_id, results)
         
         return {
             "success": True,
             "people_count": results['people_count'],
+            "people_before": people_before,
             "buses_detected": results.get('buses_count', 0)
         }
         
     except Exception as e:
-        db.rollback()
         return {"error": str(e)}
     finally:
         db.close()
 
 
+def _camera_stops(db: Session, camera_id: str) -> List[Dict]:
+    """Активные остановки камеры с настроенной зоной"""
+    stops = db.query(Stop).filter(
+        Stop.camera_id == camera_id,
+        Stop.is_active == True,
+        Stop.stop_zone_coords.isnot(None)
+    ).all()
+    return [{"id": stop.id, "name": stop.name, "stop_zone_coords": stop.stop_zone_coords} for stop in stops]
+
+
 @celery_app.task(name="process_video_stream")
-def process_video_stream_task(stream_url: str, stop_id: int):
+def process_video_stream_task(stream_url: Optional[str], stop_id: int, duration: Optional[float] = None):
     """
-    Обработка видеопотока (для длительных потоков)
+    Непрерывный мониторинг видеопотока камеры остановки
+    Обрабатываются все активные остановки той же камеры; задача работает до
+    остановки через API, истечения duration или потери аренды камеры
     
     Args:
-        stream_url: URL видеопотока
+        stream_url: URL видеопотока (None - URL камеры остановки)
         stop_id: ID остановки
+        duration: время работы, секунды (None - без ограничения)
+    """
+    db = SessionLocal()
+    try:
+        stop = db.query(Stop).filter(Stop.id == stop_id).first()
+        if not stop:
+            return {"error": "Stop not found"}
+        if not stop.camera_id or stop.camera_id not in IS74_CAMERAS:
+            return {"error": "Camera not configured for this stop"}
+        camera_id = stop.camera_id
+        stops = _camera_stops(db, camera_id)
+    finally:
+        db.close()
+    
+    if not stops:
+        return {"error": "No active stops with stop_zone_coords for this camera"}
+    
+    return StreamMonitor(camera_id, stops, stream_url).run(duration)
+
+
+@celery_app.task(name="process_all_streams")
+def process_all_streams_task(camera_ids: Optional[List[str]] = None, duration: Optional[float] = None):
+    """
+    Непрерывный мониторинг нескольких камер в одном процессе (общая модель)
+    
+    Args:
+        camera_ids: камеры (None - STREAM_MONITOR_CAMERAS); занятые другими воркерами пропускаются
+        duration: время работы, секунды (None - без ограничения)
     """
-    # Для длительных задач можно использовать другой подход
-    # Например, запуск отдельного процесса обработки
-    pass
+    camera_ids = camera_ids or settings.STREAM_MONITOR_CAMERAS
+    db = SessionLocal()
+    try:
+        cameras = {}
+        for camera_id in camera_ids:
+            if camera_id not in IS74_CAMERAS:
+                continue
+            stops = _camera_stops(db, camera_id)
+            if stops:
+                cameras[camera_id] = stops
+    finally:
+        db.close()
+    
+    if not cameras:
+        return {"error": "No cameras with active stops"}
+    
+    return MultiStreamMonitor(cameras).run(duration)
+
 
+@celery_app.task(name="ensure_stream_monitors")
+def ensure_stream_monitors_task():
+    """
+    Перезапуск воркеров потоков для камер из STREAM_MONITOR_CAMERAS
+    Воркер, процесс которого упал, теряет аренду по TTL и запускается снова.
+    Запуск, ожидающий в очереди занятых воркеров, отмечен в Redis и не ставится
+    повторно; не взятый за STREAM_MONITOR_LEASE_TTL запуск отбрасывается Celery
+    """
+    if not settings.STREAM_MONITOR_CAMERAS:
+        return {"started": []}
+    
+    missing = [
+        camera_id for camera_id in settings.STREAM_MONITOR_CAMERAS
+        if camera_id in IS74_CAMERAS and not is_running(camera_id)
+    ]
+    if settings.STREAM_MONITOR_MODE == "scheduler":
+        # Один процесс на все незанятые камеры
+        missing = [camera_id for camera_id in missing if mark_starting(camera_id)]
+        if missing:
+            process_all_streams_task.apply_async(
+                args=(missing,), expires=settings.STREAM_MONITOR_LEASE_TTL
+            )
+        return {"started": missing}
+    
+    db = SessionLocal()
+    started = []
+    try:
+        for camera_id in missing:
+            stops = _camera_stops(db, camera_id)
+            if not stops or not mark_starting(camera_id):
+                continue
+            process_video_stream_task.apply_async(
+                args=(None, stops[0]["id"]), expires=settings.STREAM_MONITOR_LEASE_TTL
+            )
+            started.append(camera_id)
+    finally:
+        db.close()
+    
+    if started:
+        print(f"[STREAM] Запущены воркеры потоков камер: {started}")
+    return {"started": started}
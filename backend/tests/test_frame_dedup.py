@@ -0,0 +1,102 @@
+"""Подавление повторных кадров: допуск отпечатка и вытеснение источников"""
+import numpy as np
+
+from services.frame_dedup import DuplicateFrameFilter
+
+
+def make_frame(value: int) -> np.ndarray:
+    frame = np.full((120, 160, 3), value, np.uint8)
+    frame[40:80, 60:100] = 255 - value
+    return frame
+
+
+def make_filter(**kwargs) -> DuplicateFrameFilter:
+    dedup = DuplicateFrameFilter(tolerance=kwargs.pop("tolerance", 4), size=16, max_age=60, **kwargs)
+    dedup.enabled = True
+    return dedup
+
+
+def test_same_frame_reuses_result():
+    dedup = make_filter()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"people": len(calls)}
+
+    first, duplicate = dedup.get_or_compute("ws", make_frame(50), compute)
+    assert (first, duplicate) == ({"people": 1}, False)
+    second, duplicate = dedup.get_or_compute("ws", make_frame(50), compute)
+    assert (second, duplicate) == ({"people": 1}, True)
+    assert len(calls) == 1
+
+
+def test_tolerance():
+    dedup = make_filter(tolerance=4)
+    fingerprint, previous = dedup.check("camera", make_frame(50))
+    assert previous is None
+    dedup.remember("camera", fingerprint, "result")
+
+    # Шум в пределах допуска - тот же кадр
+    assert dedup.check("camera", make_frame(53))[1] == "result"
+    # Разница больше допуска - новый кадр
+    assert dedup.check("camera", make_frame(60))[1] is None
+
+
+def test_sources_are_independent():
+    dedup = make_filter()
+    fingerprint, _ = dedup.check(("ws", "a"), make_frame(50))
+    dedup.remember(("ws", "a"), fingerprint, "a")
+    assert dedup.check(("ws", "b"), make_frame(50))[1] is None
+    stats = dedup.get_stats()
+    assert stats["checked"] == 2
+    assert stats["duplicates"] == 0
+
+
+def test_least_recently_used_source_is_evicted():
+    dedup = make_filter(max_sources=2)
+    for source in ("a", "b"):
+        fingerprint, _ = dedup.check(source, make_frame(50))
+        dedup.remember(source, fingerprint, source)
+
+    # Повтор кадра источника "a" делает его последним использованным
+    assert dedup.check("a", make_frame(50))[1] == "a"
+    fingerprint, _ = dedup.check("c", make_frame(50))
+    dedup.remember("c", fingerprint, "c")
+
+    assert dedup.check("b", make_frame(50))[1] is None
+    assert dedup.check("a", make_frame(50))[1] == "a"
+    assert dedup.check("c", make_frame(50))[1] == "c"
+
+
+def test_disabled_filter_always_computes():
+    dedup = make_filter()
+    dedup.enabled = False
+    dedup.get_or_compute("ws", make_frame(50), lambda: 1)
+    assert dedup.get_or_compute("ws", make_frame(50), lambda: 2) == (2, False)
+
+
+def test_exact_match_for_camera_snapshots():
+    # Человек 15x8 пикселей на кадре 2688x1520 меняет ячейку отпечатка меньше допуска
+    frame = np.full((1520, 2688, 3), 100, np.uint8)
+    arrived = frame.copy()
+    arrived[700:715, 1300:1308] = 200
+    dedup = make_filter(tolerance=4)
+    dedup.size = 32
+
+    fingerprint, _ = dedup.check("zone", frame)
+    dedup.remember("zone", fingerprint, "before")
+    assert dedup.check("zone", arrived)[1] == "before"
+
+    fingerprint, _ = dedup.check("monitor", frame, exact=True)
+    dedup.remember("monitor", fingerprint, "before")
+    assert dedup.check("monitor", arrived, exact=True)[1] is None
+    assert dedup.check("monitor", frame.copy(), exact=True)[1] == "before"
+
+
+def test_exact_match_on_frame_region():
+    frame = np.random.default_rng(0).integers(0, 255, (100, 200, 3), dtype=np.uint8)
+    dedup = make_filter()
+    fingerprint, _ = dedup.check("zone", frame[10:50, 20:80], exact=True)
+    dedup.remember("zone", fingerprint, "zone")
+    assert dedup.check("zone", frame.copy()[10:50, 20:80], exact=True)[1] == "zone"
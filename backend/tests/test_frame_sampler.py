@@ -0,0 +1,56 @@
+"""Расписание отбора кадров FrameSampler по часам потока"""
+import pytest
+
+from services.frame_sampler import FrameSampler
+
+
+def due_times(sampler: FrameSampler, times):
+    return [t for t in times if sampler._due(t)]
+
+
+def test_first_frame_is_due():
+    assert FrameSampler(fps=2)._due(12.3)
+
+
+def test_samples_at_requested_rate():
+    # 25 кадров/с, отбор 2 кадра/с
+    times = [i * 0.04 for i in range(100)]
+    selected = due_times(FrameSampler(fps=2), times)
+    assert len(selected) == 8
+    assert selected[:3] == pytest.approx([0.0, 0.52, 1.0])
+
+
+def test_grid_does_not_drift():
+    # Кадр чуть позже срока не сдвигает следующий срок
+    sampler = FrameSampler(fps=2)
+    assert due_times(sampler, [0.0, 0.2, 0.6, 0.9, 1.0, 1.4, 1.5]) == [0.0, 0.6, 1.0, 1.5]
+
+
+def test_timestamp_rounding_tolerance():
+    # Метки кадров округлены до миллисекунд: кадр за долю миллисекунды до срока отбирается
+    sampler = FrameSampler(fps=2)
+    assert due_times(sampler, [0.0, 0.4995]) == [0.0, 0.4995]
+
+
+def test_gap_restarts_schedule_without_double_sample():
+    sampler = FrameSampler(fps=2)
+    assert due_times(sampler, [0.0, 0.5, 3.0, 3.04, 3.2, 3.5]) == [0.0, 0.5, 3.0, 3.5]
+
+
+def test_reset_with_start_skips_earlier_frames():
+    sampler = FrameSampler(fps=1)
+    sampler.reset(start=10.0)
+    assert due_times(sampler, [9.0, 9.5, 10.0, 10.5, 11.0]) == [10.0, 11.0]
+
+
+def test_set_fps_keeps_schedule():
+    sampler = FrameSampler(fps=1)
+    assert sampler._due(0.0)
+    sampler.set_fps(4)
+    # Срок уже назначен по прежней частоте, дальше - по новой
+    assert due_times(sampler, [0.5, 1.0, 1.1, 1.25]) == [1.0, 1.25]
+
+
+def test_invalid_fps():
+    with pytest.raises(ValueError):
+        FrameSampler(fps=0)
@@ -0,0 +1,96 @@
+"""Уменьшенное декодирование JPEG: размер из заголовка, коэффициент, перевод координат"""
+import cv2
+import numpy as np
+import pytest
+
+from services.image_decode import DecodedImage, decode_image, jpeg_size, reduction_factor
+
+
+def encode(frame: np.ndarray, ext: str = ".jpg") -> bytes:
+    return cv2.imencode(ext, frame)[1].tobytes()
+
+
+def with_orientation(data: bytes, orientation: int) -> bytes:
+    """JPEG с сегментом APP1 (EXIF), содержащим только тег Orientation"""
+    tiff = b"II*\x00" + (8).to_bytes(4, "little") + (1).to_bytes(2, "little")
+    tiff += (0x0112).to_bytes(2, "little") + (3).to_bytes(2, "little") + (1).to_bytes(4, "little")
+    tiff += orientation.to_bytes(2, "little") + b"\x00\x00" + (0).to_bytes(4, "little")
+    payload = b"Exif\x00\x00" + tiff
+    return data[:2] + b"\xff\xe1" + (len(payload) + 2).to_bytes(2, "big") + payload + data[2:]
+
+
+@pytest.mark.parametrize("params", [[], [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]])
+def test_jpeg_size(params):
+    data = cv2.imencode(".jpg", np.zeros((90, 160, 3), np.uint8), params)[1].tobytes()
+    assert jpeg_size(data) == (160, 90)
+
+
+def test_jpeg_size_not_jpeg():
+    assert jpeg_size(encode(np.zeros((10, 10, 3), np.uint8), ".png")) is None
+    assert jpeg_size(b"\xff\xd8\xff") is None
+
+
+def test_reduction_factor_keeps_model_input():
+    # Длинная сторона после уменьшения не меньше imgsz исходного кадра
+    assert reduction_factor(1280, 720) == 2
+    assert reduction_factor(3840, 2160) == 2
+    assert reduction_factor(2688, 1520) == 1
+    assert reduction_factor(1920, 1080) == 1
+    assert reduction_factor(640, 360) == 1
+
+
+def test_reduction_factor_limited_by_zones():
+    # Зона 1500x800 (imgsz 1280) при уменьшении в 2 раза стала бы меньше входа модели
+    assert reduction_factor(3840, 2160, [(0, 0, 1500, 800)]) == 1
+    assert reduction_factor(3840, 2160, [(100, 100, 1500, 400)]) == 2
+    # Вырожденная зона не учитывается
+    assert reduction_factor(3840, 2160, [(10, 10, 10, 10)]) == 2
+
+
+def test_to_full_maps_boxes_to_original_coordinates():
+    image = DecodedImage(b"", np.zeros((360, 640, 3), np.uint8), 1280, 720)
+    assert image.reduced
+    detections = {
+        "people": [{"bbox": [10, 20, 30, 40], "confidence": 0.9, "area": 400.0}],
+        "buses": [],
+    }
+    full = image.to_full(detections)
+    assert full["people"][0]["bbox"] == [20, 40, 60, 80]
+    assert full["people"][0]["area"] == 1600.0
+    assert full["people"][0]["confidence"] == 0.9
+    assert full["frame_shape"] == (720, 1280, 3)
+    # Обратный перевод для отрисовки на уменьшенном кадре
+    assert image.to_frame(full["people"])[0]["bbox"] == [10, 20, 30, 40]
+    assert image.box_to_frame((100, 50, 300, 250)) == (50, 25, 150, 125)
+
+
+def test_to_full_without_reduction_is_identity():
+    frame = np.zeros((720, 1280, 3), np.uint8)
+    image = DecodedImage(b"", frame, 1280, 720)
+    detections = {"people": [{"bbox": [1, 2, 3, 4]}], "buses": []}
+    assert not image.reduced
+    assert image.to_full(detections) is detections
+    assert image.full() is frame
+
+
+def test_decode_image_reduced():
+    frame = np.random.default_rng(0).integers(0, 255, (720, 1280, 3), dtype=np.uint8)
+    image = decode_image(encode(frame))
+    assert image.frame.shape == (360, 640, 3)
+    assert image.shape == (720, 1280, 3)
+    assert image.imgsz == 640
+    assert image.full().shape == (720, 1280, 3)
+
+
+def test_decode_image_invalid():
+    assert decode_image(b"not an image") is None
+
+
+def test_decode_image_ignores_exif_orientation():
+    # Поворот на 90 градусов по EXIF: кадры совпадают с размером из SOF по осям
+    frame = np.random.default_rng(0).integers(0, 255, (720, 1280, 3), dtype=np.uint8)
+    data = with_orientation(encode(frame), 6)
+    assert jpeg_size(data) == (1280, 720)
+    image = decode_image(data)
+    assert image.frame.shape == (360, 640, 3)
+    assert image.full().shape == (720, 1280, 3)
@@ -0,0 +1,66 @@
+"""Слияние состояния остановки с результатами мониторинга"""
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("redis")
+
+from services.stop_state import RECENT_BUSES_LIMIT, StopStateStore  # noqa: E402
+
+
+def make_update(people_count: int, buses=(), timestamp=None):
+    return {
+        "stop_id": 1,
+        "stop_name": "Центральная",
+        "people_count": people_count,
+        "buses_detected": len(buses),
+        "buses": list(buses),
+        "timestamp": timestamp or datetime.now(),
+    }
+
+
+def test_merge_without_previous_state():
+    state = StopStateStore(ttl=60, window=3).merge(None, make_update(4))
+    assert state["people_count"] == 4
+    assert state["smoothed_count"] == 4
+    assert state["history"] == [4]
+    assert state["recent_buses"] == []
+    assert state["stop_name"] == "Центральная"
+
+
+def test_merge_smooths_over_window():
+    store = StopStateStore(ttl=60, window=3)
+    state = None
+    for count in (2, 10, 3, 4):
+        state = store.merge(state, make_update(count))
+    assert state["history"] == [10, 3, 4]
+    assert state["smoothed_count"] == 4
+    assert state["people_count"] == 4
+
+
+def test_merge_keeps_recent_buses():
+    store = StopStateStore(ttl=60, window=3)
+    now = datetime.now()
+    state = store.merge(None, make_update(1, [{"bus_number": "18", "confidence": 0.8}], now - timedelta(minutes=1)))
+    state = store.merge(state, make_update(2, [{"bus_number": "64", "confidence": 0.9}], now))
+    assert [bus["bus_number"] for bus in state["recent_buses"]] == ["64", "18"]
+    assert state["buses_detected"] == 1
+
+
+def test_merge_drops_old_and_excess_buses():
+    store = StopStateStore(ttl=60, window=3)
+    now = datetime.now()
+    old = store.merge(None, make_update(1, [{"bus_number": "old"}], now - timedelta(hours=1)))
+    state = store.merge(old, make_update(1, [{"bus_number": str(i)} for i in range(RECENT_BUSES_LIMIT + 2)], now))
+    numbers = [bus["bus_number"] for bus in state["recent_buses"]]
+    assert "old" not in numbers
+    assert len(numbers) == RECENT_BUSES_LIMIT
+
+
+def test_merge_keeps_stop_name_when_update_has_none():
+    store = StopStateStore(ttl=60, window=3)
+    state = store.merge(None, make_update(1))
+    update = make_update(2)
+    update["stop_name"] = None
+    assert store.merge(state, update)["stop_name"] == "Центральная"
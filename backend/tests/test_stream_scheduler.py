@@ -0,0 +1,40 @@
+"""Расписание потоков MultiStreamScheduler"""
+import threading
+
+import pytest
+
+from services.stream_scheduler import CaptureSource, MultiStreamScheduler, ScheduledStream
+
+
+def make_stream(fps: float = 2.0) -> ScheduledStream:
+    source = CaptureSource("cam", [], fps, threading.Event())
+    stream = ScheduledStream(source, fps, None)
+    stream.next_due = 0.0
+    return stream
+
+
+def test_grid_does_not_drift():
+    stream = make_stream(fps=2)
+    stream.served(0.1)
+    assert stream.next_due == pytest.approx(0.5)
+    stream.served(0.7)
+    assert stream.next_due == pytest.approx(1.0)
+    assert stream.deadline_missed == 0
+
+
+def test_gap_restarts_schedule():
+    # После разрыва следующий кадр не должен оказаться просроченным сразу
+    stream = make_stream(fps=2)
+    stream.served(0.0)
+    stream.served(3.2)
+    assert stream.next_due == pytest.approx(3.7)
+    assert stream.deadline_missed == 1
+
+
+def test_wait_ignores_overdue_streams_without_frame():
+    scheduler = MultiStreamScheduler(batch_size=1, max_frame_age=1.0)
+    scheduler._streams["cam"] = make_stream()
+    waits = []
+    scheduler._notify.wait = lambda timeout: waits.append(timeout)
+    scheduler._wait(now=10.0, timeout=0.5)
+    assert waits == [0.5]
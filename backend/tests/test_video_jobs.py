@@ -0,0 +1,26 @@
+"""Агрегация результатов офлайн обработки видео по секундам"""
+from services.video_jobs import per_second_counts
+
+
+def test_per_second_counts():
+    samples = [
+        [0.0, 3, 0],
+        [0.5, 5, 1],
+        [0.9, 4, 0],
+        [2.1, 7, 2],
+        [2.6, 8, 1],
+    ]
+    assert per_second_counts(samples) == [
+        {"second": 0, "people_count": 4, "buses_count": 1, "samples": 3},
+        {"second": 2, "people_count": 7, "buses_count": 2, "samples": 2},
+    ]
+
+
+def test_per_second_counts_unordered_samples():
+    # Отрезки обрабатываются параллельно, выборки приходят не по порядку
+    samples = [[5.2, 1, 0], [1.0, 2, 0], [5.7, 3, 1]]
+    assert [item["second"] for item in per_second_counts(samples)] == [1, 5]
+
+
+def test_per_second_counts_empty():
+    assert per_second_counts([]) == []
@@ -0,0 +1,40 @@
+"""Префикс ID кадра в сообщениях WebSocket /process-video-stream"""
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("redis")
+pytest.importorskip("celery")
+
+from api.cv import JPEG_SOI, frame_message, parse_client_frame  # noqa: E402
+
+JPEG = JPEG_SOI + b"\xff\xe0jpeg-data\xff\xd9"
+
+
+def test_untagged_frame():
+    assert parse_client_frame(JPEG) == (None, JPEG)
+
+
+def test_tagged_frame():
+    assert parse_client_frame((42).to_bytes(4, "big") + JPEG) == (42, JPEG)
+    assert parse_client_frame(b"\x00\x00\x00\x00" + JPEG) == (0, JPEG)
+
+
+def test_largest_frame_id_is_not_taken_for_jpeg():
+    # ID меньше 0xFFD80000 не начинается с SOI
+    frame_id = 0xFFD7FFFF
+    assert parse_client_frame(frame_id.to_bytes(4, "big") + JPEG) == (frame_id, JPEG)
+
+
+def test_message_without_frame():
+    assert parse_client_frame(b"\x00\x00\x00\x01") is None
+    assert parse_client_frame(b"\x01") is None
+
+
+def test_response_keeps_client_format():
+    assert frame_message(42, True, JPEG) == (42).to_bytes(4, "big") + JPEG
+    assert frame_message(42, False, JPEG) == JPEG
+
+
+def test_round_trip():
+    assert parse_client_frame(frame_message(7, True, JPEG)) == (7, JPEG)